@@ -0,0 +1,174 @@
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from depth_camera_array.fusion import voxel_indices, voxel_keys
+
+
+class OrientedBoundingBox(NamedTuple):
+    """Box with the given center, edge directions as rows of axes and full edge lengths along them"""
+    center: np.ndarray
+    axes: np.ndarray
+    extents: np.ndarray
+
+
+class CrossSection(NamedTuple):
+    """(N, 2) x and z coordinates of the points within a horizontal slice and the area they occupy"""
+    points: np.ndarray
+    area: float
+
+
+def gather_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Returns the concatenated indices of the ranges [start, start + count) without a Python loop"""
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+    return np.arange(total) + offsets
+
+
+def occupied_cells(coordinates: np.ndarray, cell_size: float) -> int:
+    """Returns the number of grid cells of the given size that contain at least one of the (N, D) coordinates"""
+    if coordinates.shape[0] == 0:
+        return 0
+    cells = np.floor(coordinates / np.float32(cell_size)).astype(np.int64)
+    cells -= cells.min(axis=0)
+    keys = np.ravel_multi_index(tuple(cells.T), tuple(cells.max(axis=0) + 1))
+    return np.unique(keys).shape[0]
+
+
+class PointCloudIndex:
+    """Voxel hash over a world point cloud that answers geometric queries about the measured object.
+
+    The points are sorted by their voxel once, so the points of any set of voxels are contiguous slices and most
+    queries only touch the voxels instead of all points. The k-d tree for nearest neighbour queries is built on the
+    first query and reused afterwards. The y axis points upwards, as for the measurement cylinder.
+    """
+
+    def __init__(self, points: np.ndarray, voxel_size: float = 0.01):
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        self.voxel_size = voxel_size
+        indices = voxel_indices(points, voxel_size)
+        keys = voxel_keys(indices)
+        order = np.argsort(keys)
+        self.points = np.take(points, order, axis=0)
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.diff(sorted_keys, prepend=-1))
+        self.voxels = indices[order[starts]]
+        self.starts = starts
+        self.counts = np.diff(np.append(starts, points.shape[0]))
+        self._tree = None
+
+    def __len__(self) -> int:
+        return self.points.shape[0]
+
+    def points_in_voxels(self, voxel_mask: np.ndarray) -> np.ndarray:
+        """Returns the points of the voxels selected by the bool mask over self.voxels"""
+        return self.points[gather_ranges(self.starts[voxel_mask], self.counts[voxel_mask])]
+
+    def height(self, bottom: float) -> float:
+        """Returns the height of the highest point above bottom"""
+        if len(self) == 0:
+            return 0.
+        # Only the points of the highest voxel layer have to be compared
+        top_layer = self.voxels[:, 1] == self.voxels[:, 1].max()
+        return float(self.points_in_voxels(top_layer)[:, 1].max() - bottom)
+
+    def bounding_box(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the minimum and maximum corner of the axis aligned bounding box"""
+        lower, upper = np.zeros(3, dtype=np.float32), np.zeros(3, dtype=np.float32)
+        # Only the points of the outermost voxel layers have to be compared
+        for axis in range(3):
+            lower[axis] = self.points_in_voxels(self.voxels[:, axis] == self.voxels[:, axis].min())[:, axis].min()
+            upper[axis] = self.points_in_voxels(self.voxels[:, axis] == self.voxels[:, axis].max())[:, axis].max()
+        return lower, upper
+
+    def oriented_box(self, upright: bool = True) -> OrientedBoundingBox:
+        """Returns the bounding box along the principal axes of the points. If upright, the box stands on the ground and
+        is only rotated around the y axis"""
+        # The covariance is calculated from the moments by a matrix product, which is faster than np.cov
+        center = self.points.mean(axis=0, dtype=np.float64)
+        covariance = (self.points.T @ self.points).astype(np.float64) / len(self) - np.outer(center, center)
+        if upright:
+            _, vectors = np.linalg.eigh(covariance[np.ix_([0, 2], [0, 2])])
+            major = vectors[:, -1]
+            axes = np.array([[major[0], 0., major[1]], [0., 1., 0.], [-major[1], 0., major[0]]])
+        else:
+            _, vectors = np.linalg.eigh(covariance)
+            axes = vectors[:, ::-1].T
+        # Coordinates along the axes as rows, since reducing contiguous rows is much faster than reducing columns
+        local = axes.astype(np.float32) @ self.points.T
+        lower, upper = local.min(axis=1).astype(np.float64), local.max(axis=1).astype(np.float64)
+        return OrientedBoundingBox((lower + upper) / 2 @ axes, axes, upper - lower)
+
+    def cross_section(self, height: float, thickness: float = None) -> CrossSection:
+        """Returns the points within thickness / 2 of the given y coordinate and their area by occupancy of a grid of
+        the voxel size. The thickness defaults to the voxel size"""
+        thickness = thickness or self.voxel_size
+        lower, upper = height - thickness / 2, height + thickness / 2
+        layers = (self.voxels[:, 1] >= np.floor(lower / self.voxel_size)) & \
+                 (self.voxels[:, 1] <= np.floor(upper / self.voxel_size))
+        points = self.points_in_voxels(layers)
+        points = points[(points[:, 1] >= lower) & (points[:, 1] <= upper)][:, [0, 2]]
+        return CrossSection(points, occupied_cells(points, self.voxel_size) * self.voxel_size ** 2)
+
+    def occupied_volume(self) -> float:
+        """Returns the volume of the occupied voxels, which approximates the volume of the measured surface layer"""
+        return self.voxels.shape[0] * self.voxel_size ** 3
+
+    def column_volume(self, bottom: float) -> float:
+        """Returns the volume between bottom and the highest occupied voxel of each vertical column of voxels, which
+        approximates the volume of an object standing on the ground seen from above"""
+        if self.voxels.shape[0] == 0:
+            return 0.
+        # The columns are cells of a dense grid over the x z extent, which is small for a cropped point cloud
+        lower = self.voxels.min(axis=0)
+        span = self.voxels.max(axis=0) - lower + 1
+        columns = (self.voxels[:, 0] - lower[0]) * span[2] + self.voxels[:, 2] - lower[2]
+        tops = np.full(span[0] * span[2], lower[1] - 1)
+        np.maximum.at(tops, columns, self.voxels[:, 1])
+        tops = (tops[tops >= lower[1]] + 1) * self.voxel_size
+        return float(np.clip(tops - bottom, 0., None).sum() * self.voxel_size ** 2)
+
+    def nearest_distances(self, points: np.ndarray) -> np.ndarray:
+        """Returns the distance of each of the (N, 3) points to its nearest neighbour in this point cloud"""
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(self.points)
+        distances, _ = self._tree.query(np.asarray(points, dtype=np.float64).reshape(-1, 3), workers=-1)
+        return distances
+
+
+def summarize_distances(distances: np.ndarray) -> dict:
+    if distances.shape[0] == 0:
+        return {'point_count': 0}
+    mean, median, p95, maximum = np.mean(distances), *np.percentile(distances, [50, 95, 100])
+    return {'point_count': int(distances.shape[0]), 'mean': float(mean), 'median': float(median), 'p95': float(p95),
+            'max': float(maximum)}
+
+
+def summarize(index: PointCloudIndex, bottom: float, section_heights: Sequence[float] = (),
+              reference: Optional[PointCloudIndex] = None) -> dict:
+    """Returns a JSON serializable summary of the measured point cloud: its height above bottom, bounding boxes,
+    volumes, the cross-sections at the given heights above bottom and, if a reference capture is given, the distances
+    of the points to their nearest neighbours in the reference"""
+    summary = {'point_count': len(index), 'voxel_size': index.voxel_size}
+    if len(index) == 0:
+        return summary
+    lower, upper = index.bounding_box()
+    box = index.oriented_box()
+    sections: List[dict] = []
+    for section_height in section_heights:
+        section = index.cross_section(bottom + section_height)
+        sections.append({'height': section_height, 'point_count': int(section.points.shape[0]), 'area': section.area})
+    summary.update({
+        'height': index.height(bottom),
+        'bounding_box': {'min': lower.tolist(), 'max': upper.tolist()},
+        'oriented_box': {'center': box.center.tolist(), 'axes': box.axes.tolist(), 'extents': box.extents.tolist()},
+        'occupied_volume': index.occupied_volume(),
+        'column_volume': index.column_volume(bottom),
+        'cross_sections': sections
+    })
+    if reference is not None:
+        summary['reference_distances'] = summarize_distances(reference.nearest_distances(index.points))
+    return summary
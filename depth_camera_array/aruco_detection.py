@@ -0,0 +1,152 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+_dictionary = None
+_detector_parameters = None
+
+Detection = Tuple[np.ndarray, List[int]]
+
+
+def get_dictionary():
+    """Returns the ArUco dictionary of the calibration targets. It is created only once"""
+    global _dictionary
+    if _dictionary is None:
+        from cv2 import aruco
+        _dictionary = aruco.Dictionary_get(aruco.DICT_5X5_250)
+    return _dictionary
+
+
+def get_detector_parameters():
+    global _detector_parameters
+    if _detector_parameters is None:
+        from cv2 import aruco
+        _detector_parameters = aruco.DetectorParameters_create()
+    return _detector_parameters
+
+
+def _detect(gray_image: np.ndarray) -> Detection:
+    from cv2 import aruco
+    corners, ids, _ = aruco.detectMarkers(gray_image, get_dictionary(), parameters=get_detector_parameters())
+    if ids is None:
+        return np.zeros((0, 4, 2), dtype=np.float32), []
+    return np.array([item[0] for item in corners], dtype=np.float32), [int(item[0]) for item in ids]
+
+
+def _to_gray(image: np.ndarray) -> np.ndarray:
+    if image.ndim == 2:
+        return image
+    import cv2
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def regions_of_interest(corners: np.ndarray, image_shape: Tuple[int, int], margin: float,
+                        min_margin: int = 8) -> np.ndarray:
+    """Returns the (N, 4) bounding boxes [left, top, right, bottom) of the (N, 4, 2) marker corners, extended by
+    margin times the marker size, but at least min_margin pixels, and clipped to the image"""
+    lower = corners.min(axis=1)
+    upper = corners.max(axis=1)
+    extension = np.maximum((upper - lower).max(axis=1, keepdims=True) * margin, min_margin)
+    lower = np.floor(lower - extension).astype(np.int64)
+    upper = np.ceil(upper + extension).astype(np.int64) + 1
+    height, width = image_shape[:2]
+    return np.stack([np.clip(lower[:, 0], 0, width), np.clip(lower[:, 1], 0, height),
+                     np.clip(upper[:, 0], 0, width), np.clip(upper[:, 1], 0, height)], axis=1)
+
+
+def detect_in_regions(gray_image: np.ndarray, regions: np.ndarray, expected_ids: List[int]) -> Detection:
+    """Detects the expected marker in each region at full resolution. Markers of other ids in a region are ignored, so
+    overlapping regions do not yield duplicates"""
+    found_corners, found_ids = [], []
+    for (left, top, right, bottom), expected_id in zip(regions, expected_ids):
+        corners, ids = _detect(gray_image[top:bottom, left:right])
+        for marker_corners, marker_id in zip(corners, ids):
+            if marker_id == expected_id and marker_id not in found_ids:
+                found_corners.append(marker_corners + np.array([left, top], dtype=np.float32))
+                found_ids.append(marker_id)
+    if not found_ids:
+        return np.zeros((0, 4, 2), dtype=np.float32), []
+    return np.stack(found_corners), found_ids
+
+
+class ArucoDetector:
+    """Detects the ArUco markers of the calibration targets in the color images of several cameras.
+
+    With a coarse scale below 1, marker candidates are detected on a downscaled image first and the corners are
+    detected again at full resolution only within a margin around each candidate. If nothing is found on the
+    downscaled image, the full image is searched. In tracking mode, the markers are searched only around the markers
+    of the previous frame of the same camera. The full search is repeated if a marker got lost or after
+    tracking_interval frames, so new markers are found as well. Images of different cameras are processed in parallel
+    by a thread pool, since OpenCV releases the GIL. The pool is kept until the detector is closed.
+    """
+
+    def __init__(self, coarse_scale: float = 1., roi_margin: float = 0.5, tracking: bool = False,
+                 tracking_interval: int = 30, workers: int = None):
+        if not 0 < coarse_scale <= 1:
+            raise ValueError('The coarse scale has to be within (0, 1].')
+        self.coarse_scale = coarse_scale
+        self.roi_margin = roi_margin
+        self.tracking = tracking
+        self.tracking_interval = tracking_interval
+        self.workers = workers
+        self._previous: Dict[str, Tuple[Detection, int]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Shuts the thread pool down"""
+        self._executor.shutdown()
+
+    def detect(self, image: np.ndarray, camera_id: str = '') -> Detection:
+        """Returns the (N, 4, 2) float32 corners and the ids of the markers in a bgr8 or gray image"""
+        gray_image = _to_gray(image)
+        previous = self._previous.get(camera_id) if self.tracking else None
+        detection = None
+        if previous is not None and previous[1] < self.tracking_interval:
+            (previous_corners, previous_ids), tracked_frames = previous
+            detection = detect_in_regions(
+                gray_image, regions_of_interest(previous_corners, gray_image.shape, self.roi_margin), previous_ids)
+            if len(detection[1]) < len(previous_ids):
+                detection = None
+            else:
+                self._previous[camera_id] = (detection, tracked_frames + 1)
+        if detection is None:
+            detection = self._detect_coarse_to_fine(gray_image)
+            if self.tracking and detection[1]:
+                self._previous[camera_id] = (detection, 0)
+        return detection
+
+    def _detect_coarse_to_fine(self, gray_image: np.ndarray) -> Detection:
+        if self.coarse_scale == 1:
+            return _detect(gray_image)
+        import cv2
+        coarse_image = cv2.resize(gray_image, None, fx=self.coarse_scale, fy=self.coarse_scale,
+                                  interpolation=cv2.INTER_AREA)
+        coarse_corners, coarse_ids = _detect(coarse_image)
+        if not coarse_ids:
+            return _detect(gray_image)
+        # The margin is increased by the pixel size of the coarse image, since its corners are less accurate
+        regions = regions_of_interest(coarse_corners / self.coarse_scale, gray_image.shape, self.roi_margin,
+                                      min_margin=int(np.ceil(2 / self.coarse_scale)))
+        return detect_in_regions(gray_image, regions, coarse_ids)
+
+    def detect_all(self, images: Dict[str, np.ndarray]) -> Dict[str, Detection]:
+        """Detects the markers in the images of all cameras in parallel"""
+        if len(images) <= 1:
+            return {camera_id: self.detect(image, camera_id) for camera_id, image in images.items()}
+        futures = {camera_id: self._executor.submit(self.detect, image, camera_id)
+                   for camera_id, image in images.items()}
+        return {camera_id: future.result() for camera_id, future in futures.items()}
+
+    def reset(self, camera_id: Optional[str] = None):
+        """Forgets the tracked markers of one or all cameras"""
+        if camera_id is None:
+            self._previous.clear()
+        else:
+            self._previous.pop(camera_id, None)
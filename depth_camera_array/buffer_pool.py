@@ -0,0 +1,115 @@
+import threading
+import weakref
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from depth_camera_array.instrumentation import Instrumentation
+
+BufferKey = Tuple[str, str, str]
+
+
+class BufferPool:
+    """Preallocated arrays that are checked out for one frame and checked back in once the frame has been processed,
+    so the processing of a stream does not allocate full size arrays for every frame.
+
+    Buffers are kept per stage, camera and name. checkout returns a view of the first elements of a free buffer with
+    at least the requested size and capacity, and only allocates if there is none. A checked out array that is
+    garbage collected without being checked in, e.g. because a pipeline buffer dropped its frame, is not reused, since
+    views of it may still exist. The checked out bytes of each stage and camera and their peak are tracked, and exported
+    as peak memory of the stage if the pool is attached to an instrumentation until it is closed.
+    """
+
+    def __init__(self, instrumentation: Instrumentation = None):
+        self._free: Dict[Tuple[BufferKey, np.dtype], List[np.ndarray]] = {}
+        self._checked_out: Dict[int, Tuple[BufferKey, np.ndarray, int, weakref.finalize]] = {}
+        self._bytes: Dict[Tuple[str, str], int] = {}
+        self._peak_bytes: Dict[Tuple[str, str], int] = {}
+        # Reentrant, since a finalizer may run during an allocation while the lock is held
+        self._lock = threading.RLock()
+        self.allocations = 0
+        self.allocated_bytes = 0
+        self.reuses = 0
+        self._instrumentation = instrumentation
+        if instrumentation is not None:
+            instrumentation.add_collector(self._collect_statistics)
+
+    def close(self):
+        """Exports the final statistics and detaches the pool from the instrumentation"""
+        if self._instrumentation is not None:
+            self._instrumentation.remove_collector(self._collect_statistics)
+            self._instrumentation = None
+
+    def checkout(self, stage: str, camera_id: str, name: str, shape: Tuple[int, ...], dtype=np.float32,
+                 capacity: int = 0) -> np.ndarray:
+        """Returns an array of the shape and dtype whose memory belongs to the pool until it is checked in. If the
+        buffer has to be allocated, it gets room for at least capacity elements, e.g. for the largest possible output,
+        so it can be reused for larger results"""
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        key = (stage, camera_id, name)
+        with self._lock:
+            free = self._free.setdefault((key, dtype), [])
+            # A buffer that is too small is dropped, since a larger one is needed from now on
+            buffer = free.pop() if free else None
+            if buffer is None or buffer.shape[0] < size:
+                buffer = np.empty(max(size, capacity), dtype=dtype)
+                self.allocations += 1
+                self.allocated_bytes += buffer.nbytes
+            else:
+                self.reuses += 1
+            array = buffer[:size].reshape(shape)
+            finalizer = weakref.finalize(array, self._forget, id(array))
+            self._checked_out[id(array)] = (key, buffer, array.nbytes, finalizer)
+            self._count_bytes(key, array.nbytes)
+        return array
+
+    def capacity(self, array: np.ndarray) -> int:
+        """Returns the number of elements the buffer of a checked out array can hold, or the size of other arrays"""
+        with self._lock:
+            entry = self._checked_out.get(id(array))
+        return array.size if entry is None else entry[1].shape[0]
+
+    def checkin(self, array: np.ndarray):
+        """Returns a checked out array to the pool. Arrays that were not checked out from the pool are ignored"""
+        with self._lock:
+            entry = self._checked_out.pop(id(array), None)
+            if entry is None:
+                return
+            key, buffer, nbytes, finalizer = entry
+            finalizer.detach()
+            self._count_bytes(key, -nbytes)
+            self._free[(key, buffer.dtype)].append(buffer)
+
+    def checkin_all(self, arrays: Iterable[np.ndarray]):
+        for array in arrays:
+            self.checkin(array)
+
+    def _forget(self, array_id: int):
+        with self._lock:
+            entry = self._checked_out.pop(array_id, None)
+            if entry is not None:
+                self._count_bytes(entry[0], -entry[2])
+
+    def _count_bytes(self, key: BufferKey, difference: int):
+        stage_key = key[:2]
+        self._bytes[stage_key] = self._bytes.get(stage_key, 0) + difference
+        self._peak_bytes[stage_key] = max(self._peak_bytes.get(stage_key, 0), self._bytes[stage_key])
+
+    @property
+    def checked_out(self) -> int:
+        """Returns the number of arrays that are currently checked out"""
+        with self._lock:
+            return len(self._checked_out)
+
+    def peak_bytes(self) -> Dict[Tuple[str, str], int]:
+        """Returns the largest number of bytes that each stage and camera had checked out at the same time"""
+        with self._lock:
+            return dict(self._peak_bytes)
+
+    def _collect_statistics(self, instrumentation: Instrumentation):
+        for (stage, camera_id), peak in self.peak_bytes().items():
+            instrumentation.observe_memory(stage, camera_id, peak)
+        instrumentation.set_counter('buffer_pool_allocations', '', self.allocations)
+        instrumentation.set_counter('buffer_pool_allocated_bytes', '', self.allocated_bytes)
+        instrumentation.set_counter('buffer_pool_reuses', '', self.reuses)
@@ -1,91 +1,143 @@
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple
 
 import numpy as np
 from pyrealsense2 import pyrealsense2 as rs
 
+from depth_camera_array.capture_profiles import CaptureProfile, HostDecimatedFrames, create_filters, \
+    get_capture_profile, MEASUREMENT
+from depth_camera_array.deprojection import create_ray_table, deproject_depth_image, depth_frame_to_depth_image, \
+    deproject_pixels, extrinsics_to_matrix, align_depth_to_color, sample_depth, project_color_pixels_to_depth_pixels
+
+class StreamCalibration(NamedTuple):
+    depth_intrinsics: rs.intrinsics
+    color_intrinsics: rs.intrinsics
+    depth_to_color: np.ndarray
+    color_to_depth: np.ndarray
 
-class Camera:
-    def __init__(self, device_id: str, context: rs.context):
-        resolution_width = 1280
-        resolution_height = 720
-        frame_rate = 30
 
+class Camera:
+    def __init__(self, device_id: str, context: rs.context, warmup_frames: int = 0, profile: CaptureProfile = None):
         self.device_id = device_id
         self._context = context
+        self.profile = profile or CaptureProfile()
 
         self._pipeline = rs.pipeline()
         self._config = rs.config()
         self._config.enable_device(self.device_id)
-        self._config.enable_stream(rs.stream.depth, resolution_width, resolution_height, rs.format.z16, frame_rate)
-        self._config.enable_stream(rs.stream.color, resolution_width, resolution_height, rs.format.bgr8, frame_rate)
+        width, height = self.profile.depth_resolution
+        self._config.enable_stream(rs.stream.depth, width, height, rs.format.z16, self.profile.frame_rate)
+        if self.profile.color:
+            width, height = self.profile.color_resolution
+            self._config.enable_stream(rs.stream.color, width, height, rs.format.bgr8, self.profile.frame_rate)
 
         self._pipeline_profile: rs.pipeline_profile = self._pipeline.start(self._config)
-        self._depth_scale = self._pipeline_profile.get_device().first_depth_sensor().get_depth_scale()
+        depth_sensor = self._pipeline_profile.get_device().first_depth_sensor()
+        if self.profile.visual_preset is not None:
+            depth_sensor.set_option(rs.option.visual_preset,
+                                    int(getattr(rs.rs400_visual_preset, self.profile.visual_preset)))
+        self._depth_scale = depth_sensor.get_depth_scale()
+        self._filters = create_filters(self.profile)
+        self._decimated_profile = None
+        self._reset_stream_caches()
+        # The first frames are discarded, since auto exposure needs some frames to settle
+        for _ in range(warmup_frames):
+            self._pipeline.wait_for_frames()
+
+    def _reset_stream_caches(self):
+        self._ray_table = None
+        self._stream_calibration = None
+        self._aligned_depth = None
+
+    @property
+    def depth_scale(self) -> float:
+        return self._depth_scale
 
     def poll_frames(self) -> rs.composite_frame:
-        """Returns a frames object with each available frame type"""
+        """Returns a frames object with each available frame type. The depth frame is processed by the filters and the
+        host decimation of the capture profile"""
         frames = self._pipeline.wait_for_frames()
+        for processing_block in self._filters:
+            frames = processing_block.process(frames).as_frameset()
+        if self.profile.host_decimation > 1:
+            frames = HostDecimatedFrames(frames, self.profile.host_decimation, self._decimated_profile)
+            self._decimated_profile = frames.profile
         return frames
 
     def close(self):
         self._pipeline.stop()
 
-    def image_points_to_object_points(self, color_pixels: np.array, frames: rs.composite_frame) -> List[
-        Tuple[float, float, float]]:
-        """Calculates the object points for given pixel coordinates of rgb data"""
-        color_frame: rs.video_frame = frames.get_color_frame()
-        depth_frame: rs.depth_frame = frames.get_depth_frame()
-
-        color_profile = color_frame.get_profile().as_video_stream_profile()
-        depth_profile = depth_frame.get_profile().as_video_stream_profile()
-
-        color_intrinsics = color_profile.get_intrinsics()
-        depth_intrinsics = depth_profile.get_intrinsics()
-
-        color_to_depth_extrinsics = color_profile.get_extrinsics_to(depth_profile)
-        depth_to_color_extrinsics = depth_profile.get_extrinsics_to(color_profile)
-
-        depth_pixels = [
-            rs.rs2_project_color_pixel_to_depth_pixel(
-                data=depth_frame.get_data(),
-                depth_scale=self._depth_scale,
-                depth_min=0.1,
-                depth_max=10.0,
-                depth_intrin=depth_intrinsics,
-                color_intrin=color_intrinsics,
-                depth_to_color=depth_to_color_extrinsics,
-                color_to_depth=color_to_depth_extrinsics,
-                from_pixel=color_pixel
+    def get_stream_calibration(self, frames: rs.composite_frame) -> StreamCalibration:
+        """Returns intrinsics and extrinsics of the depth and color stream. They are fetched only once per camera"""
+        if self._stream_calibration is None:
+            color_profile = frames.get_color_frame().get_profile().as_video_stream_profile()
+            depth_profile = frames.get_depth_frame().get_profile().as_video_stream_profile()
+            self._stream_calibration = StreamCalibration(
+                depth_intrinsics=depth_profile.get_intrinsics(),
+                color_intrinsics=color_profile.get_intrinsics(),
+                depth_to_color=extrinsics_to_matrix(depth_profile.get_extrinsics_to(color_profile)),
+                # Inverted instead of queried, since a host decimated depth profile is no RealSense profile
+                color_to_depth=np.linalg.inv(extrinsics_to_matrix(depth_profile.get_extrinsics_to(color_profile)))
             )
-            for color_pixel in color_pixels
-        ]
-
-        object_points = []
-        for pixel in depth_pixels:
-            depth = depth_frame.get_distance(int(round(pixel[0], 0)), int(round(pixel[1], 0)))
-            object_points.append(rs.rs2_deproject_pixel_to_point(intrin=depth_intrinsics, pixel=pixel, depth=depth))
+        return self._stream_calibration
 
-        return object_points
+    def align_depth_to_color(self, frames: rs.composite_frame) -> np.ndarray:
+        """Returns the depth in m for each pixel of the color frame. It is calculated only once per frame set"""
+        depth_frame: rs.depth_frame = frames.get_depth_frame()
+        frame_number = depth_frame.get_frame_number()
+        if self._aligned_depth is None or self._aligned_depth[0] != frame_number:
+            calibration = self.get_stream_calibration(frames)
+            aligned_depth = align_depth_to_color(depth_frame_to_depth_image(depth_frame),
+                                                 self.get_ray_table(depth_frame), calibration.depth_to_color,
+                                                 calibration.color_intrinsics)
+            self._aligned_depth = (frame_number, aligned_depth)
+        return self._aligned_depth[1]
+
+    def image_points_to_object_points(self, color_pixels: np.array, frames: rs.composite_frame,
+                                      use_aligned_depth: bool = False) -> np.ndarray:
+        """Calculates the (N, 3) float32 object points in depth camera coordinates for given pixel coordinates of rgb
+        data. Points of pixels without depth information are NaN.
+
+        By default, each color pixel is searched along its epipolar line in the depth frame. If use_aligned_depth is
+        set, the depth frame is mapped into the color frame once per frame set and each pixel is looked up directly.
+        """
+        color_pixels = np.asarray(color_pixels, dtype=np.float64).reshape(-1, 2)
+        calibration = self.get_stream_calibration(frames)
+        if use_aligned_depth:
+            depths = sample_depth(self.align_depth_to_color(frames), color_pixels)
+            object_points = deproject_pixels(calibration.color_intrinsics, color_pixels, depths)
+            object_points = object_points @ calibration.color_to_depth[:3, :3].T
+            object_points += calibration.color_to_depth[:3, 3]
+            return object_points
 
-    def depth_frame_to_object_points(self, frames: rs.composite_frame) -> np.array:
         depth_frame: rs.depth_frame = frames.get_depth_frame()
-        depth_profile = depth_frame.get_profile().as_video_stream_profile()
-        depth_intrinsics = depth_profile.get_intrinsics()
-        object_points = []
-        for x in range(depth_intrinsics.width):
-            for y in range(depth_intrinsics.height):
-                pixel = [x, y]
-                depth = depth_frame.get_distance(x, y)
-                object_points.append(
-                    rs.rs2_deproject_pixel_to_point(intrin=depth_intrinsics, pixel=pixel, depth=depth))
-        return np.array(object_points)
+        depth_image = depth_frame_to_depth_image(depth_frame)
+        depth_pixels = project_color_pixels_to_depth_pixels(
+            color_pixels, depth_image, self.get_ray_table(depth_frame), calibration.depth_intrinsics,
+            calibration.color_intrinsics, calibration.depth_to_color, calibration.color_to_depth)
+        depths = sample_depth(depth_image, depth_pixels, window_radius=0)
+        return deproject_pixels(calibration.depth_intrinsics, depth_pixels, depths * self._depth_scale)
+
+    def get_ray_table(self, depth_frame: rs.depth_frame) -> np.ndarray:
+        """Returns the ray lookup table of the depth stream. It is calculated only once per camera"""
+        depth_intrinsics = depth_frame.get_profile().as_video_stream_profile().get_intrinsics()
+        if self._ray_table is None or self._ray_table.shape[0] != depth_intrinsics.width * depth_intrinsics.height:
+            self._ray_table = create_ray_table(depth_intrinsics, self._depth_scale)
+        return self._ray_table
+
+    def depth_frame_to_object_points(self, frames: rs.composite_frame, remove_zero_depth: bool = False) -> np.array:
+        """Calculates an (N, 3) float32 array of object points for each pixel of the depth frame in row major order"""
+        depth_frame: rs.depth_frame = frames.get_depth_frame()
+        return deproject_depth_image(depth_frame_to_depth_image(depth_frame), self.get_ray_table(depth_frame),
+                                     remove_zero_depth)
 
 
 def extract_color_image(frames: rs.composite_frame) -> np.ndarray:
     return np.asanyarray(frames.get_color_frame().get_data())
 
 
-def _find_connected_devices(context):
+def find_connected_devices(context: rs.context) -> List[str]:
+    """Returns the serial numbers of the connected RealSense devices"""
     devices = []
     for device in context.devices:
         if device.get_info(rs.camera_info.name).lower() != 'platform camera':
@@ -93,12 +145,29 @@ def _find_connected_devices(context):
     return devices
 
 
-def initialize_connected_cameras() -> List[Camera]:
-    context = rs.context()
-    device_ids = _find_connected_devices(context)
+def initialize_connected_cameras(recording_dir: str = None, realtime: bool = False, warmup_frames: int = 0,
+                                 rig_config: dict = None, purpose: str = MEASUREMENT) -> List[Camera]:
+    """Initializes a camera for each connected device with its capture profile for the purpose from the rig config. The
+    pipelines of all devices are started in parallel and warmup_frames frames are discarded for each of them. If a
+    recording directory is given, the recorded cameras are replayed instead"""
+    if recording_dir is not None:
+        from depth_camera_array.recording import initialize_replay_cameras
+        return initialize_replay_cameras(recording_dir, realtime)
 
-    devices = [Camera(device_id, context) for device_id in device_ids]
-    return devices
+    context = rs.context()
+    device_ids = find_connected_devices(context)
+    if not device_ids:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(device_ids)) as executor:
+        futures = [executor.submit(Camera, device_id, context, warmup_frames,
+                                   get_capture_profile(rig_config or {}, purpose, device_id))
+                   for device_id in device_ids]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        close_connected_cameras([future.result() for future in futures if future.exception() is None])
+        raise errors[0]
+    return [future.result() for future in futures]
 
 
 def close_connected_cameras(cameras: List[Camera]):
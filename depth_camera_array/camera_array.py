@@ -0,0 +1,166 @@
+import collections
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from pyrealsense2 import pyrealsense2 as rs
+
+from depth_camera_array.camera import Camera
+from depth_camera_array.instrumentation import Instrumentation, DISABLED
+
+
+def pop_synchronized(queues: Dict[str, Deque[Any]], tolerance: float,
+                     get_timestamp: Callable[[Any], float] = lambda frames: frames.get_timestamp()) \
+        -> Tuple[Optional[Dict[str, Any]], List[Tuple[str, Any]]]:
+    """Pops the oldest item of each queue if all of them were captured within the tolerance in ms. Items that are too
+    old to be matched with the items of the other queues are popped as unmatched. Returns the synchronized items or
+    None if no set is complete yet and the list of (device id, item) of the unmatched items"""
+    unmatched = []
+    while all(queues.values()):
+        timestamps = {device_id: get_timestamp(queue[0]) for device_id, queue in queues.items()}
+        latest = max(timestamps.values())
+        outdated = [device_id for device_id, timestamp in timestamps.items() if latest - timestamp > tolerance]
+        if not outdated:
+            return {device_id: queue.popleft() for device_id, queue in queues.items()}, unmatched
+        unmatched += [(device_id, queues[device_id].popleft()) for device_id in outdated]
+    return None, unmatched
+
+
+class CameraArray:
+    """Captures frames of all cameras in parallel and combines them to sets of frames with matching timestamps.
+
+    Each camera is polled by its own grabber thread that appends the frames to a bounded queue. If a queue is full, its
+    oldest frames are dropped. A set of frames is complete as soon as the oldest queued frames of all cameras were
+    captured within the tolerance in ms. Frames that are too old to be matched with the frames of the other cameras are
+    discarded as unmatched. If drop_frames is not set, the grabbers wait for free space in the queues instead, which is
+    useful to process replayed recordings completely. If instrumentation is enabled, the capture latency of each camera
+    as well as the dropped and unmatched frames are recorded.
+    """
+
+    def __init__(self, cameras: List[Camera], queue_size: int = 4, tolerance: float = 15., drop_frames: bool = True,
+                 instrumentation: Instrumentation = DISABLED):
+        self.cameras = cameras
+        self.tolerance = tolerance
+        self._queue_size = queue_size
+        self._drop_frames = drop_frames
+        self._queues = {camera.device_id: collections.deque() for camera in cameras}
+        self._condition = threading.Condition()
+        self._threads = []
+        self._running = False
+        self._error = None
+        self._end_of_stream = {}
+        self.dropped_frames = {camera.device_id: 0 for camera in cameras}
+        self.unmatched_frames = {camera.device_id: 0 for camera in cameras}
+        self._instrumentation = instrumentation
+
+    def __enter__(self) -> 'CameraArray':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._instrumentation.add_collector(self._collect_statistics)
+        self._running = True
+        self._threads = [threading.Thread(target=self._grab, args=(camera,), name=f'grabber-{camera.device_id}',
+                                          daemon=True)
+                         for camera in self.cameras]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._instrumentation.remove_collector(self._collect_statistics)
+
+    def _grab(self, camera: Camera):
+        queue = self._queues[camera.device_id]
+        while self._running:
+            try:
+                with self._instrumentation.measure('capture', camera.device_id):
+                    frames = camera.poll_frames()
+                    frames.keep()
+            except EOFError as error:
+                with self._condition:
+                    self._end_of_stream[camera.device_id] = error
+                    self._condition.notify_all()
+                return
+            except Exception as error:
+                with self._condition:
+                    self._error = error
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                while not self._drop_frames and len(queue) >= self._queue_size and self._running:
+                    self._condition.wait(0.1)
+                if len(queue) >= self._queue_size:
+                    queue.popleft()
+                    self.dropped_frames[camera.device_id] += 1
+                queue.append(frames)
+                self._condition.notify_all()
+
+    def _pop_synchronized_frames(self) -> Optional[Dict[str, rs.composite_frame]]:
+        frames, unmatched = pop_synchronized(self._queues, self.tolerance)
+        for device_id, _ in unmatched:
+            self.unmatched_frames[device_id] += 1
+        if frames is not None or unmatched:
+            self._condition.notify_all()
+        return frames
+
+    def wait_for_frames(self, timeout: float = 5.) -> Dict[str, rs.composite_frame]:
+        """Returns the next set of synchronized frames as dict of device id and frames. Raises a RuntimeError if no
+        set is complete within timeout seconds or if one of the cameras failed. Reraises the EOFError of a replayed
+        camera at the end of its recording, once all of its captured frames were returned or discarded"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if self._error is not None:
+                    raise RuntimeError(f'Capturing frames failed: {self._error}') from self._error
+                frames = self._pop_synchronized_frames()
+                if frames is not None:
+                    return frames
+                for device_id, error in self._end_of_stream.items():
+                    if not self._queues[device_id]:
+                        raise error
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError(f'No synchronized frames arrived within {timeout} s.')
+                self._condition.wait(remaining)
+
+    def clear(self):
+        """Discards all queued frames, so the next frame set is captured after this call"""
+        with self._condition:
+            for queue in self._queues.values():
+                queue.clear()
+            self._condition.notify_all()
+
+    def get_statistics(self) -> Dict[str, Dict[str, int]]:
+        """Returns the number of dropped and unmatched frames for each camera"""
+        with self._condition:
+            return {
+                device_id: {
+                    'dropped_frames': self.dropped_frames[device_id],
+                    'unmatched_frames': self.unmatched_frames[device_id]
+                }
+                for device_id in self._queues
+            }
+
+    def _collect_statistics(self, instrumentation: Instrumentation):
+        for device_id, statistics in self.get_statistics().items():
+            for counter, value in statistics.items():
+                instrumentation.set_counter(counter, device_id, value)
+
+
+def capture_frame_sets(camera_array: CameraArray, frame_count: int = 0) -> Iterator[Dict[str, rs.composite_frame]]:
+    """Yields synchronized frame sets. If frame_count is 0, frames are captured infinitely or until the end of a
+    replayed recording"""
+    captured = 0
+    while frame_count == 0 or captured < frame_count:
+        try:
+            yield camera_array.wait_for_frames()
+        except EOFError:
+            return
+        captured += 1
@@ -0,0 +1,223 @@
+import argparse
+import os
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from pyrealsense2 import pyrealsense2 as rs
+
+from depth_camera_array.utilities import load_json_to_dict
+
+RIG_CONFIG_FILE = 'rig_config.json'
+
+# Purposes a rig config defines capture profiles for
+CALIBRATION = 'calibration'
+MEASUREMENT = 'measurement'
+RECORDING = 'recording'
+PURPOSES = [CALIBRATION, MEASUREMENT, RECORDING]
+
+# RealSense post-processing blocks in the order they are applied
+DECIMATION = 'decimation'
+SPATIAL = 'spatial'
+TEMPORAL = 'temporal'
+HOLE_FILLING = 'hole_filling'
+FILTERS = [DECIMATION, SPATIAL, TEMPORAL, HOLE_FILLING]
+
+
+class CaptureProfile(NamedTuple):
+    """Stream modes and depth processing of one camera.
+
+    filters are RealSense post-processing blocks, decimation is the magnitude of their decimation block.
+    host_decimation reduces each block of host_decimation x host_decimation depth pixels to the mean of its valid
+    pixels with numpy instead.
+    """
+    depth_resolution: Tuple[int, int] = (1280, 720)
+    color_resolution: Tuple[int, int] = (1280, 720)
+    frame_rate: int = 30
+    color: bool = True
+    visual_preset: Optional[str] = None
+    filters: Tuple[str, ...] = ()
+    decimation: int = 2
+    host_decimation: int = 1
+
+    @property
+    def depth_shape(self) -> Tuple[int, int]:
+        """Returns the (height, width) of the processed depth images"""
+        width, height = self.depth_resolution
+        if DECIMATION in self.filters:
+            # The decimation block pads its output to a multiple of 4 pixels
+            width = (width // self.decimation + 3) // 4 * 4
+            height = (height // self.decimation + 3) // 4 * 4
+        return height // self.host_decimation, width // self.host_decimation
+
+    @property
+    def color_shape(self) -> Optional[Tuple[int, int, int]]:
+        return (self.color_resolution[1], self.color_resolution[0], 3) if self.color else None
+
+
+# The measurement does not use the color stream, so it is disabled to save USB bandwidth
+DEFAULT_PROFILES = {
+    CALIBRATION: CaptureProfile(),
+    MEASUREMENT: CaptureProfile(color=False),
+    RECORDING: CaptureProfile()
+}
+
+
+def parse_capture_profile(data: dict, base: CaptureProfile) -> CaptureProfile:
+    """Overrides the fields of base by the entries of a rig config section"""
+    unknown = set(data) - set(CaptureProfile._fields)
+    if unknown:
+        raise ValueError(f'Unknown capture profile settings {sorted(unknown)}. Use some of {CaptureProfile._fields}.')
+    data = {key: tuple(value) if isinstance(value, list) else value for key, value in data.items()}
+    profile = base._replace(**data)
+    unknown_filters = [name for name in profile.filters if name not in FILTERS]
+    if unknown_filters:
+        raise ValueError(f'Unknown filters {unknown_filters}. Use some of {FILTERS}.')
+    if profile.decimation < 1 or profile.host_decimation < 1:
+        raise ValueError('Decimation factors have to be at least 1.')
+    return profile
+
+
+def add_rig_config_argument(parser: argparse.ArgumentParser):
+    parser.add_argument('--rig_config', type=str, default=None,
+                        help='Rig config file with the capture profiles of the cameras for calibration, measurement '
+                             'and recording. Defaults to <data_dir>/rig_config.json if it exists')
+
+
+def load_rig_config(data_dir: str, path: str = None) -> dict:
+    """Loads the rig config at path or, if not given, data_dir/rig_config.json if it exists. Returns an empty config
+    otherwise, so the default profiles are used"""
+    if path is None:
+        path = os.path.join(data_dir, RIG_CONFIG_FILE)
+        if not os.path.exists(path):
+            return {}
+    return load_json_to_dict(path)
+
+
+def get_capture_profile(rig_config: dict, purpose: str, device_id: str = None) -> CaptureProfile:
+    """Returns the capture profile of a device for calibration, measurement or recording. The default profile of the
+    purpose is overridden by the section of the purpose in the rig config, which is overridden by the section of the
+    purpose within the entry of the device in "cameras" """
+    if purpose not in PURPOSES:
+        raise ValueError(f'Unknown purpose {purpose}. Use one of {PURPOSES}.')
+    profile = parse_capture_profile(rig_config.get(purpose, {}), DEFAULT_PROFILES[purpose])
+    camera_config = rig_config.get('cameras', {}).get(device_id, {})
+    return parse_capture_profile(camera_config.get(purpose, {}), profile)
+
+
+def create_filters(profile: CaptureProfile) -> List[rs.filter]:
+    """Creates the RealSense post-processing blocks of the profile. Spatial and temporal filtering is done in the
+    disparity domain, as recommended for stereo depth"""
+    filters = []
+    if DECIMATION in profile.filters:
+        decimation = rs.decimation_filter()
+        decimation.set_option(rs.option.filter_magnitude, profile.decimation)
+        filters.append(decimation)
+    disparity_filters = []
+    if SPATIAL in profile.filters:
+        disparity_filters.append(rs.spatial_filter())
+    if TEMPORAL in profile.filters:
+        disparity_filters.append(rs.temporal_filter())
+    if disparity_filters:
+        filters += [rs.disparity_transform(True)] + disparity_filters + [rs.disparity_transform(False)]
+    if HOLE_FILLING in profile.filters:
+        filters.append(rs.hole_filling_filter())
+    return filters
+
+
+def decimate_depth_image(depth_image: np.ndarray, factor: int) -> np.ndarray:
+    """Reduces each factor x factor block of a z16 depth image to the mean of its non-zero values. Blocks without
+    valid pixels stay 0. Remaining rows and columns at the border are cut off"""
+    height, width = depth_image.shape[0] // factor, depth_image.shape[1] // factor
+    image = depth_image[:height * factor, :width * factor]
+    sums = np.zeros((height, width), dtype=np.uint32)
+    counts = np.zeros((height, width), dtype=np.uint16)
+    # Accumulating one strided view per block offset is several times faster than reducing a reshaped 4D view
+    for row in range(factor):
+        for column in range(factor):
+            block = image[row::factor, column::factor]
+            sums += block
+            counts += block != 0
+    sums += counts >> 1
+    decimated = np.zeros((height, width), dtype=np.uint16)
+    np.floor_divide(sums, counts, out=decimated, where=counts > 0, casting='unsafe')
+    return decimated
+
+
+def decimate_intrinsics(intrinsics: rs.intrinsics, factor: int) -> rs.intrinsics:
+    """Returns the intrinsics of a depth image decimated by decimate_depth_image"""
+    decimated = rs.intrinsics()
+    decimated.width = intrinsics.width // factor
+    decimated.height = intrinsics.height // factor
+    # The center of the first block lies at (factor - 1) / 2 in pixels of the original image
+    decimated.ppx = (intrinsics.ppx - (factor - 1) / 2) / factor
+    decimated.ppy = (intrinsics.ppy - (factor - 1) / 2) / factor
+    decimated.fx = intrinsics.fx / factor
+    decimated.fy = intrinsics.fy / factor
+    decimated.model = intrinsics.model
+    decimated.coeffs = list(intrinsics.coeffs)
+    return decimated
+
+
+class DecimatedDepthProfile:
+    """Stream profile of a host decimated depth frame. Extrinsics are the ones of the original stream"""
+
+    def __init__(self, profile, factor: int):
+        self._profile = profile.as_video_stream_profile()
+        self._intrinsics = decimate_intrinsics(self._profile.get_intrinsics(), factor)
+
+    def as_video_stream_profile(self) -> 'DecimatedDepthProfile':
+        return self
+
+    def get_intrinsics(self) -> rs.intrinsics:
+        return self._intrinsics
+
+    def get_extrinsics_to(self, profile) -> rs.extrinsics:
+        return self._profile.get_extrinsics_to(profile)
+
+
+class DecimatedDepthFrame:
+    def __init__(self, depth_frame, profile: DecimatedDepthProfile, factor: int):
+        self._data = decimate_depth_image(np.asanyarray(depth_frame.get_data()), factor)
+        self._profile = profile
+        self._frame_number = depth_frame.get_frame_number()
+        self._timestamp = depth_frame.get_timestamp()
+
+    def __bool__(self) -> bool:
+        return True
+
+    def get_data(self) -> np.ndarray:
+        return self._data
+
+    def get_profile(self) -> DecimatedDepthProfile:
+        return self._profile
+
+    def get_frame_number(self) -> int:
+        return self._frame_number
+
+    def get_timestamp(self) -> float:
+        return self._timestamp
+
+
+class HostDecimatedFrames:
+    """Composite frame whose depth frame is decimated on the host, while the color frame is passed through"""
+
+    def __init__(self, frames, factor: int, profile: DecimatedDepthProfile = None):
+        depth_frame = frames.get_depth_frame()
+        self._frames = frames
+        self.profile = profile or DecimatedDepthProfile(depth_frame.get_profile(), factor)
+        self._depth_frame = DecimatedDepthFrame(depth_frame, self.profile, factor)
+
+    def get_depth_frame(self) -> DecimatedDepthFrame:
+        return self._depth_frame
+
+    def get_color_frame(self):
+        return self._frames.get_color_frame()
+
+    def get_frame_number(self) -> int:
+        return self._frames.get_frame_number()
+
+    def get_timestamp(self) -> float:
+        return self._frames.get_timestamp()
+
+    def keep(self):
+        self._frames.keep()
@@ -1,10 +1,6 @@
 import argparse
 import os
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from cv2 import aruco
-
 from depth_camera_array.utilities import DEFAULT_DATA_DIR, create_if_not_exists
 
 
@@ -21,6 +17,10 @@ def parse_args() -> argparse.Namespace:
 
 
 def create_bottom_target(data_dir):
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    from cv2 import aruco
+
     shape = (3, 4,)
     fig = plt.figure()
     fig.suptitle('Bottom Targets (1-3)', color='gray')
@@ -47,6 +47,10 @@ def create_bottom_target(data_dir):
 
 
 def create_relative_targets(target_count, min_aruco_id, data_dir):
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    from cv2 import aruco
+
     shape = (2, 3,)
     aruco_id = min_aruco_id
     for i in range(target_count):
@@ -0,0 +1,125 @@
+import abc
+from typing import Tuple
+
+import numpy as np
+
+
+class CropVolume(abc.ABC):
+    """Base class of the convex volumes used to crop point clouds in world coordinates"""
+
+    @abc.abstractmethod
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        """Returns a boolean mask that marks each of the (N, 3) points that lies inside the volume"""
+
+    @abc.abstractmethod
+    def intersect_rays(self, origin: np.ndarray, rays: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the interval [near, far] of the parameter t within which origin + t * ray lies inside the volume for
+        each of the (N, 3) rays. near > far if a ray misses the volume"""
+
+
+def intersect_slabs(origin: np.ndarray, rays: np.ndarray, lower: np.ndarray,
+                    upper: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Intersects the rays with the axis aligned slabs lower <= p <= upper by the slab method"""
+    near = np.full(rays.shape[0], -np.inf)
+    far = np.full(rays.shape[0], np.inf)
+    for axis in range(3):
+        direction = rays[:, axis]
+        parallel = direction == 0
+        inside = lower[axis] <= origin[axis] <= upper[axis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            first = (lower[axis] - origin[axis]) / direction
+            second = (upper[axis] - origin[axis]) / direction
+        # A ray parallel to the slab either lies within it everywhere or nowhere
+        near = np.maximum(near, np.where(parallel, -np.inf if inside else np.inf, np.minimum(first, second)))
+        far = np.minimum(far, np.where(parallel, np.inf if inside else -np.inf, np.maximum(first, second)))
+    return near, far
+
+
+class MeasurementCylinder(CropVolume):
+    """Upright cylinder around the y axis of the world coordinate system"""
+
+    def __init__(self, bottom: float, height: float, radius: float):
+        self.bottom = bottom
+        self.height = height
+        self.radius = radius
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        x, y, z = points[:, 0], points[:, 1], points[:, 2]
+        mask = x * x
+        mask += z * z
+        mask = mask <= self.radius ** 2
+        mask &= y >= self.bottom
+        mask &= y <= self.bottom + self.height
+        return mask
+
+    def intersect_rays(self, origin: np.ndarray, rays: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        origin = np.asarray(origin, dtype=np.float64)
+        rays = np.asarray(rays, dtype=np.float64)
+        near, far = intersect_slabs(origin, rays, np.array([-np.inf, self.bottom, -np.inf]),
+                                    np.array([np.inf, self.bottom + self.height, np.inf]))
+        # Solves (ox + t * rx)^2 + (oz + t * rz)^2 = radius^2 for the mantle
+        a = rays[:, 0] ** 2 + rays[:, 2] ** 2
+        b = origin[0] * rays[:, 0] + origin[2] * rays[:, 2]
+        c = origin[0] ** 2 + origin[2] ** 2 - self.radius ** 2
+        discriminant = b * b - a * c
+        vertical = a == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            root = np.sqrt(np.maximum(discriminant, 0.))
+            near = np.maximum(near, np.where(vertical, -np.inf, (-b - root) / a))
+            far = np.minimum(far, np.where(vertical, np.inf, (-b + root) / a))
+        # Rays that pass the mantle and vertical rays outside of the cylinder miss it
+        missed = (discriminant < 0) | (vertical & (c > 0))
+        far[missed] = -np.inf
+        return near, far
+
+
+class AxisAlignedBox(CropVolume):
+    def __init__(self, min_corner: np.ndarray, max_corner: np.ndarray):
+        self.min_corner = np.asarray(min_corner, dtype=np.float32)
+        self.max_corner = np.asarray(max_corner, dtype=np.float32)
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        mask = np.ones(points.shape[0], dtype=bool)
+        for axis in range(3):
+            mask &= points[:, axis] >= self.min_corner[axis]
+            mask &= points[:, axis] <= self.max_corner[axis]
+        return mask
+
+    def intersect_rays(self, origin: np.ndarray, rays: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return intersect_slabs(np.asarray(origin, dtype=np.float64), np.asarray(rays, dtype=np.float64),
+                               self.min_corner.astype(np.float64), self.max_corner.astype(np.float64))
+
+
+class OrientedBox(CropVolume):
+    """Box with given center and half extents whose axes are the columns of the rotation matrix"""
+
+    def __init__(self, center: np.ndarray, half_extents: np.ndarray, rotation: np.ndarray):
+        self.center = np.asarray(center, dtype=np.float32)
+        self.half_extents = np.asarray(half_extents, dtype=np.float32)
+        self.rotation = np.asarray(rotation, dtype=np.float32)
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        local_points = (points - self.center) @ self.rotation
+        return np.all(np.abs(local_points) <= self.half_extents, axis=1)
+
+    def intersect_rays(self, origin: np.ndarray, rays: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        rotation = self.rotation.astype(np.float64)
+        half_extents = self.half_extents.astype(np.float64)
+        local_origin = (np.asarray(origin, dtype=np.float64) - self.center) @ rotation
+        return intersect_slabs(local_origin, np.asarray(rays, dtype=np.float64) @ rotation, -half_extents,
+                               half_extents)
+
+
+def transform_points(object_points: np.ndarray, extrinsic: np.ndarray) -> np.ndarray:
+    """Applies a 4x4 homogeneous transformation as R * p + t to (N, 3) points. Returns a float32 array"""
+    extrinsic = np.asarray(extrinsic, dtype=np.float32)
+    transformed = np.asarray(object_points, dtype=np.float32) @ extrinsic[:3, :3].T
+    transformed += extrinsic[:3, 3]
+    return transformed
+
+
+def transform_and_crop(object_points: np.ndarray, extrinsic: np.ndarray, crop_volume: CropVolume) -> np.ndarray:
+    """Transforms (N, 3) object points to world coordinates and returns the compact float32 array of those points
+    that lie inside the crop volume"""
+    transformed = transform_points(object_points, extrinsic)
+    return transformed[crop_volume.contains(transformed)]
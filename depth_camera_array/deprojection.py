@@ -0,0 +1,229 @@
+import warnings
+from typing import Tuple
+
+import numpy as np
+from pyrealsense2 import pyrealsense2 as rs
+
+FLT_EPSILON = np.finfo(np.float32).eps
+
+
+def _undistort(intrinsics: rs.intrinsics, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Removes the lens distortion from normalized image coordinates like rs2_deproject_pixel_to_point does"""
+    coeffs = np.asarray(intrinsics.coeffs, dtype=np.float64)
+    x_original, y_original = x, y
+    if intrinsics.model == rs.distortion.inverse_brown_conrady:
+        for _ in range(10):
+            r2 = x * x + y * y
+            icdist = 1. / (1. + ((coeffs[4] * r2 + coeffs[1]) * r2 + coeffs[0]) * r2)
+            xq = x / icdist
+            yq = y / icdist
+            delta_x = 2 * coeffs[2] * xq * yq + coeffs[3] * (r2 + 2 * xq * xq)
+            delta_y = 2 * coeffs[3] * xq * yq + coeffs[2] * (r2 + 2 * yq * yq)
+            x = (x_original - delta_x) * icdist
+            y = (y_original - delta_y) * icdist
+    elif intrinsics.model == rs.distortion.brown_conrady:
+        for _ in range(10):
+            r2 = x * x + y * y
+            icdist = 1. / (1. + ((coeffs[4] * r2 + coeffs[1]) * r2 + coeffs[0]) * r2)
+            delta_x = 2 * coeffs[2] * x * y + coeffs[3] * (r2 + 2 * x * x)
+            delta_y = 2 * coeffs[3] * x * y + coeffs[2] * (r2 + 2 * y * y)
+            x = (x_original - delta_x) * icdist
+            y = (y_original - delta_y) * icdist
+    elif intrinsics.model == rs.distortion.kannala_brandt4:
+        rd = np.maximum(np.sqrt(x * x + y * y), FLT_EPSILON)
+        theta = rd.copy()
+        theta2 = rd * rd
+        for _ in range(4):
+            f = theta * (1 + theta2 * (coeffs[0] + theta2 * (coeffs[1] + theta2 * (
+                    coeffs[2] + theta2 * coeffs[3])))) - rd
+            df = 1 + theta2 * (3 * coeffs[0] + theta2 * (5 * coeffs[1] + theta2 * (
+                    7 * coeffs[2] + 9 * theta2 * coeffs[3])))
+            theta = np.where(np.abs(f) < FLT_EPSILON, theta, theta - f / df)
+            theta2 = theta * theta
+        r = np.tan(theta)
+        x = x * r / rd
+        y = y * r / rd
+    elif intrinsics.model == rs.distortion.ftheta:
+        rd = np.maximum(np.sqrt(x * x + y * y), FLT_EPSILON)
+        r = np.tan(coeffs[0] * rd) / np.arctan(2 * np.tan(coeffs[0] / 2.))
+        x = x * r / rd
+        y = y * r / rd
+    return x, y
+
+
+def deproject_pixels(intrinsics: rs.intrinsics, pixels: np.ndarray, depths: np.ndarray = None) -> np.ndarray:
+    """Vectorized rs2_deproject_pixel_to_point for an (N, 2) array of pixels. Returns an (N, 3) float32 array.
+    If no depths are given, the returned points lie on the plane z = 1"""
+    pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+    x = (pixels[:, 0] - intrinsics.ppx) / intrinsics.fx
+    y = (pixels[:, 1] - intrinsics.ppy) / intrinsics.fy
+    x, y = _undistort(intrinsics, x, y)
+    points = np.empty((pixels.shape[0], 3), dtype=np.float32)
+    points[:, 0] = x
+    points[:, 1] = y
+    points[:, 2] = 1.
+    if depths is not None:
+        points *= np.asarray(depths, dtype=np.float32).reshape(-1, 1)
+    return points
+
+
+def create_ray_table(intrinsics: rs.intrinsics, depth_scale: float = 1.) -> np.ndarray:
+    """Creates an (height * width, 3) float32 lookup table containing the ray of each pixel in row major order. The rays
+    are scaled such that multiplying them with the raw z16 value of the pixel results in its object point"""
+    columns, rows = np.meshgrid(np.arange(intrinsics.width), np.arange(intrinsics.height))
+    pixels = np.stack([columns.ravel(), rows.ravel()], axis=1)
+    ray_table = deproject_pixels(intrinsics, pixels)
+    ray_table *= np.float32(depth_scale)
+    return ray_table
+
+
+def depth_frame_to_depth_image(depth_frame: rs.depth_frame) -> np.ndarray:
+    """Wraps the z16 buffer of a depth frame as (height, width) uint16 array without copying it"""
+    return np.asanyarray(depth_frame.get_data())
+
+
+def deproject_depth_image(depth_image: np.ndarray, ray_table: np.ndarray,
+                          remove_zero_depth: bool = False) -> np.ndarray:
+    """Calculates the (N, 3) float32 object points of a raw z16 depth image by use of a ray table created by
+    create_ray_table. Pixels without depth information are dropped if remove_zero_depth is set"""
+    depth_values = depth_image.reshape(-1)
+    if depth_values.shape[0] != ray_table.shape[0]:
+        raise ValueError(f'Depth image with {depth_values.shape[0]} pixels does not match ray table with '
+                         f'{ray_table.shape[0]} rays.')
+    if remove_zero_depth:
+        valid = np.flatnonzero(depth_values)
+        return ray_table[valid] * depth_values[valid, np.newaxis]
+    return ray_table * depth_values[:, np.newaxis]
+
+
+def _distort(intrinsics: rs.intrinsics, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Applies the lens distortion to normalized image coordinates like rs2_project_point_to_pixel does"""
+    coeffs = np.asarray(intrinsics.coeffs, dtype=np.float64)
+    if intrinsics.model in (rs.distortion.modified_brown_conrady, rs.distortion.inverse_brown_conrady):
+        r2 = x * x + y * y
+        f = 1 + coeffs[0] * r2 + coeffs[1] * r2 * r2 + coeffs[4] * r2 * r2 * r2
+        x = x * f
+        y = y * f
+        r2 = x * x + y * y
+        x, y = (x + 2 * coeffs[2] * x * y + coeffs[3] * (r2 + 2 * x * x),
+                y + 2 * coeffs[3] * x * y + coeffs[2] * (r2 + 2 * y * y))
+    elif intrinsics.model == rs.distortion.brown_conrady:
+        r2 = x * x + y * y
+        f = 1 + coeffs[0] * r2 + coeffs[1] * r2 * r2 + coeffs[4] * r2 * r2 * r2
+        x, y = (x * f + 2 * coeffs[2] * x * y + coeffs[3] * (r2 + 2 * x * x),
+                y * f + 2 * coeffs[3] * x * y + coeffs[2] * (r2 + 2 * y * y))
+    elif intrinsics.model == rs.distortion.ftheta:
+        r = np.maximum(np.sqrt(x * x + y * y), FLT_EPSILON)
+        rd = 1. / coeffs[0] * np.arctan(2 * r * np.tan(coeffs[0] / 2.))
+        x = x * rd / r
+        y = y * rd / r
+    elif intrinsics.model == rs.distortion.kannala_brandt4:
+        r = np.maximum(np.sqrt(x * x + y * y), FLT_EPSILON)
+        theta = np.arctan(r)
+        theta2 = theta * theta
+        rd = theta * (1 + theta2 * (coeffs[0] + theta2 * (coeffs[1] + theta2 * (coeffs[2] + theta2 * coeffs[3]))))
+        x = x * rd / r
+        y = y * rd / r
+    return x, y
+
+
+def project_points(intrinsics: rs.intrinsics, points: np.ndarray) -> np.ndarray:
+    """Vectorized rs2_project_point_to_pixel for an (N, 3) array of points. Returns an (N, 2) float32 array"""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = points[:, 0] / points[:, 2]
+        y = points[:, 1] / points[:, 2]
+        x, y = _distort(intrinsics, x, y)
+    pixels = np.empty((points.shape[0], 2), dtype=np.float32)
+    pixels[:, 0] = x * intrinsics.fx + intrinsics.ppx
+    pixels[:, 1] = y * intrinsics.fy + intrinsics.ppy
+    return pixels
+
+
+def extrinsics_to_matrix(extrinsics: rs.extrinsics) -> np.ndarray:
+    """Converts librealsense extrinsics, whose rotation is stored in column major order, to a 4x4 float32 matrix"""
+    matrix = np.eye(4, dtype=np.float32)
+    matrix[:3, :3] = np.reshape(extrinsics.rotation, (3, 3)).T
+    matrix[:3, 3] = extrinsics.translation
+    return matrix
+
+
+def align_depth_to_color(depth_image: np.ndarray, ray_table: np.ndarray, depth_to_color: np.ndarray,
+                         color_intrinsics: rs.intrinsics) -> np.ndarray:
+    """Maps a raw z16 depth image into the color image. Returns a (color height, color width) float32 image holding the
+    depth in m along the color camera's z axis for each color pixel, 0 where no depth is available. If several depth
+    pixels hit the same color pixel, the closest one wins"""
+    points = deproject_depth_image(depth_image, ray_table, remove_zero_depth=True)
+    points = points @ depth_to_color[:3, :3].T
+    points += depth_to_color[:3, 3]
+    pixels = np.rint(project_points(color_intrinsics, points)).astype(np.int64)
+    inside = (points[:, 2] > 0) & (pixels[:, 0] >= 0) & (pixels[:, 0] < color_intrinsics.width) & \
+             (pixels[:, 1] >= 0) & (pixels[:, 1] < color_intrinsics.height)
+
+    aligned_depth = np.full(color_intrinsics.width * color_intrinsics.height, np.inf, dtype=np.float32)
+    np.minimum.at(aligned_depth, pixels[inside, 1] * color_intrinsics.width + pixels[inside, 0], points[inside, 2])
+    aligned_depth[np.isinf(aligned_depth)] = 0.
+    return aligned_depth.reshape(color_intrinsics.height, color_intrinsics.width)
+
+
+def sample_depth(depth_image: np.ndarray, pixels: np.ndarray, window_radius: int = 1) -> np.ndarray:
+    """Looks up the depth of each of the (N, 2) pixels in a float depth image. Pixels without depth information use the
+    median of the valid depths in the surrounding window. Returns NaN if the window holds no depth at all"""
+    pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+    pixels = np.rint(np.where(np.isfinite(pixels), pixels, -1.)).astype(np.int64)
+    offsets = np.arange(-window_radius, window_radius + 1)
+    columns = np.clip(pixels[:, 0, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :], 0,
+                      depth_image.shape[1] - 1)
+    rows = np.clip(pixels[:, 1, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis], 0,
+                   depth_image.shape[0] - 1)
+    windows = depth_image[rows, columns].reshape(pixels.shape[0], -1).astype(np.float32)
+    depths = windows[:, windows.shape[1] // 2].copy()
+    missing = depths <= 0
+    if np.any(missing):
+        neighbours = windows[missing]
+        neighbours[neighbours <= 0] = np.nan
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            depths[missing] = np.nanmedian(neighbours, axis=1)
+    outside = (pixels[:, 0] < 0) | (pixels[:, 0] >= depth_image.shape[1]) | \
+              (pixels[:, 1] < 0) | (pixels[:, 1] >= depth_image.shape[0])
+    depths[outside] = np.nan
+    return depths
+
+
+def project_color_pixels_to_depth_pixels(color_pixels: np.ndarray, depth_image: np.ndarray, ray_table: np.ndarray,
+                                         depth_intrinsics: rs.intrinsics, color_intrinsics: rs.intrinsics,
+                                         depth_to_color: np.ndarray, color_to_depth: np.ndarray,
+                                         depth_min: float = 0.1, depth_max: float = 10.) -> np.ndarray:
+    """Vectorized rs2_project_color_pixel_to_depth_pixel for an (N, 2) array of color pixels.
+
+    For each color pixel, the depth pixels along its epipolar line between depth_min and depth_max are deprojected and
+    projected back into the color image. The depth pixel whose projection is closest to the color pixel is returned.
+    The ray table must be scaled by the depth scale, so it yields points in m for raw depth values.
+    Returns an (N, 2) float32 array which is NaN for color pixels without any valid depth pixel on their line.
+    """
+    color_pixels = np.asarray(color_pixels, dtype=np.float64).reshape(-1, 2)
+    line_ends = []
+    for depth in (depth_min, depth_max):
+        points = deproject_pixels(color_intrinsics, color_pixels, np.full(color_pixels.shape[0], depth))
+        points = points @ color_to_depth[:3, :3].T + color_to_depth[:3, 3]
+        pixels = project_points(depth_intrinsics, points)
+        line_ends.append(np.clip(pixels, 0, [depth_intrinsics.width - 1, depth_intrinsics.height - 1]))
+    start, end = line_ends
+
+    sample_count = int(np.ceil(np.max(np.abs(end - start), initial=0.))) + 1
+    steps = np.linspace(0., 1., sample_count, dtype=np.float32)
+    samples = start[:, np.newaxis, :] + steps[np.newaxis, :, np.newaxis] * (end - start)[:, np.newaxis, :]
+    indices = samples[..., 1].astype(np.int64) * depth_intrinsics.width + samples[..., 0].astype(np.int64)
+
+    depth_values = depth_image.reshape(-1)[indices]
+    points = ray_table[indices] * depth_values[..., np.newaxis]
+    points = points @ depth_to_color[:3, :3].T + depth_to_color[:3, 3]
+    projected = project_points(color_intrinsics, points.reshape(-1, 3)).reshape(samples.shape)
+    distances = np.sum((projected - color_pixels[:, np.newaxis, :]) ** 2, axis=2)
+    distances[depth_values == 0] = np.inf
+
+    best = np.argmin(distances, axis=1)
+    depth_pixels = samples[np.arange(samples.shape[0]), best].astype(np.float32)
+    depth_pixels[np.isinf(distances[np.arange(samples.shape[0]), best])] = np.nan
+    return depth_pixels
@@ -0,0 +1,119 @@
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+CENTROID = 'centroid'
+MEDIAN = 'median'
+REDUCTIONS = [CENTROID, MEDIAN]
+
+_KEY_BITS = 21
+_MAX_VOXEL_INDEX = (1 << _KEY_BITS) - 1
+# Estimated number of bytes needed per input point while downsampling: voxel indices, keys, sort order and the sorted
+# points
+BYTES_PER_POINT = 80
+
+
+class FusedPointCloud(NamedTuple):
+    points: np.ndarray
+    counts: Optional[np.ndarray] = None
+    camera_masks: Optional[np.ndarray] = None
+    camera_ids: Optional[List[str]] = None
+
+
+def voxel_indices(points: np.ndarray, voxel_size: float) -> np.ndarray:
+    """Returns the (N, 3) integer index of the voxel that contains each point"""
+    return np.floor(points / np.float32(voxel_size)).astype(np.int64)
+
+
+def voxel_keys(indices: np.ndarray) -> np.ndarray:
+    """Packs (N, 3) voxel indices into one int64 key per voxel. The indices are shifted to be non negative first"""
+    indices = indices - indices.min(axis=0, initial=0)
+    if np.any(indices > _MAX_VOXEL_INDEX):
+        raise ValueError('The point cloud spans too many voxels. Increase the voxel size.')
+    return (indices[:, 0] << 2 * _KEY_BITS) | (indices[:, 1] << _KEY_BITS) | indices[:, 2]
+
+
+def _downsample(points: np.ndarray, voxel_size: float, reduction: str, camera_indices: Optional[np.ndarray],
+                with_counts: bool) -> FusedPointCloud:
+    keys = voxel_keys(voxel_indices(points, voxel_size))
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    starts = np.concatenate([[0], np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1])
+    counts = np.diff(np.append(starts, sorted_keys.shape[0]))
+
+    if reduction == CENTROID:
+        sums = np.add.reduceat(points[order].astype(np.float64), starts, axis=0)
+        reduced = (sums / counts[:, np.newaxis]).astype(np.float32)
+    else:
+        reduced = np.empty((starts.shape[0], 3), dtype=np.float32)
+        lower = starts + (counts - 1) // 2
+        upper = starts + counts // 2
+        for axis in range(3):
+            values = points[np.lexsort((points[:, axis], keys)), axis]
+            reduced[:, axis] = (values[lower] + values[upper]) / 2
+
+    camera_masks = None
+    if camera_indices is not None:
+        camera_masks = np.bitwise_or.reduceat(np.left_shift(np.uint64(1), camera_indices[order].astype(np.uint64)),
+                                              starts)
+    return FusedPointCloud(reduced, counts if with_counts else None, camera_masks)
+
+
+def voxel_downsample(points: np.ndarray, voxel_size: float, reduction: str = CENTROID,
+                     camera_indices: np.ndarray = None, with_counts: bool = False,
+                     memory_limit: int = None) -> FusedPointCloud:
+    """Replaces all points within the same voxel by their centroid or median.
+
+    If camera_indices are given, a bit mask of the cameras that contributed to each voxel is returned as well. If a
+    memory limit in bytes is given, the cloud is processed in slabs along the x axis that fit into the limit.
+    """
+    if reduction not in REDUCTIONS:
+        raise ValueError(f'Unknown reduction {reduction}. Use one of {REDUCTIONS}.')
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+    if points.shape[0] == 0:
+        return FusedPointCloud(points, np.zeros(0, dtype=np.int64) if with_counts else None,
+                               np.zeros(0, dtype=np.uint64) if camera_indices is not None else None)
+    max_points = points.shape[0] if memory_limit is None else max(memory_limit // BYTES_PER_POINT, 1)
+    if points.shape[0] <= max_points:
+        return _downsample(points, voxel_size, reduction, camera_indices, with_counts)
+
+    # Slabs consist of whole voxel columns along x, so no voxel is split between two slabs
+    x_indices = np.floor(points[:, 0] / np.float32(voxel_size)).astype(np.int64)
+    unique_x, x_counts = np.unique(x_indices, return_counts=True)
+    slab_ids = np.empty(unique_x.shape[0], dtype=np.int64)
+    slab_id, slab_size = 0, 0
+    for index, count in enumerate(x_counts):
+        if slab_size > 0 and slab_size + count > max_points:
+            slab_id, slab_size = slab_id + 1, 0
+        slab_ids[index] = slab_id
+        slab_size += count
+    slab_starts = unique_x[np.concatenate([[0], np.flatnonzero(np.diff(slab_ids)) + 1])]
+
+    slabs = []
+    for slab_start, slab_end in zip(slab_starts, np.append(slab_starts[1:], unique_x[-1] + 1)):
+        mask = (x_indices >= slab_start) & (x_indices < slab_end)
+        slabs.append(_downsample(points[mask], voxel_size, reduction,
+                                 None if camera_indices is None else camera_indices[mask], with_counts))
+    return FusedPointCloud(
+        np.concatenate([slab.points for slab in slabs]),
+        np.concatenate([slab.counts for slab in slabs]) if with_counts else None,
+        np.concatenate([slab.camera_masks for slab in slabs]) if camera_indices is not None else None
+    )
+
+
+def fuse_point_clouds(point_clouds: Dict[str, np.ndarray], voxel_size: float, reduction: str = CENTROID,
+                      with_statistics: bool = False, memory_limit: int = None) -> FusedPointCloud:
+    """Merges the world coordinate point clouds of several cameras and removes duplicate points in overlapping regions
+    by voxel grid downsampling. With statistics, the number of points and a bit mask of the cameras in camera_ids
+    order is returned for each voxel"""
+    camera_ids = sorted(point_clouds)
+    if len(camera_ids) > 64:
+        raise ValueError('Camera masks support at most 64 cameras.')
+    points = np.concatenate([np.asarray(point_clouds[camera_id], dtype=np.float32).reshape(-1, 3)
+                             for camera_id in camera_ids]) if camera_ids else np.zeros((0, 3), dtype=np.float32)
+    camera_indices = None
+    if with_statistics:
+        camera_indices = np.repeat(np.arange(len(camera_ids), dtype=np.uint8),
+                                   [len(point_clouds[camera_id]) for camera_id in camera_ids])
+    fused = voxel_downsample(points, voxel_size, reduction, camera_indices, with_statistics, memory_limit)
+    return fused._replace(camera_ids=camera_ids if with_statistics else None)
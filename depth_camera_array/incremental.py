@@ -0,0 +1,131 @@
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from depth_camera_array.crop_volumes import CropVolume
+from depth_camera_array.rig import MAX_DEPTH_VALUE, WorldRayTable
+
+
+class ChangeDetection(NamedTuple):
+    """Parameters of the tile based change detection.
+
+    A pixel changed if its depth differs from the reference by more than noise_offset + noise_factor * depth^2 in m,
+    which follows the quadratic growth of the stereo depth noise, or if it became valid or invalid. A tile changed if at
+    least min_changed_pixels of its pixels changed, so single flickering pixels do not trigger an update.
+    """
+    tile_size: int = 16
+    noise_offset: float = 0.005
+    noise_factor: float = 0.01
+    min_changed_pixels: int = 4
+
+
+class FrameChanges(NamedTuple):
+    """(tile rows, tile columns) mask of the changed tiles and the row major indices of the pixels within them"""
+    tiles: np.ndarray
+    pixels: np.ndarray
+
+
+def tile_starts(length: int, tile_size: int) -> np.ndarray:
+    return np.arange(0, length, tile_size)
+
+
+def count_per_tile(mask: np.ndarray, tile_size: int) -> np.ndarray:
+    """Counts the set pixels of each tile of a (height, width) bool mask. Tiles at the border may be smaller"""
+    values = mask.view(np.uint8)
+    full_rows = mask.shape[0] // tile_size * tile_size
+    # Summing whole rows of a reshaped view is an order of magnitude faster than reduceat along the first axis
+    rows = np.add.reduce(values[:full_rows].reshape(-1, tile_size, mask.shape[1]), axis=1, dtype=np.uint16)
+    if full_rows < mask.shape[0]:
+        rows = np.concatenate([rows, np.add.reduce(values[full_rows:], axis=0, dtype=np.uint16)[np.newaxis]])
+    return np.add.reduceat(rows, tile_starts(mask.shape[1], tile_size), axis=1)
+
+
+def create_threshold_table(depth_scale: float, detection: ChangeDetection) -> np.ndarray:
+    """Returns the change threshold in raw z16 units for each raw z16 value"""
+    depth = np.arange(1 << 16) * depth_scale
+    threshold = (detection.noise_offset + detection.noise_factor * depth ** 2) / depth_scale
+    return np.minimum(threshold, (1 << 16) - 1).astype(np.uint16)
+
+
+def detect_changes(depth_image: np.ndarray, reference: np.ndarray, thresholds: np.ndarray,
+                   detection: ChangeDetection) -> np.ndarray:
+    """Returns the (tile rows, tile columns) mask of the tiles in which the z16 depth image differs from the reference.
+    The threshold of a pixel is looked up in the threshold table by the larger of both values"""
+    # A lookup table and differences of uint16 values avoid widening the whole image to floats
+    larger = np.maximum(depth_image, reference)
+    changed = larger - np.minimum(depth_image, reference) > np.take(thresholds, larger)
+    changed |= (depth_image == 0) != (reference == 0)
+    return count_per_tile(changed, detection.tile_size) >= detection.min_changed_pixels
+
+
+class IncrementalDeprojector:
+    """Keeps the world points of one camera in a persistent buffer and updates only the tiles of the depth image that
+    changed since they were processed the last time.
+
+    Each tile is compared with the depth values it had when it was processed, so slow drifts are picked up once they
+    exceed the noise threshold. The first frame is processed completely. Pixels whose depth lies outside the depth
+    range in m are invalid, as in the pixel masks of the compiled rig.
+    """
+
+    def __init__(self, table: WorldRayTable, shape: Tuple[int, int], depth_scale: float,
+                 crop_volume: CropVolume = None, detection: ChangeDetection = ChangeDetection(),
+                 depth_range: Tuple[float, Optional[float]] = (0., None)):
+        if shape[0] * shape[1] != table.rays.shape[0]:
+            raise ValueError(f'Depth image shape {shape} does not match ray table with {table.rays.shape[0]} rays.')
+        self.table = table
+        self.shape = shape
+        self.depth_scale = depth_scale
+        self.crop_volume = crop_volume
+        self.detection = detection
+        # Zero depth is invalid, so the lower bound is at least 1
+        self._near = max(int(np.ceil(depth_range[0] / depth_scale)), 1)
+        self._far = MAX_DEPTH_VALUE if depth_range[1] is None else int(np.floor(depth_range[1] / depth_scale))
+        self._reference = None
+        self._thresholds = create_threshold_table(depth_scale, detection)
+        self._world_points = np.zeros((shape[0] * shape[1], 3), dtype=np.float32)
+        self._valid = np.zeros(shape[0] * shape[1], dtype=bool)
+        self._points = None
+        # Row major pixel indices of each tile, so the pixels of the changed tiles can be gathered without a full mask
+        pixels = np.arange(shape[0] * shape[1]).reshape(shape)
+        size = detection.tile_size
+        self._tile_pixels = [pixels[row:row + size, column:column + size].reshape(-1)
+                             for row in tile_starts(shape[0], size) for column in tile_starts(shape[1], size)]
+        self._tile_shape = (len(tile_starts(shape[0], size)), len(tile_starts(shape[1], size)))
+
+    @property
+    def points(self) -> np.ndarray:
+        """Returns the (N, 3) float32 world points of all valid pixels within the depth range and the crop volume"""
+        if self._points is None:
+            self._points = self._world_points[self._valid]
+        return self._points
+
+    def changed_points(self, changes: FrameChanges) -> np.ndarray:
+        """Returns the current world points of the valid pixels within the changed tiles"""
+        return self._world_points[changes.pixels[self._valid[changes.pixels]]]
+
+    def update(self, depth_image: np.ndarray) -> FrameChanges:
+        """Compares a z16 depth image with the processed depth values and updates the world points of the changed
+        tiles. Returns the changed tiles and pixels"""
+        if depth_image.shape != self.shape:
+            raise ValueError(f'Depth image of shape {depth_image.shape} does not match {self.shape}.')
+        if self._reference is None:
+            self._reference = np.zeros(self.shape, dtype=np.uint16)
+            tiles = np.ones(self._tile_shape, dtype=bool)
+        else:
+            tiles = detect_changes(depth_image, self._reference, self._thresholds, self.detection)
+        changed = np.flatnonzero(tiles)
+        if changed.shape[0] == 0:
+            return FrameChanges(tiles, np.zeros(0, dtype=np.int64))
+        pixels = np.concatenate([self._tile_pixels[tile] for tile in changed])
+        depth_values = depth_image.reshape(-1)[pixels]
+        self._reference.reshape(-1)[pixels] = depth_values
+        points = np.take(self.table.rays, pixels, axis=0)
+        points *= depth_values[:, np.newaxis]
+        points += self.table.origin
+        valid = (depth_values >= self._near) & (depth_values <= self._far)
+        if self.crop_volume is not None:
+            valid &= self.crop_volume.contains(points)
+        self._world_points[pixels] = points
+        self._valid[pixels] = valid
+        self._points = None
+        return FrameChanges(tiles, pixels)
@@ -0,0 +1,269 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Callable, ContextManager, Dict, List, Tuple
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Upper bounds of the latency histogram buckets in s. The last bucket collects all slower observations
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.]
+METRIC_PREFIX = 'depth_camera_array'
+
+_NO_OP = contextlib.nullcontext()
+
+
+class LatencyHistogram:
+    def __init__(self, buckets: List[float] = None):
+        self.buckets = LATENCY_BUCKETS if buckets is None else buckets
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.min = float('inf')
+        self.max = 0.
+        self.first_time = None
+        self.last_time = None
+
+    def observe(self, seconds: float, now: float):
+        self.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket that contains the q quantile, limited to the maximum observation"""
+        if self.count == 0:
+            return 0.
+        rank = q * self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    @property
+    def frames_per_second(self) -> float:
+        if self.count < 2 or self.last_time == self.first_time:
+            return 0.
+        return (self.count - 1) / (self.last_time - self.first_time)
+
+
+class _Timer:
+    def __init__(self, instrumentation: 'Instrumentation', stage: str, camera_id: str):
+        self._instrumentation = instrumentation
+        self._stage = stage
+        self._camera_id = camera_id
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._instrumentation.observe(self._stage, self._camera_id, time.perf_counter() - self._start)
+
+
+class Instrumentation:
+    """Collects latency histograms and frame rates per stage and camera as well as counters like dropped frames or
+    written bytes.
+
+    If it is disabled, measure returns a shared no-op context manager and all other recording methods return
+    immediately. Collectors are functions that are called on each snapshot to update values that are counted elsewhere,
+    e.g. the statistics of a CameraArray. Snapshots can be exported as JSON or as Prometheus text file, on demand or
+    periodically by a background thread.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._counters: Dict[Tuple[str, str], float] = {}
+        self._peak_memory: Dict[Tuple[str, str], int] = {}
+        self._collectors: List[Callable[['Instrumentation'], None]] = []
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self._export_thread = None
+        self._stop_export = threading.Event()
+
+    def measure(self, stage: str, camera_id: str = '') -> ContextManager:
+        """Returns a context manager that records the runtime of its body as latency of the stage"""
+        if not self.enabled:
+            return _NO_OP
+        return _Timer(self, stage, camera_id)
+
+    def observe(self, stage: str, camera_id: str, seconds: float):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            histogram = self._histograms.get((stage, camera_id))
+            if histogram is None:
+                histogram = self._histograms[(stage, camera_id)] = LatencyHistogram()
+            histogram.observe(seconds, now)
+
+    def increment(self, counter: str, camera_id: str = '', value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[(counter, camera_id)] = self._counters.get((counter, camera_id), 0) + value
+
+    def set_counter(self, counter: str, camera_id: str, value: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[(counter, camera_id)] = value
+
+    def observe_memory(self, stage: str, camera_id: str, peak_bytes: int):
+        """Records the peak memory of a stage, only a larger value replaces the recorded one"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._peak_memory[(stage, camera_id)] = max(self._peak_memory.get((stage, camera_id), 0), peak_bytes)
+
+    def add_collector(self, collector: Callable[['Instrumentation'], None]):
+        if self.enabled:
+            with self._lock:
+                self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[['Instrumentation'], None]):
+        """Calls the collector a last time, so its final counters are kept, and stops calling it"""
+        with self._lock:
+            if collector not in self._collectors:
+                return
+            self._collectors.remove(collector)
+        collector(self)
+
+    def snapshot(self) -> dict:
+        """Returns all metrics. Latencies are given in ms and frame ages in s since the last observation"""
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            collector(self)
+        now = time.monotonic()
+        with self._lock:
+            stages = [{
+                'stage': stage,
+                'camera': camera_id,
+                'frames': histogram.count,
+                'fps': histogram.frames_per_second,
+                'mean_ms': histogram.sum / histogram.count * 1000.,
+                'min_ms': histogram.min * 1000.,
+                'max_ms': histogram.max * 1000.,
+                'p50_ms': histogram.quantile(0.5) * 1000.,
+                'p99_ms': histogram.quantile(0.99) * 1000.,
+                'last_frame_age_s': now - histogram.last_time,
+                'buckets_ms': [bound * 1000. for bound in histogram.buckets],
+                'bucket_counts': list(histogram.bucket_counts)
+            } for (stage, camera_id), histogram in self._histograms.items()]
+            counters = [{'counter': counter, 'camera': camera_id, 'value': value}
+                        for (counter, camera_id), value in self._counters.items()]
+            stage_memory = [{'stage': stage, 'camera': camera_id, 'peak_bytes': peak_bytes}
+                            for (stage, camera_id), peak_bytes in self._peak_memory.items()]
+        return {
+            'uptime_s': now - self._start_time,
+            'peak_memory_bytes': peak_memory_bytes(),
+            'stages': stages,
+            'stage_memory': stage_memory,
+            'counters': counters
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = [
+            f'# TYPE {METRIC_PREFIX}_uptime_seconds gauge',
+            f'{METRIC_PREFIX}_uptime_seconds {snapshot["uptime_s"]}',
+            f'# TYPE {METRIC_PREFIX}_peak_memory_bytes gauge',
+            f'{METRIC_PREFIX}_peak_memory_bytes {snapshot["peak_memory_bytes"]}',
+            f'# TYPE {METRIC_PREFIX}_stage_latency_seconds histogram'
+        ]
+        for stage in snapshot['stages']:
+            labels = f'stage="{stage["stage"]}",camera="{stage["camera"]}"'
+            cumulative = 0
+            for bound, bucket_count in zip(stage['buckets_ms'] + [float('inf')], stage['bucket_counts']):
+                cumulative += bucket_count
+                bound = '+Inf' if bound == float('inf') else repr(round(bound / 1000., 9))
+                lines.append(f'{METRIC_PREFIX}_stage_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            latency_sum = stage['mean_ms'] * stage['frames'] / 1000.
+            lines.append(f'{METRIC_PREFIX}_stage_latency_seconds_sum{{{labels}}} {latency_sum}')
+            lines.append(f'{METRIC_PREFIX}_stage_latency_seconds_count{{{labels}}} {stage["frames"]}')
+        for name, key in [('stage_fps', 'fps'), ('stage_last_frame_age_seconds', 'last_frame_age_s')]:
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} gauge')
+            lines += [f'{METRIC_PREFIX}_{name}{{stage="{stage["stage"]}",camera="{stage["camera"]}"}} {stage[key]}'
+                      for stage in snapshot['stages']]
+        if snapshot['stage_memory']:
+            lines.append(f'# TYPE {METRIC_PREFIX}_stage_peak_memory_bytes gauge')
+            lines += [f'{METRIC_PREFIX}_stage_peak_memory_bytes{{stage="{item["stage"]}",camera="{item["camera"]}"}} '
+                      f'{item["peak_bytes"]}' for item in snapshot['stage_memory']]
+        for counter in sorted({counter['counter'] for counter in snapshot['counters']}):
+            lines.append(f'# TYPE {METRIC_PREFIX}_{counter}_total counter')
+            lines += [f'{METRIC_PREFIX}_{counter}_total{{camera="{item["camera"]}"}} {item["value"]}'
+                      for item in snapshot['counters'] if item['counter'] == counter]
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str):
+        """Writes the metrics as JSON if the path ends with .json, otherwise as Prometheus text. The file is replaced
+        atomically, so readers never see a partially written file"""
+        if not self.enabled:
+            return
+        content = self.to_json() if path.endswith('.json') else self.to_prometheus()
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write(content)
+        os.replace(temporary_path, path)
+
+    def start_periodic_export(self, path: str, interval: float):
+        if not self.enabled or self._export_thread is not None:
+            return
+        self._stop_export.clear()
+
+        def run():
+            while not self._stop_export.wait(interval):
+                self.export(path)
+
+        self._export_thread = threading.Thread(target=run, name='metrics-export', daemon=True)
+        self._export_thread.start()
+
+    def stop_periodic_export(self):
+        if self._export_thread is not None:
+            self._stop_export.set()
+            self._export_thread.join()
+            self._export_thread = None
+
+
+DISABLED = Instrumentation(enabled=False)
+
+
+def peak_memory_bytes() -> int:
+    """Returns the peak resident memory of the process, or 0 if it is not available on this platform"""
+    if resource is None:
+        return 0
+    # ru_maxrss is given in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def create_instrumentation(metrics_path: str = None, metrics_interval: float = 0.) -> Instrumentation:
+    """Returns an enabled instrumentation that exports periodically if metrics_path and metrics_interval are set, or
+    DISABLED if no metrics_path is given"""
+    if metrics_path is None:
+        return DISABLED
+    instrumentation = Instrumentation()
+    if metrics_interval > 0:
+        instrumentation.start_periodic_export(metrics_path, metrics_interval)
+    return instrumentation
+
+
+def finish_instrumentation(instrumentation: Instrumentation, metrics_path: str = None):
+    instrumentation.stop_periodic_export()
+    if metrics_path is not None:
+        instrumentation.export(metrics_path)
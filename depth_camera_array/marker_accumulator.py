@@ -0,0 +1,120 @@
+import copy
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+class AccumulatedMarkers(NamedTuple):
+    aruco_ids: List[int]
+    centers: np.ndarray
+    corners: np.ndarray
+    spread: np.ndarray
+    counts: np.ndarray
+    rejected: np.ndarray
+
+
+class _MarkerState:
+    """Running mean and sum of squared deviations of the center and corners of one marker"""
+
+    def __init__(self):
+        self.count = 0
+        self.rejected = 0
+        self.mean = np.zeros(3)
+        self.m2 = np.zeros(3)
+        self.corner_count = 0
+        self.corner_mean = np.full((4, 3), np.nan)
+        # The first samples are kept until they can be checked against their median
+        self.pending: List[Tuple[np.ndarray, Optional[np.ndarray]]] = []
+        self.seeded = False
+
+    def add(self, center: np.ndarray, corners: Optional[np.ndarray]):
+        self.count += 1
+        delta = center - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (center - self.mean)
+        if corners is not None and np.all(np.isfinite(corners)):
+            self.corner_count += 1
+            if self.corner_count == 1:
+                self.corner_mean = corners.astype(float)
+            else:
+                self.corner_mean += (corners - self.corner_mean) / self.corner_count
+
+    @property
+    def variance(self) -> np.ndarray:
+        return self.m2 / self.count if self.count > 0 else np.zeros(3)
+
+
+class MarkerAccumulator:
+    """Merges the 3D marker centers and corners of many frames of one camera with a memory cost that depends on the
+    number of markers only.
+
+    The mean and variance of each marker are updated online by Welford's algorithm. The first min_samples centers of a
+    marker are kept until they can be compared with their median, and those farther from it than outlier_threshold
+    times their median absolute deviation, scaled to a standard deviation, and min_deviation in m are rejected. So an
+    outlier among them inflates neither the mean nor the variance. Afterwards, a new center is rejected as outlier if
+    its distance to the mean exceeds outlier_threshold standard deviations and min_deviation, e.g. if the depth of the
+    marker center was invalid or belongs to the background.
+    """
+
+    def __init__(self, outlier_threshold: float = 3., min_deviation: float = 0.005, min_samples: int = 5):
+        self.outlier_threshold = outlier_threshold
+        self.min_deviation = min_deviation
+        self.min_samples = min_samples
+        self._markers: Dict[int, _MarkerState] = {}
+
+    def add(self, aruco_ids: List[int], centers: np.ndarray, corners: np.ndarray = None):
+        """Adds the (N, 3) centers and optionally (N, 4, 3) corners of the markers detected in one frame. Markers with
+        NaN centers are skipped"""
+        centers = np.asarray(centers, dtype=float).reshape(-1, 3)
+        if corners is not None:
+            corners = np.asarray(corners, dtype=float).reshape(-1, 4, 3)
+        for index, aruco_id in enumerate(aruco_ids):
+            center = centers[index]
+            if not np.all(np.isfinite(center)):
+                continue
+            state = self._markers.setdefault(int(aruco_id), _MarkerState())
+            marker_corners = None if corners is None else corners[index]
+            if not state.seeded:
+                state.pending.append((center, marker_corners))
+                if len(state.pending) >= self.min_samples:
+                    self._seed(state)
+                continue
+            distance = np.linalg.norm(center - state.mean)
+            if distance > max(self.outlier_threshold * np.sqrt(state.variance.sum()), self.min_deviation):
+                state.rejected += 1
+                continue
+            state.add(center, marker_corners)
+
+    def _seed(self, state: _MarkerState):
+        centers = np.array([center for center, _ in state.pending])
+        distances = np.linalg.norm(centers - np.median(centers, axis=0), axis=1)
+        # 1.4826 scales the median absolute deviation of normally distributed samples to their standard deviation
+        limit = max(self.outlier_threshold * 1.4826 * np.median(distances), self.min_deviation)
+        for (center, corners), distance in zip(state.pending, distances):
+            if distance > limit:
+                state.rejected += 1
+            else:
+                state.add(center, corners)
+        state.pending = []
+        state.seeded = True
+
+    def result(self) -> AccumulatedMarkers:
+        """Returns the mean center and corners, the standard deviation of the center per axis, the number of used and
+        the number of rejected samples of each marker sorted by id"""
+        aruco_ids = sorted(self._markers)
+        states = []
+        for aruco_id in aruco_ids:
+            state = self._markers[aruco_id]
+            if not state.seeded:
+                # Markers seen less than min_samples times are checked against the median of the samples so far
+                state = copy.deepcopy(state)
+                self._seed(state)
+            states.append(state)
+        return AccumulatedMarkers(
+            aruco_ids=aruco_ids,
+            centers=np.array([state.mean for state in states]).reshape(-1, 3),
+            corners=np.array([state.corner_mean for state in states]).reshape(-1, 4, 3),
+            spread=np.sqrt(np.array([state.variance for state in states]).reshape(-1, 3)),
+            counts=np.array([state.count for state in states], dtype=np.int64),
+            rejected=np.array([state.rejected for state in states], dtype=np.int64)
+        )
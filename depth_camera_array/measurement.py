@@ -0,0 +1,266 @@
+import os
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from pyrealsense2 import pyrealsense2 as rs
+
+from depth_camera_array.analytics import PointCloudIndex, summarize
+from depth_camera_array.buffer_pool import BufferPool
+from depth_camera_array.camera import Camera
+from depth_camera_array.crop_volumes import CropVolume, transform_and_crop
+from depth_camera_array.deprojection import depth_frame_to_depth_image
+from depth_camera_array.fusion import fuse_point_clouds, CENTROID
+from depth_camera_array.incremental import ChangeDetection, IncrementalDeprojector
+from depth_camera_array.instrumentation import Instrumentation, DISABLED
+from depth_camera_array.pipeline import Stage, map_stage, BLOCK
+from depth_camera_array.point_cloud_io import PointCloudContainerWriter, load_npy, load_ply, write_json, write_npy, \
+    write_ply
+from depth_camera_array.rig import CompiledRig, WorldRayTable, deproject_to_world
+from depth_camera_array.utilities import dump_dict_as_json
+
+OUTPUT_FORMATS = ['npy', 'ply', 'container', 'json']
+FUSED_POINT_CLOUD_ID = 'fused'
+CAMERA_ORIGIN = np.zeros(3, dtype=np.float32)
+
+
+class Measurement(NamedTuple):
+    frame_number: int
+    timestamp: float
+    points: Dict[str, np.ndarray]
+    attributes: Optional[Dict[str, np.ndarray]] = None
+    summary: Optional[dict] = None
+
+
+class MeasurementWriter:
+    """Writes the point clouds of measurements in each of the given output formats. In stream mode, the frame number is
+    appended to the file names"""
+
+    def __init__(self, data_dir: str, output_formats: List[str], stream: bool = False,
+                 instrumentation: Instrumentation = DISABLED):
+        self.data_dir = data_dir
+        self.output_formats = output_formats
+        self.stream = stream
+        self.instrumentation = instrumentation
+        self._container = None
+        if 'container' in output_formats:
+            self._container = PointCloudContainerWriter(os.path.join(data_dir, 'measurement.dcapc'))
+
+    def __enter__(self) -> 'MeasurementWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __call__(self, measurement: Measurement):
+        for device_id, points in measurement.points.items():
+            with self.instrumentation.measure('output', device_id):
+                bytes_written = self._write(measurement, device_id, points)
+            self.instrumentation.increment('bytes_written', device_id, bytes_written)
+        for key, values in (measurement.attributes or {}).items():
+            name = f'{key}_{measurement.frame_number:06d}' if self.stream else key
+            np.save(os.path.join(self.data_dir, f'{name}.npy'), values)
+        if measurement.summary is not None:
+            name = f'analytics_{measurement.frame_number:06d}' if self.stream else 'analytics'
+            dump_dict_as_json(measurement.summary, os.path.join(self.data_dir, f'{name}.json'))
+
+    def _write(self, measurement: Measurement, device_id: str, points: np.ndarray) -> int:
+        name = f'{device_id}_{measurement.frame_number:06d}' if self.stream else device_id
+        paths = []
+        if 'npy' in self.output_formats:
+            paths.append(os.path.join(self.data_dir, f'{name}.npy'))
+            write_npy(points, paths[-1])
+        if 'ply' in self.output_formats:
+            paths.append(os.path.join(self.data_dir, f'{name}.ply'))
+            write_ply(points, paths[-1])
+        if 'json' in self.output_formats:
+            paths.append(os.path.join(self.data_dir, f'{name}_object_points.json'))
+            write_json(points, paths[-1], device_id)
+        bytes_written = 0
+        if self._container is not None:
+            bytes_written = self._container.write(measurement.frame_number, device_id, points, measurement.timestamp)
+        if self.instrumentation.enabled:
+            bytes_written += sum(os.path.getsize(path) for path in paths)
+        return bytes_written
+
+    def close(self):
+        if self._container is not None:
+            self._container.close()
+
+
+def create_fusion(voxel_size: float, reduction: str = CENTROID, statistics: bool = False,
+                  memory_limit: Optional[int] = None,
+                  instrumentation: Instrumentation = DISABLED) -> Callable[[Measurement], Measurement]:
+    """Returns a function that fuses the point clouds of a measurement into one with voxels of voxel_size m. With
+    statistics, the point counts and camera masks of the voxels are added as attributes. memory_limit is given in
+    bytes"""
+
+    def fuse(measurement: Measurement) -> Measurement:
+        with instrumentation.measure('fuse'):
+            fused = fuse_point_clouds(measurement.points, voxel_size, reduction, statistics, memory_limit)
+        attributes = measurement.attributes
+        if statistics:
+            attributes = {
+                **(attributes or {}),
+                f'{FUSED_POINT_CLOUD_ID}_counts': fused.counts,
+                f'{FUSED_POINT_CLOUD_ID}_camera_masks': fused.camera_masks,
+                f'{FUSED_POINT_CLOUD_ID}_camera_ids': np.array(fused.camera_ids)
+            }
+        return measurement._replace(points={FUSED_POINT_CLOUD_ID: fused.points}, attributes=attributes)
+
+    return fuse
+
+
+def create_analytics(voxel_size: float, bottom: float, section_heights: Sequence[float] = (),
+                     reference: Optional[str] = None,
+                     instrumentation: Instrumentation = DISABLED) -> Callable[[Measurement], Measurement]:
+    """Returns a function that adds the analytics summary of all point clouds of a measurement. The index of the
+    reference capture, a ply or npy file, is built once and reused for all measurements"""
+    reference_index = None
+    if reference is not None:
+        load = load_ply if reference.endswith('.ply') else load_npy
+        reference_index = PointCloudIndex(load(reference), voxel_size)
+
+    def analyze(measurement: Measurement) -> Measurement:
+        with instrumentation.measure('analyze'):
+            points = list(measurement.points.values())
+            index = PointCloudIndex(np.concatenate(points) if points else np.zeros((0, 3)), voxel_size)
+            summary = summarize(index, bottom, section_heights, reference_index)
+        return measurement._replace(summary=summary)
+
+    return analyze
+
+
+def deproject_frame_set(cameras: Dict[str, Camera], frame_set: Dict[str, rs.composite_frame],
+                        instrumentation: Instrumentation = DISABLED, rig: CompiledRig = None,
+                        pool: BufferPool = None) -> Dict[str, np.ndarray]:
+    """Returns the object points of each camera, in world coordinates if a compiled rig is given, otherwise in camera
+    coordinates. If a buffer pool is given, the points are checked out from it"""
+    points = {}
+    for device_id, frames in frame_set.items():
+        with instrumentation.measure('deproject', device_id):
+            if rig is None and pool is None:
+                points[device_id] = cameras[device_id].depth_frame_to_object_points(frames, remove_zero_depth=True)
+            elif rig is None:
+                # With the origin of the rays at the camera, the points are calculated in camera coordinates
+                depth_frame = frames.get_depth_frame()
+                table = WorldRayTable(cameras[device_id].get_ray_table(depth_frame), CAMERA_ORIGIN)
+                points[device_id] = deproject_to_world(depth_frame_to_depth_image(depth_frame), table, True, pool,
+                                                       device_id)
+            else:
+                points[device_id] = rig.deproject(device_id, frames.get_depth_frame(), cameras[device_id].depth_scale,
+                                                  pool=pool)
+    return points
+
+
+def crop_into_pool(points: np.ndarray, crop_volume: CropVolume, pool: BufferPool, device_id: str) -> np.ndarray:
+    """Copies the points inside the crop volume into a buffer checked out from the pool and checks in the given
+    points, if they were checked out from it. The buffer can hold as many points as the buffer of the given points, so
+    it is reused for every frame"""
+    inside = crop_volume.contains(points)
+    cropped = np.compress(inside, points, axis=0,
+                          out=pool.checkout('transform_and_crop', device_id, 'points',
+                                            (int(np.count_nonzero(inside)), 3), np.float32, pool.capacity(points)))
+    pool.checkin(points)
+    return cropped
+
+
+def transform_and_crop_point_clouds(point_clouds: Dict[str, np.ndarray], extrinsics: Optional[Dict[str, np.ndarray]],
+                                    crop_volume: CropVolume, instrumentation: Instrumentation = DISABLED,
+                                    pool: BufferPool = None) -> Dict[str, np.ndarray]:
+    """Transforms the point clouds to world coordinates and crops them. If extrinsics is None, the points are already
+    given in world coordinates and are only cropped. If a buffer pool is given, the cropped points and the transformed
+    points are checked out from it, and the given points are checked in"""
+    points = {}
+    for device_id, object_points in point_clouds.items():
+        with instrumentation.measure('transform_and_crop', device_id):
+            if pool is not None:
+                if extrinsics is not None:
+                    extrinsic = np.asarray(extrinsics[device_id], dtype=np.float32)
+                    transformed = np.matmul(object_points, extrinsic[:3, :3].T, out=pool.checkout(
+                        'transform_and_crop', device_id, 'transformed', object_points.shape, np.float32,
+                        pool.capacity(object_points)))
+                    transformed += extrinsic[:3, 3]
+                    pool.checkin(object_points)
+                    object_points = transformed
+                points[device_id] = crop_into_pool(object_points, crop_volume, pool, device_id)
+            elif extrinsics is None:
+                points[device_id] = object_points[crop_volume.contains(object_points)]
+            else:
+                points[device_id] = transform_and_crop(object_points, extrinsics[device_id], crop_volume)
+    return points
+
+
+def release_points(pool: Optional[BufferPool], point_clouds: Iterable[np.ndarray],
+                   kept: Iterable[np.ndarray] = ()):
+    """Checks in the point clouds of a processed measurement, except those that are kept by a later one"""
+    if pool is not None:
+        kept = {id(points) for points in kept}
+        pool.checkin_all(points for points in point_clouds if id(points) not in kept)
+
+
+def create_measurement_stages(cameras: List[Camera], extrinsics: Dict[str, np.ndarray],
+                              crop_volume: CropVolume, buffer_size: int = 2, policy: str = BLOCK,
+                              fuse: Callable[[Measurement], Measurement] = None,
+                              instrumentation: Instrumentation = DISABLED, rig: CompiledRig = None,
+                              change_detection: ChangeDetection = None,
+                              analyze: Callable[[Measurement], Measurement] = None,
+                              pool: BufferPool = None) -> List[Stage]:
+    """Creates the stages that turn frame sets into cropped point clouds in world coordinates. With a compiled rig,
+    the world points are calculated directly by the deproject stage and the next stage only crops them. With change
+    detection, the deproject stage updates only the changed tiles of persistent cropped point clouds of the cameras,
+    which requires a compiled rig, and adds the masks of the changed tiles as attributes.
+
+    If a buffer pool is given, the point clouds are processed in buffers checked out from it. The stages check in the
+    buffers they replace, the consumer of the measurements checks in the remaining ones by release_points once it is
+    done with them."""
+    cameras = {cam.device_id: cam for cam in cameras}
+    deprojectors = {}
+
+    def deproject_changes(frame_set: Dict[str, rs.composite_frame]) \
+            -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        points, attributes = {}, {}
+        for device_id, frames in frame_set.items():
+            with instrumentation.measure('deproject', device_id):
+                depth_frame = frames.get_depth_frame()
+                depth_image = depth_frame_to_depth_image(depth_frame)
+                if device_id not in deprojectors:
+                    intrinsics = depth_frame.get_profile().as_video_stream_profile().get_intrinsics()
+                    depth_scale = cameras[device_id].depth_scale
+                    deprojectors[device_id] = IncrementalDeprojector(
+                        rig.get_table(device_id, intrinsics, depth_scale), depth_image.shape, depth_scale,
+                        crop_volume, change_detection, rig.depth_range)
+                changes = deprojectors[device_id].update(depth_image)
+                points[device_id] = deprojectors[device_id].points
+                attributes[f'{device_id}_changed_tiles'] = changes.tiles
+                instrumentation.increment('changed_tiles', device_id, int(np.count_nonzero(changes.tiles)))
+        return points, attributes
+
+    def deproject(items: Iterator[Dict[str, rs.composite_frame]]) -> Iterator[Measurement]:
+        for frame_number, frame_set in enumerate(items):
+            timestamp = min(frames.get_timestamp() for frames in frame_set.values())
+            if change_detection is not None:
+                points, attributes = deproject_changes(frame_set)
+                yield Measurement(frame_number, timestamp, points, attributes)
+            else:
+                yield Measurement(frame_number, timestamp,
+                                  deproject_frame_set(cameras, frame_set, instrumentation, rig, pool))
+
+    def transform(measurement: Measurement) -> Measurement:
+        return measurement._replace(
+            points=transform_and_crop_point_clouds(measurement.points, None if rig is not None else extrinsics,
+                                                   crop_volume, instrumentation, pool))
+
+    def fuse_and_release(measurement: Measurement) -> Measurement:
+        fused = fuse(measurement)
+        release_points(pool, measurement.points.values(), fused.points.values())
+        return fused
+
+    stages = [Stage('deproject', deproject, buffer_size, policy)]
+    # The points of the incremental deprojection are cropped already
+    if change_detection is None:
+        stages.append(map_stage('transform_and_crop', transform, buffer_size, policy))
+    if fuse is not None:
+        stages.append(map_stage('fuse', fuse_and_release, buffer_size, policy))
+    if analyze is not None:
+        stages.append(map_stage('analyze', analyze, buffer_size, policy))
+    return stages
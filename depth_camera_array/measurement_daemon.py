@@ -0,0 +1,395 @@
+import asyncio
+import collections
+import itertools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from depth_camera_array.camera import Camera
+from depth_camera_array.camera_array import CameraArray
+from depth_camera_array.crop_volumes import CropVolume
+from depth_camera_array.instrumentation import Instrumentation, DISABLED
+from depth_camera_array.measurement import OUTPUT_FORMATS, Measurement, MeasurementWriter, deproject_frame_set, \
+    transform_and_crop_point_clouds
+from depth_camera_array.rig import CompiledRig
+
+# Request types
+SNAPSHOT = 'snapshot'
+BURST = 'burst'
+SUBSCRIBE = 'subscribe'
+CANCEL = 'cancel'
+STATUS = 'status'
+MEASUREMENT_REQUESTS = [SNAPSHOT, BURST, SUBSCRIBE]
+
+# Response types. Each job ends with a done, cancelled or error response
+MEASUREMENT = 'measurement'
+DONE = 'done'
+CANCELLED = 'cancelled'
+ERROR = 'error'
+
+# Number of measurement responses buffered for a slow subscriber before the oldest ones are skipped
+SUBSCRIPTION_BUFFER_SIZE = 8
+
+
+class MeasurementJob:
+    """A measurement request of a client. Its responses are put into the results queue until frame_count measurements
+    were delivered, it was cancelled or it failed. A subscription has no frame count"""
+
+    def __init__(self, job_id: int, request_id, kind: str, frame_count: Optional[int], fuse: bool,
+                 writer: Optional[MeasurementWriter], deadline: Optional[float], analyze: bool = False):
+        self.job_id = job_id
+        self.request_id = request_id
+        self.kind = kind
+        self.frame_count = frame_count
+        self.fuse = fuse
+        self.analyze = analyze
+        self.writer = writer
+        self.deadline = deadline
+        self.delivered = 0
+        self.skipped = 0
+        self.finished = False
+        self.results = asyncio.Queue()
+
+    @property
+    def output_dir(self) -> Optional[str]:
+        return None if self.writer is None else self.writer.data_dir
+
+    def put(self, message: dict):
+        if self.frame_count is None and message['type'] == MEASUREMENT \
+                and self.results.qsize() >= SUBSCRIPTION_BUFFER_SIZE:
+            self.results.get_nowait()
+            self.skipped += 1
+        self.results.put_nowait({'id': self.request_id, **message})
+
+    def finish(self, message: dict):
+        self.finished = True
+        self.put({**message, 'frame_count': self.delivered})
+
+
+class MeasurementService:
+    """Keeps the cameras and the compiled rig of the array warm and serves measurement requests of several clients.
+
+    The cameras are polled continuously by a CameraArray. While jobs are active, one frame set after another is
+    measured and every measurement is delivered to all active jobs, so concurrent clients share the frames instead of
+    waiting for each other. At most max_active_jobs jobs are served at the same time, further jobs are queued in order
+    of arrival and rejected if max_queued_jobs jobs are waiting already. A job is cancelled if its timeout passed, which
+    includes the time it was queued. Measuring and writing runs in one executor thread, so the event loop stays
+    responsive.
+    """
+
+    def __init__(self, cameras: List[Camera], extrinsics: Dict[str, np.ndarray], crop_volume: CropVolume,
+                 data_dir: str, output_formats: List[str], rig: CompiledRig = None,
+                 fuse: Callable[[Measurement], Measurement] = None, fuse_by_default: bool = False,
+                 analyze: Callable[[Measurement], Measurement] = None, analyze_by_default: bool = False,
+                 sync_tolerance: float = 15., max_active_jobs: int = 8, max_queued_jobs: int = 64,
+                 instrumentation: Instrumentation = DISABLED):
+        self.cameras = {cam.device_id: cam for cam in cameras}
+        self.extrinsics = extrinsics
+        self.crop_volume = crop_volume
+        self.data_dir = data_dir
+        self.output_formats = output_formats
+        self.rig = rig
+        self.fuse = fuse
+        self.fuse_by_default = fuse_by_default
+        self.analyze = analyze
+        self.analyze_by_default = analyze_by_default
+        self.max_active_jobs = max_active_jobs
+        self.max_queued_jobs = max_queued_jobs
+        self.instrumentation = instrumentation
+        self.camera_array = CameraArray(cameras, tolerance=sync_tolerance, instrumentation=instrumentation)
+        self.measured_frames = 0
+        self.timed_out_jobs = 0
+        self._active: List[MeasurementJob] = []
+        self._queued: Deque[MeasurementJob] = collections.deque()
+        self._job_ids = itertools.count()
+        self._executor = None
+        self._wakeup = None
+
+    def submit(self, request: dict) -> MeasurementJob:
+        """Creates and queues the job of a snapshot, burst or subscribe request. Raises a ValueError if the request is
+        invalid and a RuntimeError if too many jobs are queued"""
+        kind = request.get('type')
+        if kind not in MEASUREMENT_REQUESTS:
+            raise ValueError(f'Unknown request type {kind}. Use one of {MEASUREMENT_REQUESTS + [CANCEL, STATUS]}.')
+        frame_count = 1 if kind == SNAPSHOT else request.get('frame_count')
+        if kind == BURST and frame_count is None:
+            raise ValueError('A burst needs a positive frame_count.')
+        # bool is an int as well
+        if frame_count is not None and (not isinstance(frame_count, int) or isinstance(frame_count, bool)
+                                        or frame_count < 1):
+            raise ValueError(f'The frame_count has to be a positive integer, not {frame_count!r}.')
+        fuse = bool(request.get('fuse', self.fuse_by_default))
+        if fuse and self.fuse is None:
+            raise ValueError('Fusion is not available.')
+        analyze = bool(request.get('analytics', self.analyze_by_default))
+        if analyze and self.analyze is None:
+            raise ValueError('Analytics are not available.')
+        output_formats = request.get('output_formats', self.output_formats)
+        if not set(output_formats) <= set(OUTPUT_FORMATS):
+            raise ValueError(f'Unknown output formats {output_formats}. Use some of {OUTPUT_FORMATS}.')
+        if len(self._queued) >= self.max_queued_jobs:
+            raise RuntimeError(f'{len(self._queued)} jobs are queued already.')
+        job_id = next(self._job_ids)
+        writer = None
+        if output_formats:
+            output_dir = os.path.join(self.data_dir, 'jobs', f'{job_id:06d}')
+            os.makedirs(output_dir, exist_ok=True)
+            writer = MeasurementWriter(output_dir, output_formats, stream=kind != SNAPSHOT)
+        timeout = request.get('timeout')
+        deadline = None if timeout is None else asyncio.get_running_loop().time() + float(timeout)
+        job = MeasurementJob(job_id, request.get('id'), kind, frame_count, fuse, writer, deadline, analyze)
+        self._queued.append(job)
+        self._wakeup.set()
+        return job
+
+    def cancel(self, job: MeasurementJob, reason: str = 'cancelled'):
+        """Stops delivering measurements to the job. Its writer is closed after the measurement in progress"""
+        if job.finished:
+            return
+        if job in self._queued:
+            self._queued.remove(job)
+        if job in self._active:
+            self._active.remove(job)
+        if reason == 'timeout':
+            self.timed_out_jobs += 1
+        job.finish({'type': CANCELLED, 'reason': reason})
+        self._close_writer(job)
+
+    def get_status(self) -> dict:
+        return {
+            'type': STATUS,
+            'cameras': sorted(self.cameras),
+            'active_jobs': len(self._active),
+            'queued_jobs': len(self._queued),
+            'measured_frames': self.measured_frames,
+            'timed_out_jobs': self.timed_out_jobs,
+            'camera_statistics': self.camera_array.get_statistics()
+        }
+
+    def _close_writer(self, job: MeasurementJob):
+        # Closing runs in the executor as well, so it cannot interfere with a write in progress
+        if job.writer is not None:
+            self._executor.submit(job.writer.close)
+
+    def _fail(self, job: MeasurementJob, error: Exception):
+        if job in self._active:
+            self._active.remove(job)
+        job.finish({'type': ERROR, 'error': f'{type(error).__name__}: {error}'})
+        self._close_writer(job)
+
+    def _deliver(self, job: MeasurementJob, message: dict):
+        job.put(message)
+        job.delivered += 1
+        if job.frame_count is not None and job.delivered >= job.frame_count:
+            self._active.remove(job)
+            job.finish({'type': DONE, 'skipped': job.skipped})
+            self._close_writer(job)
+
+    def _measure(self, clear: bool) -> Measurement:
+        if clear:
+            # Queued frames were captured before the jobs were submitted
+            self.camera_array.clear()
+        frame_set = self.camera_array.wait_for_frames()
+        points = deproject_frame_set(self.cameras, frame_set, self.instrumentation, self.rig)
+        return Measurement(
+            frame_number=self.measured_frames,
+            timestamp=min(frames.get_timestamp() for frames in frame_set.values()),
+            points=transform_and_crop_point_clouds(points, None if self.rig is not None else self.extrinsics,
+                                                   self.crop_volume, self.instrumentation)
+        )
+
+    def _write(self, jobs: List[MeasurementJob], measurement: Measurement,
+               fused: Optional[Measurement]) -> List[Tuple[MeasurementJob, dict]]:
+        messages = []
+        # The summaries of the raw and the fused measurement are calculated at most once for all jobs
+        analyzed = {}
+        for job in jobs:
+            # The writer of a job that was cancelled meanwhile may be closed already
+            if job.finished:
+                continue
+            result = fused if job.fuse else measurement
+            if job.analyze:
+                if job.fuse not in analyzed:
+                    analyzed[job.fuse] = self.analyze(result)
+                result = analyzed[job.fuse]
+            result = result._replace(frame_number=job.delivered)
+            if job.writer is not None:
+                job.writer(result)
+            message = {
+                'type': MEASUREMENT,
+                'frame_number': result.frame_number,
+                'timestamp': result.timestamp,
+                'point_counts': {device_id: len(points) for device_id, points in result.points.items()},
+                'output_dir': job.output_dir
+            }
+            if result.summary is not None:
+                message['summary'] = result.summary
+            messages.append((job, message))
+        return messages
+
+    async def run(self):
+        """Measures frame sets as long as jobs are active"""
+        loop = asyncio.get_running_loop()
+        idle = True
+        while True:
+            while self._queued and len(self._active) < self.max_active_jobs:
+                self._active.append(self._queued.popleft())
+            if not self._active:
+                idle = True
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            jobs = list(self._active)
+            try:
+                measurement = await loop.run_in_executor(self._executor, self._measure, idle)
+                fused = None
+                if any(job.fuse for job in jobs):
+                    fused = await loop.run_in_executor(self._executor, self.fuse, measurement)
+                messages = await loop.run_in_executor(self._executor, self._write, jobs, measurement, fused)
+            except Exception as error:
+                # E.g. the end of a replayed recording or a camera that stopped delivering frames
+                for job in jobs:
+                    if not job.finished:
+                        self._fail(job, error)
+                idle = True
+                continue
+            idle = False
+            self.measured_frames += 1
+            for job, message in messages:
+                # Jobs cancelled while their measurement was written are skipped
+                if job.finished:
+                    continue
+                try:
+                    self._deliver(job, message)
+                except Exception as error:
+                    # A failing job must not stop the measurements of the other jobs
+                    self._fail(job, error)
+
+    async def _serve_job(self, job: MeasurementJob, send: Callable):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Once the job finished, its remaining responses are sent regardless of the deadline
+            remaining = None if job.deadline is None or job.finished else max(job.deadline - loop.time(), 0.)
+            try:
+                message = await asyncio.wait_for(job.results.get(), remaining)
+            except asyncio.TimeoutError:
+                self.cancel(job, 'timeout')
+                continue
+            try:
+                await send(message)
+            except ConnectionError:
+                self.cancel(job, 'disconnected')
+                return
+            if message['type'] != MEASUREMENT:
+                return
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves the newline delimited JSON requests of one connection. Responses of concurrent jobs are interleaved
+        and carry the id of their request. The id of a job can only be used again once the job finished"""
+        lock = asyncio.Lock()
+        jobs: Dict[object, MeasurementJob] = {}
+        # All running jobs of the connection, including those without id, so they are cancelled on disconnect
+        running: List[MeasurementJob] = []
+        tasks = set()
+
+        async def send(message: dict):
+            async with lock:
+                writer.write(json.dumps(message).encode() + b'\n')
+                await writer.drain()
+
+        try:
+            async for line in reader:
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('A request has to be a JSON object.')
+                except ValueError as error:
+                    await send({'id': None, 'type': ERROR, 'error': str(error)})
+                    continue
+                if request.get('type') == STATUS:
+                    await send({'id': request.get('id'), **self.get_status()})
+                elif request.get('type') == CANCEL:
+                    job = jobs.get(request.get('id'))
+                    if job is None:
+                        await send({'id': request.get('id'), 'type': ERROR, 'error': 'Unknown job.'})
+                    else:
+                        self.cancel(job)
+                else:
+                    request_id = request.get('id')
+                    try:
+                        if isinstance(request_id, (list, dict)):
+                            raise ValueError('The id has to be a string or a number.')
+                        if request_id in jobs and not jobs[request_id].finished:
+                            raise ValueError(f'The id {request_id!r} is used by a running job.')
+                        job = self.submit(request)
+                    except (ValueError, RuntimeError) as error:
+                        await send({'id': request_id, 'type': ERROR, 'error': str(error)})
+                        continue
+                    if request_id is not None:
+                        jobs[request_id] = job
+                    running = [other for other in running if not other.finished] + [job]
+                    task = asyncio.create_task(self._serve_job(job, send))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        except ConnectionError:
+            pass
+        finally:
+            # The jobs of a client that disconnected are cancelled
+            for job in running:
+                self.cancel(job, 'disconnected')
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, socket_path: str, ready: Callable[[], None] = None):
+        """Starts the cameras and serves requests on a Unix socket until the task is cancelled"""
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='measurement')
+        self._wakeup = asyncio.Event()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.camera_array.start()
+        runner = asyncio.create_task(self.run())
+        server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+        try:
+            if ready is not None:
+                ready()
+            async with server:
+                await server.serve_forever()
+        finally:
+            runner.cancel()
+            for job in list(self._active) + list(self._queued):
+                self.cancel(job, 'shutdown')
+            self._executor.shutdown(wait=True)
+            self.camera_array.stop()
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+async def request_measurements(socket_path: str, request: dict) -> AsyncIterator[dict]:
+    """Sends one request to a measurement daemon and yields its responses until the last one"""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        async for line in reader:
+            message = json.loads(line)
+            yield message
+            if message['type'] != MEASUREMENT:
+                return
+    finally:
+        writer.close()
+
+
+def send_request(socket_path: str, request: dict) -> List[dict]:
+    """Blocking variant of request_measurements for scripts, returns all responses of a snapshot, burst or status
+    request"""
+
+    async def collect() -> List[dict]:
+        return [message async for message in request_measurements(socket_path, request)]
+
+    return asyncio.run(collect())
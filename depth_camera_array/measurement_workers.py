@@ -0,0 +1,263 @@
+import collections
+import multiprocessing
+import queue
+import time
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from depth_camera_array.buffer_pool import BufferPool
+from depth_camera_array.camera_array import pop_synchronized
+from depth_camera_array.crop_volumes import CropVolume
+from depth_camera_array.instrumentation import Instrumentation, DISABLED
+from depth_camera_array.measurement import Measurement, MeasurementWriter, crop_into_pool, release_points
+from depth_camera_array.pipeline import BLOCK
+from depth_camera_array.recording import intrinsics_from_dict
+from depth_camera_array.rig import CompiledRig
+from depth_camera_array.shared_frames import CaptureFinished, CaptureSource, FrameDescriptor, FrameRing, RingSpec, \
+    StreamInfo, capture_to_ring
+
+# Creates a function that is applied to each measurement. It is called in each worker process, since the functions it
+# creates are usually closures that cannot be sent to another process
+MeasurementFunctionFactory = Callable[[], Callable[[Measurement], Measurement]]
+
+
+class FrameSetTask(NamedTuple):
+    frame_number: int
+    descriptors: Dict[str, FrameDescriptor]
+
+
+class FrameSetResult(NamedTuple):
+    frame_number: int
+    overwritten: bool
+    seconds: float
+
+
+class WorkerFailed(NamedTuple):
+    """Sent by a worker process before it exits because processing a frame set failed"""
+    worker: str
+    error: str
+
+
+def process_frame_sets(tasks, results, ring_specs: Dict[str, RingSpec], stream_infos: Dict[str, StreamInfo],
+                       data_dir: str, output_formats: List[str], extrinsics: Dict[str, np.ndarray],
+                       crop_volume: CropVolume, rig_dir: str, rig_crop_volume: Optional[CropVolume],
+                       depth_range: Tuple[float, Optional[float]], create_fusion: MeasurementFunctionFactory = None,
+                       create_analytics: MeasurementFunctionFactory = None):
+    """Runs in a worker process. Deprojects, crops, fuses and writes the frame sets of the tasks queue until it gets
+    None. The depth images are read from the shared memory rings in place. A frame set is discarded if one of its
+    frames was overwritten during processing. The rig is opened with the crop volume and depth range of the rig of
+    the parent process, so the workers load its pixel masks instead of compiling them. If processing fails, the error
+    is sent to the results queue before the worker exits"""
+    rings = {device_id: FrameRing.attach(spec) for device_id, spec in ring_specs.items()}
+    try:
+        rig = CompiledRig(rig_dir, extrinsics, rig_crop_volume, depth_range)
+        intrinsics = {device_id: intrinsics_from_dict(info.depth_intrinsics)
+                      for device_id, info in stream_infos.items()}
+        fuse = None if create_fusion is None else create_fusion()
+        analyze = None if create_analytics is None else create_analytics()
+        pool = BufferPool()
+        with MeasurementWriter(data_dir, output_formats, stream=True) as writer:
+            for task in iter(tasks.get, None):
+                start = time.perf_counter()
+                points = {}
+                for device_id, descriptor in task.descriptors.items():
+                    depth_image, _ = rings[device_id].read(descriptor)
+                    if depth_image is None:
+                        break
+                    world_points = rig.deproject_image(device_id, depth_image, intrinsics[device_id],
+                                                       stream_infos[device_id].depth_scale, pool=pool)
+                    points[device_id] = crop_into_pool(world_points, crop_volume, pool, device_id)
+                overwritten = not all(rings[device_id].is_current(descriptor)
+                                      for device_id, descriptor in task.descriptors.items())
+                for device_id, descriptor in task.descriptors.items():
+                    rings[device_id].release(descriptor)
+                if not overwritten:
+                    measurement = Measurement(
+                        frame_number=task.frame_number,
+                        timestamp=min(descriptor.timestamp for descriptor in task.descriptors.values()),
+                        points=points
+                    )
+                    if fuse is not None:
+                        measurement = fuse(measurement)
+                    writer(measurement if analyze is None else analyze(measurement))
+                # The fused point cloud is not pooled, so all pooled point clouds are in points
+                release_points(pool, points.values())
+                results.put(FrameSetResult(task.frame_number, overwritten, time.perf_counter() - start))
+    except Exception as exception:
+        results.put(WorkerFailed(multiprocessing.current_process().name, f'{type(exception).__name__}: {exception}'))
+        raise
+    finally:
+        for ring in rings.values():
+            ring.close()
+
+
+class MultiprocessMeasurement:
+    """Measures the scene continuously with one capture process per camera and several worker processes.
+
+    The capture processes write the frames into shared memory rings and send only their descriptors to this process,
+    which combines them to synchronized frame sets and distributes those to the workers. The world ray tables and
+    pixel masks are compiled here before the workers start, so the workers only load them. If a worker dies, a
+    RuntimeError with its error is raised, since its frames would never be released.
+    """
+
+    def __init__(self, sources: Dict[str, CaptureSource], extrinsics: Dict[str, np.ndarray], crop_volume: CropVolume,
+                 rig: CompiledRig, data_dir: str, output_formats: List[str], workers: int, ring_size: int = 8,
+                 overflow_policy: str = BLOCK, sync_tolerance: float = 15.,
+                 create_fusion: MeasurementFunctionFactory = None,
+                 create_analytics: MeasurementFunctionFactory = None,
+                 instrumentation: Instrumentation = DISABLED, timeout: float = 10.):
+        if 'container' in output_formats:
+            raise ValueError('The container format cannot be written by several worker processes.')
+        self.sources = sources
+        self.extrinsics = extrinsics
+        self.crop_volume = crop_volume
+        self.rig = rig
+        self.data_dir = data_dir
+        self.output_formats = output_formats
+        self.worker_count = workers
+        self.ring_size = ring_size
+        self.overflow_policy = overflow_policy
+        self.sync_tolerance = sync_tolerance
+        self.create_fusion = create_fusion
+        self.create_analytics = create_analytics
+        self.instrumentation = instrumentation
+        self.timeout = timeout
+        self.statistics: Dict[str, int] = {}
+        # Frames written, dropped and overwritten by each ring, available once run returned
+        self.ring_statistics: Dict[str, Dict[str, int]] = {}
+        self._workers: List[multiprocessing.Process] = []
+        self._failures: Dict[str, str] = {}
+        self._pending: Dict[str, Deque[FrameDescriptor]] = {}
+        self._stream_infos: Dict[str, StreamInfo] = {}
+        self._finished = set()
+        self._messages, self._tasks, self._results = None, None, None
+
+    def run(self, frame_count: int = 0) -> Dict[str, int]:
+        """Measures frame_count frame sets, or until a capture process finished if 0. Returns the number of
+        dispatched frame sets, of those discarded since their frames were overwritten and of unmatched frames"""
+        self.statistics = {'frame_sets': 0, 'overwritten': 0, 'unmatched': 0}
+        self.ring_statistics, self._workers, self._failures = {}, [], {}
+        self._pending = {device_id: collections.deque() for device_id in self.sources}
+        self._stream_infos, self._finished = {}, set()
+        rings = {device_id: FrameRing.create(device_id, self.ring_size, source.depth_shape, source.color_shape,
+                                             self.overflow_policy)
+                 for device_id, source in self.sources.items()}
+        self._messages, self._tasks, self._results = (multiprocessing.Queue(), multiprocessing.Queue(),
+                                                       multiprocessing.Queue())
+        stop = multiprocessing.Event()
+        captures = [multiprocessing.Process(target=capture_to_ring,
+                                            args=(source, rings[device_id].spec, self._messages, stop),
+                                            name=f'capture-{device_id}', daemon=True)
+                    for device_id, source in self.sources.items()]
+        for capture in captures:
+            capture.start()
+        try:
+            self._start_workers(rings)
+            self._dispatch(rings, frame_count)
+        finally:
+            stop.set()
+            self._stop_workers()
+            # The capture processes can only exit once their queued messages were consumed
+            while any(capture.is_alive() for capture in captures):
+                try:
+                    self._messages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for device_id, ring in rings.items():
+                self.ring_statistics[device_id] = ring.get_statistics()
+                for counter, value in self.ring_statistics[device_id].items():
+                    self.instrumentation.set_counter(f'ring_{counter}_frames', device_id, value)
+                ring.close()
+        if self._failures:
+            # A worker failed while the last frame sets were processed
+            self._raise_failures()
+        return self.statistics
+
+    def _start_workers(self, rings: Dict[str, FrameRing]):
+        while len(self._stream_infos) < len(self.sources):
+            self._receive()
+            if self._finished:
+                raise RuntimeError(f'{", ".join(sorted(self._finished))} stopped before delivering a frame.')
+        for device_id, info in self._stream_infos.items():
+            self.rig.get_table(device_id, intrinsics_from_dict(info.depth_intrinsics), info.depth_scale)
+            self.rig.get_mask(device_id, intrinsics_from_dict(info.depth_intrinsics), info.depth_scale)
+        ring_specs = {device_id: ring.spec for device_id, ring in rings.items()}
+        self._workers = [multiprocessing.Process(
+            target=process_frame_sets,
+            args=(self._tasks, self._results, ring_specs, self._stream_infos, self.data_dir, self.output_formats,
+                  self.extrinsics, self.crop_volume, self.rig.rig_dir, self.rig.crop_volume, self.rig.depth_range,
+                  self.create_fusion, self.create_analytics),
+            name=f'worker-{index}', daemon=True) for index in range(self.worker_count)]
+        for worker in self._workers:
+            worker.start()
+
+    def _dispatch(self, rings: Dict[str, FrameRing], frame_count: int):
+        while frame_count == 0 or self.statistics['frame_sets'] < frame_count:
+            frame_set, unmatched = pop_synchronized(self._pending, self.sync_tolerance, lambda item: item.timestamp)
+            for device_id, descriptor in unmatched:
+                rings[device_id].release(descriptor)
+                self.statistics['unmatched'] += 1
+            if frame_set is not None:
+                self._tasks.put(FrameSetTask(self.statistics['frame_sets'], frame_set))
+                self.statistics['frame_sets'] += 1
+                self._check_workers()
+            elif any(not self._pending[device_id] for device_id in self._finished):
+                break
+            else:
+                self._receive()
+
+    def _stop_workers(self):
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            while worker.is_alive():
+                self._collect_results()
+                worker.join(0.1)
+        self._collect_results()
+
+    def _collect_results(self):
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(result, WorkerFailed):
+                self._failures[result.worker] = f'failed with {result.error}'
+                continue
+            self.statistics['overwritten'] += result.overwritten
+            self.instrumentation.observe('process', '', result.seconds)
+
+    def _raise_failures(self):
+        raise RuntimeError('Processing frame sets failed: ' +
+                           '; '.join(f'{worker} {error}' for worker, error in self._failures.items()))
+
+    def _check_workers(self):
+        exited = [worker for worker in self._workers if not worker.is_alive()]
+        # A worker that failed sent its error before it exited, so it is collected here
+        self._collect_results()
+        for worker in exited:
+            if worker.name not in self._failures:
+                self._failures[worker.name] = f'exited with code {worker.exitcode}'
+        if self._failures:
+            self._raise_failures()
+
+    def _receive(self):
+        # Waits in short steps, so a worker that died is noticed while the capture processes wait for free slots
+        deadline = time.monotonic() + self.timeout
+        while True:
+            self._check_workers()
+            try:
+                message = self._messages.get(timeout=min(0.1, max(deadline - time.monotonic(), 0.)))
+                break
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f'No frames arrived within {self.timeout} s.')
+        if isinstance(message, FrameDescriptor):
+            self._pending[message.device_id].append(message)
+        elif isinstance(message, StreamInfo):
+            self._stream_infos[message.device_id] = message
+        elif isinstance(message, CaptureFinished):
+            if message.error is not None:
+                raise RuntimeError(f'Capturing frames of {message.device_id} failed: {message.error}')
+            self._finished.add(message.device_id)
@@ -1,12 +1,16 @@
 import argparse
 import os
-from typing import List, Tuple
+from typing import List, Tuple, Optional
 
 import numpy as np
-import rmsd
-from cv2 import aruco
 
-from depth_camera_array.camera import initialize_connected_cameras, extract_color_image, close_connected_cameras
+from depth_camera_array.aruco_detection import ArucoDetector, get_dictionary
+from depth_camera_array.camera import initialize_connected_cameras, extract_color_image, close_connected_cameras, \
+    Camera
+from depth_camera_array.camera_array import CameraArray, capture_frame_sets
+from depth_camera_array.capture_profiles import CALIBRATION, add_rig_config_argument, load_rig_config
+from depth_camera_array.instrumentation import Instrumentation, create_instrumentation, finish_instrumentation
+from depth_camera_array.marker_accumulator import AccumulatedMarkers, MarkerAccumulator
 from depth_camera_array.utilities import create_if_not_exists, dump_dict_as_json, DEFAULT_DATA_DIR
 
 
@@ -17,6 +21,28 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--remove_previous_data', action='store_true',
                         help='If set, each reference-point file in data_dir will be removed before performing new '
                              'detection.')
+    parser.add_argument('--aligned_depth', action='store_true',
+                        help='If set, the depth frame is aligned to the color frame once and the marker positions are '
+                             'looked up in the aligned depth instead of searching each of them in the depth frame.')
+    parser.add_argument('--recording_dir', type=str, default=None,
+                        help='If set, the recording in this directory is used instead of connected devices')
+    parser.add_argument('--warmup_frames', type=int, default=0,
+                        help='Number of frames discarded after starting each device, e.g. to let auto exposure settle')
+    add_rig_config_argument(parser)
+    parser.add_argument('--coarse_scale', type=float, default=0.5,
+                        help='Scale of the downscaled image the markers are searched in first. Their corners are '
+                             'detected at full resolution around the found markers only. 1 searches the full image')
+    parser.add_argument('--detection_workers', type=int, default=None,
+                        help='Number of threads detecting markers in parallel. By default, one per camera')
+    parser.add_argument('--frame_count', type=int, default=1,
+                        help='Number of frames per camera whose marker positions are averaged. Only the running mean '
+                             'and variance of each marker are kept, so memory does not grow with the frame count')
+    parser.add_argument('--outlier_threshold', type=float, default=3.,
+                        help='Marker positions farther from the running mean than this multiple of their standard '
+                             'deviation are rejected when averaging several frames')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='If set, runtime metrics of each stage and camera are written to this file, as JSON if it '
+                             'ends with .json, otherwise as Prometheus text file')
     return parser.parse_args()
 
 
@@ -31,35 +57,82 @@ def main():
     if args.remove_previous_data:
         remove_previous_data(args.data_dir)
 
-    cameras = initialize_connected_cameras()
+    cameras = initialize_connected_cameras(args.recording_dir, warmup_frames=args.warmup_frames,
+                                           rig_config=load_rig_config(args.data_dir, args.rig_config),
+                                           purpose=CALIBRATION)
+    instrumentation = create_instrumentation(args.metrics)
+    try:
+        detect_reference_points(args, cameras, instrumentation)
+    finally:
+        finish_instrumentation(instrumentation, args.metrics)
+        close_connected_cameras(cameras)
+
+
+def detect_reference_points(args: argparse.Namespace, cameras: List[Camera], instrumentation: Instrumentation):
+    """Detects the markers in args.frame_count frame sets and writes the averaged reference points of each camera"""
+    accumulators = {camera.device_id: MarkerAccumulator(args.outlier_threshold) for camera in cameras}
+    workers = args.detection_workers or max(len(cameras), 1)
+    with ArucoDetector(args.coarse_scale, tracking=args.frame_count > 1, workers=workers) as detector, \
+            CameraArray(cameras, drop_frames=args.recording_dir is None,
+                        instrumentation=instrumentation) as camera_array:
+        for frame_set in capture_frame_sets(camera_array, args.frame_count):
+            with instrumentation.measure('detect'):
+                detections = detector.detect_all({camera.device_id: extract_color_image(frame_set[camera.device_id])
+                                                  for camera in cameras})
+            for camera in cameras:
+                aruco_corners_image_points, aruco_ids = detections[camera.device_id]
+                with instrumentation.measure('deproject', camera.device_id):
+                    centers, corners = markers_to_object_points(camera, frame_set[camera.device_id],
+                                                                aruco_corners_image_points, args.aligned_depth)
+                accumulators[camera.device_id].add(aruco_ids, centers, corners)
+
     for camera in cameras:
-        frames = camera.poll_frames()
-        color_frame = extract_color_image(frames)
+        markers = accumulators[camera.device_id].result()
+        instrumentation.increment('detected_markers', camera.device_id, len(markers.aruco_ids))
+        with instrumentation.measure('output', camera.device_id):
+            dump_reference_points(camera.device_id, markers.aruco_ids, markers.centers, args.data_dir, markers)
 
-        aruco_corners_image_points, aruco_ids = detect_aruco_targets(color_frame)
-        aruco_centers_image_points = [determine_aruco_center(corners) for corners in aruco_corners_image_points]
-        aruco_centers_object_points = camera.image_points_to_object_points(aruco_centers_image_points, frames)
 
-        dump_reference_points(camera.device_id, aruco_ids, aruco_centers_object_points, args.data_dir)
-    close_connected_cameras(cameras)
+def markers_to_object_points(camera: Camera, frames, aruco_corners_image_points: np.ndarray,
+                             use_aligned_depth: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the (N, 3) object points of the marker centers and the (N, 4, 3) object points of their corners. Points
+    without depth are NaN"""
+    aruco_corners_image_points = np.asarray(aruco_corners_image_points, dtype=float).reshape(-1, 4, 2)
+    aruco_centers_image_points = [determine_aruco_center(corners) for corners in aruco_corners_image_points]
+    object_points = camera.image_points_to_object_points(
+        np.concatenate([np.reshape(aruco_centers_image_points, (-1, 2)), aruco_corners_image_points.reshape(-1, 2)]),
+        frames, use_aligned_depth=use_aligned_depth)
+    marker_count = aruco_corners_image_points.shape[0]
+    return object_points[:marker_count], object_points[marker_count:].reshape(-1, 4, 3)
 
 
 def detect_aruco_targets(rgb_image: np.array) -> Tuple[np.array, List[int]]:
-    aruco_corners, aruco_ids, _ = aruco.detectMarkers(rgb_image, aruco.Dictionary_get(aruco.DICT_5X5_250))
+    from cv2 import aruco
+    aruco_corners, aruco_ids, _ = aruco.detectMarkers(rgb_image, get_dictionary())
     return np.array([item[0] for item in aruco_corners]), [item[0] for item in aruco_ids]
 
 
 def determine_aruco_center(corners: np.array) -> np.array:
     assert corners.shape == (4, 2,)
-    return rmsd.centroid(corners)
+    return corners.mean(axis=0)
 
 
-def dump_reference_points(device_id: str, aruco_ids: List[int], aruco_centers: List[np.array], data_dir: str):
+def dump_reference_points(device_id: str, aruco_ids: List[int], aruco_centers: List[np.array], data_dir: str,
+                          markers: Optional[AccumulatedMarkers] = None):
+    """Writes the marker centers. If accumulated markers are given, their corners, the standard deviation of the
+    centers per axis and the number of used and rejected samples are written as well. Corners without depth are
+    null"""
     reference_points = {
         'camera_id': device_id,
-        'aruco': aruco_ids,
-        'centers': aruco_centers
+        'aruco': [int(aruco_id) for aruco_id in aruco_ids],
+        'centers': np.asarray(aruco_centers, dtype=float).reshape(-1, 3).tolist()
     }
+    if markers is not None:
+        reference_points['corners'] = [corners.tolist() if np.all(np.isfinite(corners)) else None
+                                       for corners in markers.corners]
+        reference_points['spread'] = markers.spread.tolist()
+        reference_points['counts'] = markers.counts.tolist()
+        reference_points['rejected'] = markers.rejected.tolist()
     dump_dict_as_json(reference_points, os.path.join(data_dir, f'{device_id}_reference_points.json'))
 
 
@@ -0,0 +1,345 @@
+import argparse
+import contextlib
+import io
+import itertools
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from depth_camera_array import analytics
+from depth_camera_array.aruco_detection import ArucoDetector
+from depth_camera_array.buffer_pool import BufferPool
+from depth_camera_array.camera import initialize_connected_cameras, close_connected_cameras
+from depth_camera_array.camera_array import CameraArray
+from depth_camera_array.capture_profiles import HostDecimatedFrames
+from depth_camera_array.crop_volumes import MeasurementCylinder, transform_and_crop
+from depth_camera_array.incremental import IncrementalDeprojector
+from depth_camera_array.perform_aruco_detection import detect_aruco_targets
+from depth_camera_array.perform_calibration import generate_extrinsics
+from depth_camera_array.measurement import crop_into_pool
+from depth_camera_array.perform_measurement import apply_transformation, remove_unnecessary_content
+from depth_camera_array.point_cloud_io import write_json, write_npy, write_ply
+from depth_camera_array.rig import CompiledRig
+from depth_camera_array.simulation import SimulatedCamera, create_aruco_image, create_depth_image, create_intrinsics
+from depth_camera_array.utilities import create_if_not_exists, dump_dict_as_json, load_json_to_dict, DEFAULT_DATA_DIR
+
+RESOLUTIONS = {'640x480': (640, 480), '1280x720': (1280, 720), '1920x1080': (1920, 1080)}
+STAGES = ['depth_frame_to_object_points', 'apply_transformation', 'remove_unnecessary_content', 'transform_and_crop',
+          'compiled_rig', 'culled_rig', 'pooled_rig', 'host_decimation', 'incremental', 'analytics',
+          'detect_aruco_targets', 'aruco_detector', 'write_ply', 'write_npy', 'write_json', 'generate_extrinsics']
+# Moves the synthetic scene such that the box in front of the camera lies in the default measurement cylinder
+CAMERA_TO_WORLD = np.array([
+    [1., 0., 0., 0.],
+    [0., -1., 0., 0.9],
+    [0., 0., -1., 1.5],
+    [0., 0., 0., 1.]
+])
+MEASUREMENT_CYLINDER = MeasurementCylinder(0., 1.8, 0.5)
+HEAVY_DEPENDENCIES = ['pyrealsense2', 'cv2', 'rmsd', 'scipy', 'open3d', 'matplotlib']
+STARTUP_MODULES = ['numpy'] + HEAVY_DEPENDENCIES + [
+    'depth_camera_array.perform_calibration', 'depth_camera_array.perform_measurement',
+    'depth_camera_array.perform_aruco_detection', 'depth_camera_array.perform_recording',
+    'depth_camera_array.create_calibration_targets'
+]
+# Imports a module in a fresh interpreter and prints the import time in s, the peak resident memory in kB and the
+# loaded heavy dependencies. VmHWM is used since ru_maxrss would include the memory of the parent process
+_IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+with open('/proc/self/status') as f:
+    peak_memory = next((line.split()[1] for line in f if line.startswith('VmHWM')), 0)
+print(duration, peak_memory, *[name for name in {dependencies} if name in sys.modules])
+'''
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser('Measures the runtime of each processing stage on synthetic data')
+    parser.add_argument('--resolutions', nargs='+', choices=list(RESOLUTIONS), default=list(RESOLUTIONS),
+                        help='Resolutions of the synthetic depth and color frames')
+    parser.add_argument('--camera_counts', type=int, nargs='+', default=[1, 4, 16],
+                        help='Numbers of cameras to process per iteration')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to benchmark')
+    parser.add_argument('--iterations', type=int, default=10, help='Number of timed iterations per benchmark')
+    parser.add_argument('--data_dir', type=lambda item: create_if_not_exists(item), default=DEFAULT_DATA_DIR,
+                        help='Data location to dump the results to')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Results of a previous run to compare with. Exits with 1 if any stage got slower')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative increase of the median latency compared to the baseline that is regarded as '
+                             'regression')
+    parser.add_argument('--startup', action='store_true',
+                        help='If set, the startup is measured instead of the processing stages: the import time of '
+                             'each entry point and heavy dependency, and the time to start the connected devices and '
+                             'to receive the first frame set')
+    parser.add_argument('--warmup_frames', type=int, default=0,
+                        help='Number of frames discarded after starting each device in the startup benchmark')
+    return parser.parse_args()
+
+
+def create_reference_points(camera_count: int, marker_count: int = 12, seed: int = 0) -> dict:
+    """Creates reference points of randomly posed cameras. The first camera sees all markers, each other camera sees
+    a random subset of at least 4 of them"""
+    random = np.random.RandomState(seed)
+    world_points = random.uniform(-2., 2., (marker_count, 3))
+    world_points[:3] = [[0.3, 0., 0.], [0., 0., 0.], [0., 0., 0.2]]
+    reference_points = {}
+    for index in range(camera_count):
+        rotation, _ = np.linalg.qr(random.normal(size=(3, 3)))
+        rotation *= np.linalg.det(rotation)
+        translation = random.uniform(-3., 3., 3)
+        if index == 0:
+            arucos = np.arange(marker_count)
+        else:
+            arucos = np.sort(random.choice(marker_count, random.randint(4, marker_count + 1), replace=False))
+        centers = (world_points[arucos] - translation) @ rotation
+        reference_points[f'cam_{index}'] = {'aruco': (arucos + 1).tolist(), 'centers': centers.tolist()}
+    return reference_points
+
+
+def summarize(latencies: List[float], peak_memory: float, camera_count: int = 1) -> Dict[str, float]:
+    """Returns median and 99th percentile of the latencies in ms, the peak memory in bytes converted to MB and the
+    throughput in frames per second"""
+    p50 = float(np.percentile(latencies, 50))
+    return {
+        'p50_ms': p50,
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'peak_memory_mb': peak_memory / 1024 ** 2,
+        'throughput': camera_count * 1000. / p50 if p50 > 0 else float('inf')
+    }
+
+
+def measure(run: Callable[[], None], iterations: int, camera_count: int = 1) -> Dict[str, float]:
+    """Returns latencies and throughput of run as well as the peak memory it allocates"""
+    run()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        run()
+        latencies.append((time.perf_counter() - start) * 1000.)
+    tracemalloc.start()
+    run()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarize(latencies, peak_memory, camera_count)
+
+
+def print_result(result: dict):
+    throughput = f'{result["throughput"]:10.1f} frames/s, ' if result['cameras'] > 0 else ''
+    print(f'{result["stage"]:<50} {result["resolution"]:>9} {result["cameras"]:>3} cameras: {throughput}'
+          f'p50 {result["p50_ms"]:9.2f} ms, p99 {result["p99_ms"]:9.2f} ms, '
+          f'peak memory {result["peak_memory_mb"]:8.1f} MB')
+
+
+def _run_silently(function: Callable, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args)
+
+
+def create_benchmarks(resolution: str, camera_count: int, output_dir: str,
+                      resources: contextlib.ExitStack) -> Dict[str, Callable[[], None]]:
+    """Returns the benchmark of each stage. The detector and the buffer pool are closed by resources"""
+    width, height = RESOLUTIONS[resolution]
+    intrinsics = create_intrinsics(width, height)
+    color_image = create_aruco_image(width, height)
+    cameras = [SimulatedCamera(f'cam_{index}', [create_depth_image(intrinsics)], [color_image], intrinsics)
+               for index in range(camera_count)]
+    frames = [camera.poll_frames() for camera in cameras]
+    object_points = [camera.depth_frame_to_object_points(camera_frames, remove_zero_depth=True)
+                     for camera, camera_frames in zip(cameras, frames)]
+    transformed_points = [apply_transformation(points, CAMERA_TO_WORLD) for points in object_points]
+    cropped_points = [transform_and_crop(points, CAMERA_TO_WORLD, MEASUREMENT_CYLINDER) for points in object_points]
+    color_images = {camera.device_id: color_image for camera in cameras}
+    aruco_detector = resources.enter_context(ArucoDetector(coarse_scale=0.5))
+    extrinsics = {camera.device_id: CAMERA_TO_WORLD for camera in cameras}
+    rig = CompiledRig(os.path.join(output_dir, 'rig'), extrinsics)
+    culled_rig = CompiledRig(os.path.join(output_dir, 'culled_rig'), extrinsics, MEASUREMENT_CYLINDER)
+
+    def deproject_with_rig(compiled_rig: CompiledRig) -> List[np.ndarray]:
+        world_points = [compiled_rig.deproject(camera.device_id, camera_frames.get_depth_frame(), camera.depth_scale)
+                        for camera, camera_frames in zip(cameras, frames)]
+        return [points[MEASUREMENT_CYLINDER.contains(points)] for points in world_points]
+
+    pool = BufferPool()
+    resources.callback(pool.close)
+
+    def deproject_into_pool() -> List[np.ndarray]:
+        world_points = [culled_rig.deproject(camera.device_id, camera_frames.get_depth_frame(), camera.depth_scale,
+                                             pool=pool)
+                        for camera, camera_frames in zip(cameras, frames)]
+        cropped = [crop_into_pool(points, MEASUREMENT_CYLINDER, pool, camera.device_id)
+                   for camera, points in zip(cameras, world_points)]
+        pool.checkin_all(cropped)
+        return cropped
+
+    deproject_with_rig(rig)
+    deproject_with_rig(culled_rig)
+    deproject_into_pool()
+
+    # Alternates between two depth images that differ in a small region, as when a person moves in a static scene
+    depth_images = [create_depth_image(intrinsics), create_depth_image(intrinsics)]
+    depth_images[1][height // 2:height // 2 + height // 10, width // 2:width // 2 + width // 10] = 1200
+    deprojectors = [IncrementalDeprojector(rig.get_table(camera.device_id, intrinsics, camera.depth_scale),
+                                           (height, width), camera.depth_scale, MEASUREMENT_CYLINDER)
+                    for camera in cameras]
+    frame_numbers = itertools.count()
+
+    def deproject_incrementally() -> List[np.ndarray]:
+        depth_image = depth_images[next(frame_numbers) % 2]
+        changes = [deprojector.update(depth_image) for deprojector in deprojectors]
+        return [deprojector.changed_points(frame_changes) for deprojector, frame_changes in zip(deprojectors, changes)]
+
+    deproject_incrementally()
+
+    def write(writer: Callable[[np.ndarray, str], None], extension: str):
+        for camera, points in zip(cameras, cropped_points):
+            writer(points, os.path.join(output_dir, f'{camera.device_id}.{extension}'))
+
+    return {
+        'depth_frame_to_object_points': lambda: [
+            camera.depth_frame_to_object_points(camera_frames, remove_zero_depth=True)
+            for camera, camera_frames in zip(cameras, frames)],
+        'apply_transformation': lambda: [apply_transformation(points, CAMERA_TO_WORLD) for points in object_points],
+        'remove_unnecessary_content': lambda: [remove_unnecessary_content(points, 0., 1.8, 0.5)
+                                               for points in transformed_points],
+        'transform_and_crop': lambda: [transform_and_crop(points, CAMERA_TO_WORLD, MEASUREMENT_CYLINDER)
+                                       for points in object_points],
+        'compiled_rig': lambda: deproject_with_rig(rig),
+        'culled_rig': lambda: deproject_with_rig(culled_rig),
+        'pooled_rig': deproject_into_pool,
+        'host_decimation': lambda: [camera.depth_frame_to_object_points(HostDecimatedFrames(camera_frames, 2),
+                                                                        remove_zero_depth=True)
+                                    for camera, camera_frames in zip(cameras, frames)],
+        'incremental': deproject_incrementally,
+        'analytics': lambda: analytics.summarize(analytics.PointCloudIndex(np.concatenate(cropped_points), 0.005), 0.,
+                                                 [0.9]),
+        'detect_aruco_targets': lambda: [detect_aruco_targets(color_image) for _ in cameras],
+        'aruco_detector': lambda: aruco_detector.detect_all(color_images),
+        'write_ply': lambda: write(write_ply, 'ply'),
+        'write_npy': lambda: write(write_npy, 'npy'),
+        'write_json': lambda: write(lambda points, path: write_json(points, path, 'camera'), 'json'),
+    }
+
+
+def run_benchmarks(resolutions: List[str], camera_counts: List[int], stages: List[str],
+                   iterations: int) -> List[dict]:
+    results = []
+
+    def add_result(stage: str, resolution: str, camera_count: int, run: Callable[[], None]):
+        result = {'stage': stage, 'resolution': resolution, 'cameras': camera_count}
+        result.update(measure(run, iterations, camera_count))
+        print_result(result)
+        results.append(result)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for resolution in resolutions:
+            for camera_count in camera_counts:
+                with contextlib.ExitStack() as resources:
+                    benchmarks = create_benchmarks(resolution, camera_count, output_dir, resources)
+                    for stage in stages:
+                        if stage in benchmarks:
+                            add_result(stage, resolution, camera_count, benchmarks[stage])
+    if 'generate_extrinsics' in stages:
+        for camera_count in camera_counts:
+            reference_points = create_reference_points(camera_count)
+            add_result('generate_extrinsics', '-', camera_count,
+                       lambda: _run_silently(generate_extrinsics, reference_points))
+    return results
+
+
+def measure_import(module: str) -> Optional[tuple]:
+    """Returns import time in ms, peak memory in bytes and loaded heavy dependencies of the module in a fresh
+    interpreter, or None if it cannot be imported"""
+    process = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT.format(module=module,
+                                                                          dependencies=HEAVY_DEPENDENCIES)],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    if process.returncode != 0:
+        return None
+    words = process.stdout.split()
+    return float(words[0]) * 1000., int(words[1]) * 1024, words[2:]
+
+
+def run_startup_benchmarks(iterations: int, warmup_frames: int = 0, modules: List[str] = None) -> List[dict]:
+    """Measures the import time of each module and, if devices are connected, the time to start them and to receive
+    the first synchronized frame set"""
+    results = []
+    for module in STARTUP_MODULES if modules is None else modules:
+        measurements = [measure_import(module) for _ in range(iterations)]
+        if any(measurement is None for measurement in measurements):
+            print(f'{module} cannot be imported')
+            continue
+        result = {'stage': f'import {module}', 'resolution': '-', 'cameras': 0}
+        result.update(summarize([measurement[0] for measurement in measurements],
+                                max(measurement[1] for measurement in measurements), 0))
+        result['loaded_dependencies'] = measurements[0][2]
+        print_result(result)
+        print(f'{"":<50} loads {", ".join(result["loaded_dependencies"]) or "no heavy dependencies"}')
+        results.append(result)
+
+    start_latencies, first_frame_latencies = [], []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        cameras = initialize_connected_cameras(warmup_frames=warmup_frames)
+        started = time.perf_counter()
+        if not cameras:
+            print('No connected devices to measure the device startup')
+            return results
+        try:
+            with CameraArray(cameras) as camera_array:
+                camera_array.wait_for_frames()
+            start_latencies.append((started - start) * 1000.)
+            first_frame_latencies.append((time.perf_counter() - started) * 1000.)
+        finally:
+            close_connected_cameras(cameras)
+    for stage, latencies in [('start_cameras', start_latencies), ('first_frame_set', first_frame_latencies)]:
+        result = {'stage': stage, 'resolution': '-', 'cameras': len(cameras)}
+        result.update(summarize(latencies, 0, len(cameras)))
+        print_result(result)
+        results.append(result)
+    return results
+
+
+def compare_with_baseline(results: List[dict], baseline: List[dict], tolerance: float) -> List[dict]:
+    """Returns the results whose median latency exceeds the one of the matching baseline result by more than the
+    relative tolerance, extended by the baseline latency"""
+    baseline = {(result['stage'], result['resolution'], result['cameras']): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline.get((result['stage'], result['resolution'], result['cameras']))
+        if reference is not None and result['p50_ms'] > reference['p50_ms'] * (1. + tolerance):
+            regressions.append(dict(result, baseline_p50_ms=reference['p50_ms']))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    if args.startup:
+        results = run_startup_benchmarks(args.iterations, args.warmup_frames)
+    else:
+        results = run_benchmarks(args.resolutions, args.camera_counts, args.stages, args.iterations)
+    dump_dict_as_json({
+        'python': sys.version,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'results': results
+    }, os.path.join(args.data_dir, 'startup_benchmark_results.json' if args.startup else 'benchmark_results.json'))
+    if args.baseline is not None:
+        regressions = compare_with_baseline(results, load_json_to_dict(args.baseline)['results'], args.tolerance)
+        for regression in regressions:
+            print(f'Regression in {regression["stage"]} at {regression["resolution"]} with {regression["cameras"]} '
+                  f'cameras: {regression["p50_ms"]:.2f} ms instead of {regression["baseline_p50_ms"]:.2f} ms')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,49 @@
 import argparse
+import heapq
+import itertools
 import os
-from typing import Tuple, Dict, Iterable, List, Union
+import sys
+from typing import Tuple, Dict, Iterable, List, NamedTuple, Optional, Union
 
 import numpy as np
-import rmsd
 
 from depth_camera_array.utilities import create_if_not_exists, load_json_to_dict, dump_dict_as_json, DEFAULT_DATA_DIR
 
 ReferencePoints = Dict[str, Dict[str, List[Union[int, Tuple[float, float, float]]]]]
 
+# Minimum number of markers two cameras have to share to calculate their relative pose
+MIN_SHARED_MARKERS = 3
+# Number of neighbours of each camera, whose shared markers are checked for outliers
+MAX_VERIFICATION_NEIGHBOURS = 4
+
+
+class ObservationGraph(NamedTuple):
+    """Marker centers observed by each camera. Cameras and markers are the nodes of the graph, each observation is an
+    edge. points holds the (C, M, 3) center of each marker in the coordinate system of each camera and observed marks
+    the valid entries. Two cameras are connected if they share enough markers to calculate their relative pose"""
+    camera_ids: List[str]
+    aruco_ids: np.ndarray
+    points: np.ndarray
+    observed: np.ndarray
+
+    @property
+    def shared_markers(self) -> np.ndarray:
+        """Returns the (C, C) number of markers each pair of cameras observed"""
+        observed = self.observed.astype(np.int64)
+        return np.matmul(observed, observed.transpose())
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser('Performes an extrinsic calibration for each available camera')
     parser.add_argument('--data_dir', type=lambda item: create_if_not_exists(item), default=DEFAULT_DATA_DIR,
                         help='Data location to load and dump config files')
+    parser.add_argument('--inlier_threshold', type=float, default=0.02,
+                        help='Maximum distance in m between a marker transformed to the base camera and its position '
+                             'detected by the base camera to be used for the calibration')
+    parser.add_argument('--ransac_iterations', type=int, default=200,
+                        help='Maximum number of marker triples that are tried to find the inliers of a camera')
+    parser.add_argument('--refinement_iterations', type=int, default=10,
+                        help='Maximum number of iterations to refine all camera poses and marker positions jointly')
     return parser.parse_args()
 
 
@@ -29,6 +59,71 @@ def read_aruco_data(data_dir: str) -> dict:
     return calibration_data
 
 
+def kabsch(src_points: np.ndarray, dst_points: np.ndarray, weights: np.ndarray = None) -> np.ndarray:
+    """Calculates the rigid transformations with the least squared error from (B, N, 3) src_points to dst_points for a
+    batch of B point sets at once. Points with zero weight are ignored. Returns (B, 4, 4) homogeneous matrices"""
+    if weights is None:
+        weights = np.ones(src_points.shape[:2])
+    weights = weights[:, :, np.newaxis] / weights.sum(axis=1)[:, np.newaxis, np.newaxis]
+    src_centroids = (weights * src_points).sum(axis=1)
+    dst_centroids = (weights * dst_points).sum(axis=1)
+    covariances = np.matmul((weights * (src_points - src_centroids[:, np.newaxis])).transpose(0, 2, 1),
+                            dst_points - dst_centroids[:, np.newaxis])
+    u, _, vt = np.linalg.svd(covariances)
+    # Flips the axis of the smallest singular value if the solution is a reflection
+    signs = np.sign(np.linalg.det(np.matmul(vt.transpose(0, 2, 1), u.transpose(0, 2, 1))))
+    vt[:, 2, :] *= signs[:, np.newaxis]
+    rotations = np.matmul(vt.transpose(0, 2, 1), u.transpose(0, 2, 1))
+
+    transformations = np.zeros((src_points.shape[0], 4, 4))
+    transformations[:, :3, :3] = rotations
+    transformations[:, :3, 3] = dst_centroids - np.matmul(rotations, src_centroids[:, :, np.newaxis])[:, :, 0]
+    transformations[:, 3, 3] = 1.
+    return transformations
+
+
+def transformation_residuals(transformations: np.ndarray, src_points: np.ndarray,
+                             dst_points: np.ndarray) -> np.ndarray:
+    """Returns the (B, N) distances between the (N, 3) src_points transformed by each of the (B, 4, 4)
+    transformations and the dst_points"""
+    differences = np.matmul(src_points, transformations[:, :3, :3].transpose(0, 2, 1))
+    differences += transformations[:, np.newaxis, :3, 3] - dst_points
+    return np.sqrt(np.square(differences).sum(axis=2))
+
+
+def ransac_kabsch(src_points: np.ndarray, dst_points: np.ndarray, threshold: float = 0.02, iterations: int = 200,
+                  seed: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Finds the transformation from (N, 3) src_points to dst_points that is supported by most point pairs within the
+    threshold. All point triples are tried if there are at most iterations of them, otherwise iterations random ones.
+    All hypotheses are solved as one batch. The best one is refined with all its inliers. Returns the transformation,
+    the inlier mask and the residual of each point pair"""
+    point_count = src_points.shape[0]
+    if point_count < 3:
+        raise ValueError('At least 3 point pairs are needed to calculate a transformation.')
+    triple_count = point_count * (point_count - 1) * (point_count - 2) // 6
+    if triple_count <= iterations:
+        samples = np.array(list(itertools.combinations(range(point_count), 3)))
+    else:
+        samples = np.argsort(np.random.RandomState(seed).rand(iterations, point_count), axis=1)[:, :3]
+    hypotheses = kabsch(src_points[samples], dst_points[samples])
+    residuals = transformation_residuals(hypotheses, src_points, dst_points)
+    inliers = residuals < threshold
+    # Most inliers first, the smallest sum of inlier residuals on ties
+    scores = inliers.sum(axis=1) - np.where(inliers, residuals, 0.).sum(axis=1) / (threshold * point_count + 1.)
+    best_inliers = inliers[np.argmax(scores)]
+    if best_inliers.sum() < 3:
+        best_inliers = np.ones(point_count, dtype=bool)
+
+    transformation = kabsch(src_points[np.newaxis], dst_points[np.newaxis], best_inliers[np.newaxis].astype(float))[0]
+    residuals = transformation_residuals(transformation[np.newaxis], src_points, dst_points)[0]
+    if (residuals < threshold).sum() >= 3:
+        best_inliers = residuals < threshold
+        transformation = kabsch(src_points[np.newaxis], dst_points[np.newaxis],
+                                best_inliers[np.newaxis].astype(float))[0]
+        residuals = transformation_residuals(transformation[np.newaxis], src_points, dst_points)[0]
+    return transformation, best_inliers, residuals
+
+
 def calculate_transformation_kabsch(src_points: np.ndarray, dst_points: np.ndarray) -> Tuple[np.array, float]:
     """
     Calculates the optimal rigid transformation from src_points to
@@ -43,29 +138,19 @@ def calculate_transformation_kabsch(src_points: np.ndarray, dst_points: np.ndarr
 
     Returns:
     -----------
-    rotation_matrix: array
-        (3,3) matrix
-
-    translation_vector: array
-        (3,1) matrix
+    transformation: array
+        (4,4) homogeneous matrix
     rmsd_value: float
     """
     assert src_points.shape == dst_points.shape
     if src_points.shape[0] != 3:
         raise Exception("The input data matrix had to be transposed in order to compute transformation.")
 
-    src_points = src_points.transpose()
-    dst_points = dst_points.transpose()
-
-    src_points_centered = src_points - rmsd.centroid(src_points)
-    dst_points_centered = dst_points - rmsd.centroid(dst_points)
-
-    rotation_matrix = rmsd.kabsch(src_points_centered, dst_points_centered)
-    rmsd_value = rmsd.kabsch_rmsd(src_points_centered, dst_points_centered)
-
-    translation_vector = rmsd.centroid(dst_points) - np.matmul(rmsd.centroid(src_points), rotation_matrix)
-
-    return create_homogenous(rotation_matrix.transpose(), translation_vector.transpose()), rmsd_value
+    src_points = np.asarray(src_points, dtype=float).transpose()
+    dst_points = np.asarray(dst_points, dtype=float).transpose()
+    transformation = kabsch(src_points[np.newaxis], dst_points[np.newaxis])
+    residuals = transformation_residuals(transformation, src_points, dst_points)[0]
+    return transformation[0], float(np.sqrt(np.mean(residuals ** 2)))
 
 
 def create_homogenous(rotation_matrix: np.array, translation_vector: np.array) -> np.array:
@@ -75,50 +160,277 @@ def create_homogenous(rotation_matrix: np.array, translation_vector: np.array) -
 
 
 def define_base_camera(aruco_data: ReferencePoints) -> str:
-    """Finds the camera that detected each bottom target and also detected the highest amount of other targets"""
-    base_camera = None
-    detected_targets = 0
+    """Finds the camera that detected each bottom target and also detected the highest amount of other targets. If no
+    camera detected all bottom targets, the camera that detected the most targets is used"""
     bottom_arucos = {1, 2, 3}
-    for k, v in aruco_data.items():
-        if bottom_arucos <= set(v['aruco']) and len(v['aruco']) > detected_targets:
-            base_camera = k
-            detected_targets = len(v['aruco'])
-
-    assert base_camera is not None
-    return base_camera
+    candidates = [k for k, v in aruco_data.items() if bottom_arucos <= set(v['aruco'])] or list(aruco_data)
+    assert candidates
+    return max(candidates, key=lambda k: len(aruco_data[k]['aruco']))
+
+
+def create_observation_graph(aruco_data: ReferencePoints) -> ObservationGraph:
+    camera_ids = sorted(aruco_data)
+    aruco_ids = np.unique(np.concatenate([np.asarray(aruco_data[k]['aruco'], dtype=np.int64) for k in camera_ids]))
+    points = np.zeros((len(camera_ids), len(aruco_ids), 3))
+    observed = np.zeros((len(camera_ids), len(aruco_ids)), dtype=bool)
+    for index, k in enumerate(camera_ids):
+        columns = np.searchsorted(aruco_ids, np.asarray(aruco_data[k]['aruco'], dtype=np.int64))
+        points[index, columns] = np.asarray(aruco_data[k]['centers'], dtype=float).reshape(-1, 3)
+        observed[index, columns] = True
+    return ObservationGraph(camera_ids, aruco_ids, points, observed)
+
+
+def connected_components(shared_markers: np.ndarray, min_shared_markers: int = MIN_SHARED_MARKERS) -> List[List[int]]:
+    """Returns the indices of the cameras of each component of the camera graph, the largest component first"""
+    connected = shared_markers >= min_shared_markers
+    component_of = np.full(shared_markers.shape[0], -1)
+    components = []
+    for start in range(shared_markers.shape[0]):
+        if component_of[start] >= 0:
+            continue
+        component_of[start] = len(components)
+        component, stack = [], [start]
+        while stack:
+            camera = stack.pop()
+            component.append(camera)
+            for neighbour in np.flatnonzero(connected[camera] & (component_of < 0)):
+                component_of[neighbour] = len(components)
+                stack.append(neighbour)
+        components.append(sorted(component))
+    return sorted(components, key=len, reverse=True)
+
+
+def maximum_spanning_tree(shared_markers: np.ndarray, root: int,
+                          min_shared_markers: int = MIN_SHARED_MARKERS) -> List[Tuple[int, int]]:
+    """Returns the (child, parent) edges of the spanning tree of the cameras connected to root that maximizes the
+    number of markers shared along the edges, ordered so that each parent precedes its children. On ties, the parent
+    closest to root is preferred, since the errors of the relative poses accumulate along the chain"""
+    depths = {root: 0}
+    edges = []
+    candidates = []
+
+    def push_neighbours(parent: int):
+        for child in np.flatnonzero(shared_markers[parent] >= min_shared_markers):
+            if child not in depths:
+                heapq.heappush(candidates, (-shared_markers[parent, child], depths[parent], child, parent))
+
+    push_neighbours(root)
+    while candidates:
+        _, depth, child, parent = heapq.heappop(candidates)
+        if child in depths:
+            continue
+        depths[child] = depth + 1
+        edges.append((child, parent))
+        push_neighbours(child)
+    return edges
+
+
+def describe_connectivity(graph: ObservationGraph, min_shared_markers: int = MIN_SHARED_MARKERS) -> Dict[str, object]:
+    """Returns the number of cameras and markers, each pair of cameras that shares at least min_shared_markers
+    markers and the components of the camera graph"""
+    shared_markers = graph.shared_markers
+    first, second = np.nonzero(np.triu(shared_markers >= min_shared_markers, k=1))
+    return {
+        'cameras': len(graph.camera_ids),
+        'markers': len(graph.aruco_ids),
+        'edges': [[graph.camera_ids[a], graph.camera_ids[b], int(shared_markers[a, b])] for a, b in zip(first, second)],
+        'components': [[graph.camera_ids[camera] for camera in component]
+                       for component in connected_components(shared_markers, min_shared_markers)]
+    }
 
 
-def calculate_relative_transformations(aruco_data: dict, base_camera: str) -> Dict[str, np.array]:
-    transformations = {
-        base_camera: np.array(
-            [[1, 0, 0, 0],
-             [0, 1, 0, 0],
-             [0, 0, 1, 0],
-             [0, 0, 0, 1]],
-            dtype=float)
+def analyze_observation_graph(aruco_data: ReferencePoints) -> Dict[str, object]:
+    return describe_connectivity(create_observation_graph(aruco_data))
+
+
+def transform_observations(poses: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """Transforms the (C, M, 3) points of each camera by its (C, 4, 4) pose"""
+    return np.matmul(points, poses[:, :3, :3].transpose(0, 2, 1)) + poses[:, np.newaxis, :3, 3]
+
+
+def verification_edges(shared_markers: np.ndarray, tree: List[Tuple[int, int]],
+                       neighbours: int = MAX_VERIFICATION_NEIGHBOURS,
+                       min_shared_markers: int = MIN_SHARED_MARKERS) -> List[Tuple[int, int]]:
+    """Returns the tree edges and the edges to the neighbours that share at least min_shared_markers markers and the
+    most markers with each camera, so the number of edges grows linearly with the number of cameras"""
+    edges = {tuple(sorted(edge)) for edge in tree}
+    for camera in range(shared_markers.shape[0]):
+        candidates = np.flatnonzero(shared_markers[camera] >= min_shared_markers)
+        candidates = candidates[candidates != camera]
+        strongest = candidates[np.argsort(-shared_markers[camera, candidates], kind='stable')[:neighbours]]
+        edges.update(tuple(sorted((camera, neighbour))) for neighbour in strongest)
+    return sorted(edges)
+
+
+def verify_observations(graph: ObservationGraph, edges: List[Tuple[int, int]], threshold: float = 0.02,
+                        iterations: int = 200, depths: Optional[np.ndarray] = None
+                        ) -> Tuple[Dict[Tuple[int, int], np.ndarray], np.ndarray]:
+    """Calculates the relative pose of each pair of cameras by RANSAC on their shared markers. An observation is
+    rejected if it was an outlier on each verified edge it belongs to. Observations on no verified edge are kept.
+    If all verified observations of a marker were rejected, no camera confirms any of them, e.g. if only two cameras
+    see it. Then the observation of the camera with the smallest (C,) depths in the spanning tree is kept, since the
+    pose of the base camera is the reference. Returns the transformation from the first to the second camera of each
+    edge and the (C, M) inlier mask"""
+    transformations = {}
+    accepted = np.zeros_like(graph.observed)
+    verified = np.zeros_like(graph.observed)
+    for first, second in edges:
+        columns = np.flatnonzero(graph.observed[first] & graph.observed[second])
+        transformation, edge_inliers, _ = ransac_kabsch(graph.points[first, columns], graph.points[second, columns],
+                                                        threshold, iterations)
+        transformations[(first, second)] = transformation
+        for camera in (first, second):
+            verified[camera, columns] = True
+            accepted[camera, columns] |= edge_inliers
+    if depths is not None:
+        unconfirmed = np.flatnonzero(verified.any(axis=0) & ~(accepted & verified).any(axis=0))
+        ranks = np.where(verified[:, unconfirmed], depths[:, np.newaxis], np.iinfo(np.int64).max)
+        accepted[np.argmin(ranks, axis=0), unconfirmed] = True
+    return transformations, graph.observed & (accepted | ~verified)
+
+
+def chain_poses(camera_count: int, root: int, tree: List[Tuple[int, int]],
+                transformations: Dict[Tuple[int, int], np.ndarray]) -> np.ndarray:
+    """Calculates the (C, 4, 4) pose of each camera relative to root by chaining the relative poses along the tree"""
+    poses = np.tile(np.eye(4), (camera_count, 1, 1))
+    for child, parent in tree:
+        if (child, parent) in transformations:
+            transformation = transformations[(child, parent)]
+        else:
+            transformation = np.linalg.inv(transformations[(parent, child)])
+        poses[child] = np.matmul(poses[parent], transformation)
+    return poses
+
+
+def rotations_from_vectors(vectors: np.ndarray) -> np.ndarray:
+    """Returns the (B, 3, 3) rotation matrices of the (B, 3) axis angle vectors by the formula of Rodrigues"""
+    angles = np.linalg.norm(vectors, axis=1)
+    axes = vectors / np.maximum(angles, 1e-12)[:, np.newaxis]
+    cross = np.zeros((vectors.shape[0], 3, 3))
+    cross[:, 0, 1], cross[:, 0, 2], cross[:, 1, 2] = -axes[:, 2], axes[:, 1], -axes[:, 0]
+    cross -= cross.transpose(0, 2, 1)
+    return (np.eye(3) + np.sin(angles)[:, np.newaxis, np.newaxis] * cross
+            + (1. - np.cos(angles))[:, np.newaxis, np.newaxis] * np.matmul(cross, cross))
+
+
+def estimate_marker_positions(poses: np.ndarray, graph: ObservationGraph, inliers: np.ndarray) -> np.ndarray:
+    """Returns the (M, 3) mean of the transformed inlier observations of each marker, or the mean of all its
+    observations if none of them is an inlier"""
+    transformed = transform_observations(poses, graph.points)
+    weights = np.where(inliers.any(axis=0), inliers, graph.observed)[:, :, np.newaxis]
+    return (weights * transformed).sum(axis=0) / weights.sum(axis=0)
+
+
+def adjust_poses(graph: ObservationGraph, poses: np.ndarray, inliers: np.ndarray, root: int, iterations: int = 10,
+                 tolerance: float = 1e-6) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Minimizes the squared distances between all inlier observations transformed to the coordinate system of root
+    and the marker positions by Gauss-Newton iterations. The unknowns are a rotation vector and a translation per
+    camera and a position per marker. Each observation only depends on one camera and one marker, so the normal
+    equations are sparse and are solved by a sparse direct solver. The pose of root stays fixed. Returns the adjusted
+    poses, the (M, 3) marker positions and the number of iterations"""
+    from scipy import sparse
+    from scipy.sparse.linalg import spsolve
+
+    poses = poses.copy()
+    positions = estimate_marker_positions(poses, graph, inliers)
+    cameras, markers = np.nonzero(inliers)
+    free_cameras = np.flatnonzero(np.arange(len(graph.camera_ids)) != root)
+    camera_columns = np.full(len(graph.camera_ids), -1)
+    camera_columns[free_cameras] = 6 * np.arange(len(free_cameras))
+    marker_offset = 6 * len(free_cameras)
+    variable_count = marker_offset + 3 * len(graph.aruco_ids)
+    free = cameras != root
+    # Row and column indices of the (3, 6) block of the camera and the (3, 3) block of the marker of each observation
+    rows = 3 * np.arange(len(cameras))[:, np.newaxis] + np.arange(3)
+    camera_rows = np.repeat(rows[free, :, np.newaxis], 6, axis=2)
+    camera_indices = np.broadcast_to(camera_columns[cameras[free], np.newaxis, np.newaxis] + np.arange(6),
+                                     camera_rows.shape)
+    marker_indices = marker_offset + 3 * markers[:, np.newaxis] + np.arange(3)
+    row_index = np.concatenate([camera_rows.reshape(-1), rows.reshape(-1)])
+    column_index = np.concatenate([camera_indices.reshape(-1), marker_indices.reshape(-1)])
+    iteration = 0
+    for iteration in range(1, iterations + 1):
+        rotated = np.matmul(poses[cameras, :3, :3], graph.points[cameras, markers, :, np.newaxis])[:, :, 0]
+        residuals = rotated + poses[cameras, :3, 3] - positions[markers]
+        # d(R p + t - x) / d(rotation vector) = -[R p]x, d / dt = I and d / dx = -I
+        camera_blocks = np.zeros((int(free.sum()), 3, 6))
+        x, y, z = rotated[free].transpose()
+        camera_blocks[:, 0, 1], camera_blocks[:, 0, 2] = z, -y
+        camera_blocks[:, 1, 0], camera_blocks[:, 1, 2] = -z, x
+        camera_blocks[:, 2, 0], camera_blocks[:, 2, 1] = y, -x
+        camera_blocks[:, :, 3:] = np.eye(3)
+        values = np.concatenate([camera_blocks.reshape(-1), -np.ones(3 * len(cameras))])
+        jacobian = sparse.csr_matrix((values, (row_index, column_index)), shape=(3 * len(cameras), variable_count))
+        normal_matrix = (jacobian.transpose() @ jacobian).tocsc()
+        # Unknowns without observations, e.g. markers that were rejected everywhere, are kept by a tiny damping
+        normal_matrix += sparse.identity(variable_count, format='csc') * 1e-12
+        update = -spsolve(normal_matrix, jacobian.transpose() @ residuals.reshape(-1))
+        camera_updates = update[:marker_offset].reshape(-1, 6)
+        increments = rotations_from_vectors(camera_updates[:, :3])
+        poses[free_cameras, :3, :3] = np.matmul(increments, poses[free_cameras, :3, :3])
+        poses[free_cameras, :3, 3] += camera_updates[:, 3:]
+        positions += update[marker_offset:].reshape(-1, 3)
+        if np.abs(update).max() < tolerance:
+            break
+    # Markers without inliers are not constrained by the adjustment
+    return poses, np.where(inliers.any(axis=0)[:, np.newaxis], positions,
+                           estimate_marker_positions(poses, graph, inliers)), iteration
+
+
+def calibrate_observation_graph(aruco_data: ReferencePoints, base_camera: Optional[str] = None,
+                                threshold: float = 0.02, iterations: int = 200,
+                                refinement_iterations: int = 10) -> Tuple[ObservationGraph, dict]:
+    """Calculates the poses of all cameras relative to the base camera and the marker positions in its coordinate
+    system. The cameras do not have to share markers with the base camera, as long as the camera graph is connected.
+    Initial poses are chained along the maximum spanning tree of the camera graph and refined jointly afterwards"""
+    graph = create_observation_graph(aruco_data)
+    base_camera = define_base_camera(aruco_data) if base_camera is None else base_camera
+    root = graph.camera_ids.index(base_camera)
+    shared_markers = graph.shared_markers
+    components = connected_components(shared_markers)
+    if len(components) > 1:
+        raise ValueError(f'Each camera has to share at least {MIN_SHARED_MARKERS} markers with another camera of the '
+                         f'array, but the cameras form the separate groups '
+                         f'{describe_connectivity(graph)["components"]}.')
+    tree = maximum_spanning_tree(shared_markers, root)
+    parents = dict(tree)
+    depths = np.zeros(len(graph.camera_ids), dtype=np.int64)
+    for child, parent in tree:
+        depths[child] = depths[parent] + 1
+    transformations, inliers = verify_observations(graph, verification_edges(shared_markers, tree), threshold,
+                                                   iterations, depths)
+    poses = chain_poses(len(graph.camera_ids), root, tree, transformations)
+    poses, positions, refinement_iterations = adjust_poses(graph, poses, inliers, root, refinement_iterations)
+    residuals = np.linalg.norm(transform_observations(poses, graph.points) - positions, axis=2)
+    cameras = {}
+    for index, k in enumerate(graph.camera_ids):
+        observed = graph.observed[index]
+        camera_inliers = inliers[index][observed]
+        camera_residuals = residuals[index][observed]
+        parent = parents.get(index)
+        cameras[k] = {
+            'pose': poses[index],
+            'parent': None if parent is None else graph.camera_ids[parent],
+            'depth': int(depths[index]),
+            'shared_markers': 0 if parent is None else int(shared_markers[index, parent]),
+            'markers': graph.aruco_ids[observed].tolist(),
+            'inliers': graph.aruco_ids[observed][camera_inliers].tolist(),
+            'outliers': graph.aruco_ids[observed][~camera_inliers].tolist(),
+            'residuals': camera_residuals.tolist(),
+            'rmsd': float(np.sqrt(np.mean(camera_residuals[camera_inliers] ** 2))) if camera_inliers.any() else 0.
+        }
+    calibration = {
+        'base_camera': base_camera,
+        'marker_positions': dict(zip(graph.aruco_ids.tolist(), positions)),
+        'refinement_iterations': refinement_iterations,
+        'cameras': cameras
     }
-    dst_arucos = aruco_data[base_camera]['aruco']
-    dst_points = aruco_data[base_camera]['centers']
-    for k, v in aruco_data.items():
-        if not k == base_camera:
-            # 1. intersect arucos
-            src_arucos = v['aruco']
-            src_points = v['centers']
-            intersection = set(dst_arucos).intersection(set(src_arucos))
-            # 2. create two sorted lists of points
-            assert len(intersection) > 2
-            dst_sorted = []
-            src_sorted = []
-            for aruco_id in intersection:
-                dst_sorted.append(dst_points[dst_arucos.index(aruco_id)])
-                src_sorted.append(src_points[src_arucos.index(aruco_id)])
-
-            transformation, rmsd_value = calculate_transformation_kabsch(np.array(src_sorted).transpose(),
-                                                                         np.array(dst_sorted).transpose())
-            print("RMS error for calibration with device number", k, "is :", rmsd_value, "m")
-            transformations[k] = transformation
+    return graph, calibration
 
-    return transformations
+
+def calculate_relative_transformations(aruco_data: dict, base_camera: str) -> Dict[str, np.array]:
+    _, calibration = calibrate_observation_graph(aruco_data, base_camera)
+    return {k: v['pose'] for k, v in calibration['cameras'].items()}
 
 
 def calculate_absolute_transformations(reference_points: Iterable[Tuple[int, Tuple[float, float, float]]]) -> np.array:
@@ -140,33 +452,59 @@ def calculate_absolute_transformations(reference_points: Iterable[Tuple[int, Tup
 
     src_points = np.array([src_x, src_z, src_center])
     dst_points = np.array([dst_x, dst_z, dst_center])
-    transformation, rmsd_value = calculate_transformation_kabsch(src_points.transpose(), dst_points.transpose())
-    print("RMS error for calibration to real world system is :", rmsd_value, "m")
-
+    transformation, _ = calculate_transformation_kabsch(src_points.transpose(), dst_points.transpose())
     return transformation
 
 
-def generate_extrinsics(aruco_data: dict) -> dict:
-    base_camera = define_base_camera(aruco_data)
-    base_camera_reference_points = zip(aruco_data[base_camera]['aruco'], aruco_data[base_camera]['centers'])
-    relative_transformations = calculate_relative_transformations(aruco_data, base_camera)
-    absolute_transformation = calculate_absolute_transformations(base_camera_reference_points)
+def generate_extrinsics_with_report(aruco_data: dict, threshold: float = 0.02, iterations: int = 200,
+                                    refinement_iterations: int = 10) -> Tuple[dict, dict]:
+    """Returns the extrinsics of each camera and a report with the connectivity of the camera graph, the spanning tree
+    and the markers, inliers, outliers, residuals in m and RMS error of each camera"""
+    graph, calibration = calibrate_observation_graph(aruco_data, threshold=threshold, iterations=iterations,
+                                                 refinement_iterations=refinement_iterations)
+    # The bottom markers may be detected by different cameras, since their positions are known for the whole graph
+    absolute_transformation = calculate_absolute_transformations(calibration['marker_positions'].items())
     final_transformations = {}
-    for k, v in relative_transformations.items():
-        final_transformations[k] = np.dot(absolute_transformation, v)
-    # final_transformations = calculate_absolute_transformations(relative_transformations, aruco_data, base_camera)
+    for k, v in calibration['cameras'].items():
+        final_transformations[k] = np.dot(absolute_transformation, v['pose'])
+
+    report = {
+        'base_camera': calibration['base_camera'],
+        'inlier_threshold': threshold,
+        'refinement_iterations': calibration['refinement_iterations'],
+        'connectivity': describe_connectivity(graph),
+        'cameras': {k: {key: value for key, value in v.items() if key != 'pose'}
+                    for k, v in calibration['cameras'].items()}
+    }
+    return final_transformations, report
+
 
-    return final_transformations
+def generate_extrinsics(aruco_data: dict) -> dict:
+    return generate_extrinsics_with_report(aruco_data)[0]
 
 
 def main():
-    """Creates a camera setup file containing camera ids and extrinsic information as 4 x 4 matrix"""
+    """Creates a camera setup file containing camera ids and extrinsic information as 4 x 4 matrix and a calibration
+    report with the residuals of each camera"""
     args = parse_args()
     aruco_data = read_aruco_data(args.data_dir)
-    final_transformations = generate_extrinsics(aruco_data)
+    connectivity = analyze_observation_graph(aruco_data)
+    print(f'{connectivity["cameras"]} cameras detected {connectivity["markers"]} markers, '
+          f'{len(connectivity["edges"])} camera pairs share at least {MIN_SHARED_MARKERS} markers')
+    if len(connectivity['components']) > 1:
+        print(f'The cameras form {len(connectivity["components"])} separate groups: {connectivity["components"]}. '
+              f'Place additional targets that are visible to cameras of different groups.')
+        sys.exit(1)
+    final_transformations, report = generate_extrinsics_with_report(aruco_data, args.inlier_threshold,
+                                                                    args.ransac_iterations,
+                                                                    args.refinement_iterations)
+    for k, v in report['cameras'].items():
+        print(f'RMS error for calibration with device number {k} is: {v["rmsd"]} m, '
+              f'{len(v["inliers"])} inliers, outliers: {v["outliers"]}, chained via {v["parent"]}')
     for k, v in final_transformations.items():
         final_transformations[k] = v.tolist()
     dump_dict_as_json(final_transformations, os.path.join(args.data_dir, 'camera_array.json'))
+    dump_dict_as_json(report, os.path.join(args.data_dir, 'calibration_report.json'))
 
 
 if __name__ == '__main__':
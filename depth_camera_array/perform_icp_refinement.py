@@ -0,0 +1,95 @@
+import argparse
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from depth_camera_array.camera import Camera, initialize_connected_cameras, close_connected_cameras
+from depth_camera_array.camera_array import CameraArray, capture_frame_sets
+from depth_camera_array.capture_profiles import CALIBRATION, add_rig_config_argument, load_rig_config
+from depth_camera_array.registration import refine_extrinsics
+from depth_camera_array.utilities import create_if_not_exists, dump_dict_as_json, load_json_to_dict, DEFAULT_DATA_DIR
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser('Refines the extrinsic calibration by registering the point clouds of all cameras')
+    parser.add_argument('--data_dir', type=lambda item: create_if_not_exists(item), default=DEFAULT_DATA_DIR,
+                        help='Data location of camera_array.json and calibration_report.json, which are updated')
+    parser.add_argument('--recording_dir', type=str, default=None,
+                        help='If set, the recording in this directory is replayed instead of using connected devices')
+    add_rig_config_argument(parser)
+    parser.add_argument('--warmup_frames', type=int, default=0,
+                        help='Number of frames discarded after starting each device, e.g. to let auto exposure settle')
+    parser.add_argument('--frame_count', type=int, default=1,
+                        help='Number of frame sets whose point clouds are combined, which averages the depth noise')
+    parser.add_argument('--min_depth', type=float, default=0.,
+                        help='Points closer to their camera in m are not registered')
+    parser.add_argument('--max_depth', type=float, default=4.,
+                        help='Points farther from their camera in m are not registered, since their noise is larger')
+    parser.add_argument('--voxel_sizes', type=float, nargs='+', default=[0.04, 0.02, 0.01],
+                        help='Voxel sizes in m from coarse to fine at which the point clouds are registered. The '
+                             'coarsest one should exceed the remaining error of the marker calibration')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='Maximum number of iterations per voxel size')
+    parser.add_argument('--max_samples', type=int, default=5000,
+                        help='Maximum number of points per camera that are paired with the other cameras')
+    parser.add_argument('--base_camera', type=str, default=None,
+                        help='Camera whose extrinsic is kept. Defaults to the base camera of calibration_report.json')
+    return parser.parse_args()
+
+
+def capture_point_clouds(cameras: List[Camera], frame_count: int = 1, min_depth: float = 0.,
+                         max_depth: Optional[float] = None, drop_frames: bool = True) -> Dict[str, np.ndarray]:
+    """Returns the combined points of frame_count synchronized frame sets in camera coordinates of each camera, limited
+    to the depth range in m"""
+    point_clouds = {camera.device_id: [] for camera in cameras}
+    cameras_by_id = {camera.device_id: camera for camera in cameras}
+    with CameraArray(cameras, drop_frames=drop_frames) as camera_array:
+        for frame_set in capture_frame_sets(camera_array, frame_count):
+            for device_id, frames in frame_set.items():
+                points = cameras_by_id[device_id].depth_frame_to_object_points(frames, remove_zero_depth=True)
+                in_range = points[:, 2] >= min_depth
+                if max_depth is not None:
+                    in_range &= points[:, 2] <= max_depth
+                point_clouds[device_id].append(points[in_range])
+    return {device_id: np.concatenate(points).astype(np.float32) for device_id, points in point_clouds.items()}
+
+
+def main():
+    """Registers the point clouds of all cameras, starting from the marker calibration, and writes the refined
+    extrinsics to camera_array.json and the residuals of each camera pair to calibration_report.json"""
+    args = parse_args()
+    camera_array_path = os.path.join(args.data_dir, 'camera_array.json')
+    report_path = os.path.join(args.data_dir, 'calibration_report.json')
+    dictionary = load_json_to_dict(camera_array_path)
+    calibration_report = load_json_to_dict(report_path) if os.path.exists(report_path) else {}
+
+    cameras = initialize_connected_cameras(args.recording_dir, warmup_frames=args.warmup_frames,
+                                           rig_config=load_rig_config(args.data_dir, args.rig_config),
+                                           purpose=CALIBRATION)
+    try:
+        point_clouds = capture_point_clouds(cameras, args.frame_count, args.min_depth, args.max_depth,
+                                            drop_frames=args.recording_dir is None)
+    finally:
+        close_connected_cameras(cameras)
+    extrinsics = {device_id: np.array(dictionary[device_id]) for device_id in point_clouds}
+    base_camera = args.base_camera or calibration_report.get('base_camera')
+    registration = refine_extrinsics(point_clouds, extrinsics, args.voxel_sizes, args.iterations,
+                                     base_camera if base_camera in point_clouds else None, args.max_samples)
+
+    for pair in registration.report['pairs']:
+        print(f'RMS point to plane distance between {pair["cameras"][0]} and {pair["cameras"][1]} is: '
+              f'{pair["rmsd"]} m, {pair["correspondences"]} correspondences')
+    unregistered = [device_id for device_id, camera in registration.report['cameras'].items()
+                    if camera['correspondences'] == 0]
+    if unregistered:
+        print(f'{", ".join(unregistered)} do not overlap with any other camera and keep their extrinsics')
+    for device_id, extrinsic in registration.extrinsics.items():
+        dictionary[device_id] = extrinsic.tolist()
+    calibration_report['icp_refinement'] = registration.report
+    dump_dict_as_json(dictionary, camera_array_path)
+    dump_dict_as_json(calibration_report, report_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,30 @@
 import argparse
+import functools
 import os
+from typing import Callable, Dict, List
 
 import numpy as np
-from open3d import open3d as o3d
 
 from depth_camera_array import camera
-from depth_camera_array.utilities import load_json_to_dict, create_if_not_exists, dump_dict_as_json, DEFAULT_DATA_DIR
+from depth_camera_array.buffer_pool import BufferPool
+from depth_camera_array.camera_array import CameraArray, capture_frame_sets
+from depth_camera_array.capture_profiles import MEASUREMENT, add_rig_config_argument, load_rig_config
+from depth_camera_array.crop_volumes import CropVolume, MeasurementCylinder, AxisAlignedBox, transform_points
+from depth_camera_array.deprojection import depth_frame_to_depth_image
+from depth_camera_array.fusion import REDUCTIONS, CENTROID
+from depth_camera_array.incremental import ChangeDetection
+from depth_camera_array.instrumentation import Instrumentation, create_instrumentation, finish_instrumentation, \
+    DISABLED
+from depth_camera_array.measurement import OUTPUT_FORMATS, Measurement, MeasurementWriter, create_analytics, \
+    create_fusion, create_measurement_stages, deproject_frame_set, release_points, transform_and_crop_point_clouds
+from depth_camera_array.measurement_workers import MultiprocessMeasurement
+from depth_camera_array.pipeline import Pipeline, OVERFLOW_POLICIES, BLOCK
+from depth_camera_array.rig import CompiledRig
+from depth_camera_array.shared_frames import CaptureSource, find_capture_sources
+from depth_camera_array.point_cloud_io import write_mesh_ply, write_ply
+from depth_camera_array.utilities import load_json_to_dict, create_if_not_exists, DEFAULT_DATA_DIR
+
+TSDF_POINT_CLOUD_ID = 'tsdf'
 
 
 def parse_args() -> argparse.Namespace:
@@ -13,56 +32,303 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--bottom', type=float, default=0.0, help='Bottom of the measurement sphere in m')
     parser.add_argument('--height', type=float, default=1.8, help='Height of the measurement sphere in m')
     parser.add_argument('--radius', type=float, default=0.5, help='Radius of the measurement sphere in m')
+    parser.add_argument('--box', type=float, nargs=6, metavar=('MIN_X', 'MIN_Y', 'MIN_Z', 'MAX_X', 'MAX_Y', 'MAX_Z'),
+                        help='If set, an axis aligned box in m is used as measurement volume instead of the cylinder')
+    parser.add_argument('--min_depth', type=float, default=0.,
+                        help='Minimum valid depth in m. Closer readings are skipped')
+    parser.add_argument('--max_depth', type=float, default=None,
+                        help='Maximum valid depth in m. Farther readings are skipped')
+    parser.add_argument('--sync_tolerance', type=float, default=15.,
+                        help='Maximum difference in ms between the timestamps of frames captured by different cameras')
+    parser.add_argument('--output_formats', nargs='+', choices=OUTPUT_FORMATS, default=['npy', 'ply'],
+                        help='Formats of the measured point clouds: float32 .npy files, binary .ply files, one '
+                             'compressed measurement.dcapc container for all frames and cameras or the legacy '
+                             '..._object_points.json files')
+    parser.add_argument('--fuse', action='store_true',
+                        help='If set, the point clouds of all cameras are merged to one fused point cloud, in which '
+                             'points of the same voxel are combined')
+    parser.add_argument('--voxel_size', type=float, default=0.005, help='Edge length of the fusion voxels in m')
+    parser.add_argument('--fusion_reduction', choices=REDUCTIONS, default=CENTROID,
+                        help='Defines how the points of one voxel are combined')
+    parser.add_argument('--fusion_statistics', action='store_true',
+                        help='If set, the number of points and a bit mask of the contributing cameras are stored for '
+                             'each voxel of the fused point cloud as .npy files')
+    parser.add_argument('--fusion_memory_limit', type=float, default=None,
+                        help='Maximum memory in MB used for the fusion. Larger point clouds are fused in slabs')
+    parser.add_argument('--analytics', action='store_true',
+                        help='If set, the height above the bottom, bounding boxes, volumes and cross-sections of the '
+                             'measured points are written as analytics.json for each measurement')
+    parser.add_argument('--section_heights', type=float, nargs='+', default=[],
+                        help='Heights above the bottom in m at which cross-sections are summarized by the analytics')
+    parser.add_argument('--reference', type=str, default=None,
+                        help='Point cloud (.npy or .ply) of a reference capture. If set, the analytics summarize the '
+                             'distances of the measured points to their nearest neighbours in the reference')
+    parser.add_argument('--tsdf', action='store_true',
+                        help='If set, frame_count frame sets are fused into a truncated signed distance field with the '
+                             'voxel size, whose surface is written as tsdf point cloud and tsdf_mesh.ply')
+    parser.add_argument('--truncation', type=float, default=None,
+                        help='Truncation distance of the signed distance field in m. Defaults to 4 voxels')
+    parser.add_argument('--stream', action='store_true',
+                        help='If set, the scene is measured continuously and the point clouds of each frame are '
+                             'written to data_dir')
+    parser.add_argument('--frame_count', type=int, default=0,
+                        help='Number of frames to measure in stream mode. If not set, the stream runs until it is '
+                             'interrupted')
+    parser.add_argument('--incremental', action='store_true',
+                        help='If set in stream mode, each depth image is compared tile by tile with the last processed '
+                             'one and only the changed tiles are deprojected and cropped again. The changed tiles are '
+                             'written as <device_id>_changed_tiles_<frame>.npy masks')
+    parser.add_argument('--tile_size', type=int, default=16,
+                        help='Edge length in pixels of the tiles compared in incremental mode')
+    parser.add_argument('--buffer_size', type=int, default=2,
+                        help='Number of frames that can be buffered in front of each stage in stream mode')
+    parser.add_argument('--overflow_policy', choices=OVERFLOW_POLICIES, default=BLOCK,
+                        help='Defines what happens if a stage falls behind in stream mode: The preceding stage either '
+                             'blocks or the oldest or newest frame in the buffer is dropped')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='If set in stream mode, each camera is captured by its own process into a shared memory '
+                             'ring buffer and the frame sets are processed by this number of worker processes')
+    parser.add_argument('--ring_size', type=int, default=8,
+                        help='Number of frames each shared memory ring buffer can hold. If a ring is full, the '
+                             'overflow policy decides whether the capture process waits, skips the new frame or '
+                             'overwrites the oldest one')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='If set, the cameras are kept running and measurement requests are served on this Unix '
+                             'socket until the script is interrupted')
+    parser.add_argument('--max_queued_jobs', type=int, default=64,
+                        help='Maximum number of measurement requests waiting to be served by the socket, further '
+                             'requests are rejected')
+    parser.add_argument('--recording_dir', type=str, default=None,
+                        help='If set, the recording in this directory is replayed instead of using connected devices')
+    parser.add_argument('--realtime', action='store_true',
+                        help='If set, a recording is replayed at the recorded frame rate instead of as fast as '
+                             'possible')
+    add_rig_config_argument(parser)
+    parser.add_argument('--warmup_frames', type=int, default=0,
+                        help='Number of frames discarded after starting each device, e.g. to let auto exposure settle')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='If set, runtime metrics of each stage and camera are written to this file, as JSON if it '
+                             'ends with .json, otherwise as Prometheus text file')
+    parser.add_argument('--metrics_interval', type=float, default=0.,
+                        help='Interval in s in which the metrics file is updated. If not set, it is written at the end')
+    parser.add_argument('--rig_dir', type=str, default=None,
+                        help='Location of the compiled world ray tables and pixel masks of the cameras. They are '
+                             'compiled from the calibration and the crop volume on the first frame and reused as long '
+                             'as calibration, crop volume and stream modes do not change. Defaults to <data_dir>/rig')
     parser.add_argument('--data_dir', type=lambda item: create_if_not_exists(item), default=DEFAULT_DATA_DIR,
                         help='Data location to load and dump config files', )
     return parser.parse_args()
 
 
-def is_in_measurement_cylinder(point: np.array, bottom: float, height: float, radius: float) -> bool:
-    is_beside_cylinder = np.linalg.norm([point[0], point[2]]) > radius
-    is_above_cylinder = point[1] > (bottom + height)
-    is_below_cylinder = point[1] < bottom
-    return not (is_beside_cylinder or is_above_cylinder or is_below_cylinder)
+def create_crop_volume(args: argparse.Namespace) -> CropVolume:
+    if args.box is not None:
+        return AxisAlignedBox(args.box[:3], args.box[3:])
+    return MeasurementCylinder(args.bottom, args.height, args.radius)
 
 
 def remove_unnecessary_content(object_points, bottom: float, height: float, radius: float) -> np.array:
     """Removes points outside the defined measurement cylinder"""
-    filtered_points = []
-    for item in object_points:
-        if is_in_measurement_cylinder(item, bottom, height, radius):
-            filtered_points.append(item.tolist())
-    return filtered_points
+    object_points = np.asarray(object_points, dtype=np.float32)
+    return object_points[MeasurementCylinder(bottom, height, radius).contains(object_points)]
 
 
 def apply_transformation(object_points: np.array, extrinsic: np.array) -> np.array:
-    tmp = object_points.transpose()
-    points = np.ones((4, tmp.shape[1],))
-    points[:-1, :] = tmp
-    transformed = extrinsic.dot(points)
-    return transformed[:-1, :].transpose()
+    return transform_points(object_points, extrinsic)
 
 
 def dump_to_ply(object_points: np.array, data_dir: str, camera_id: str):
-    points = np.array(object_points)
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(points)
-    o3d.io.write_point_cloud(os.path.join(data_dir, f'{camera_id}.ply'), pcd)
+    write_ply(object_points, os.path.join(data_dir, f'{camera_id}.ply'))
+
+
+def create_fusion_from_args(args: argparse.Namespace,
+                            instrumentation: Instrumentation = DISABLED) -> Callable[[Measurement], Measurement]:
+    """Returns a function that fuses the point clouds of a measurement as configured by the fusion arguments"""
+    memory_limit = None if args.fusion_memory_limit is None else int(args.fusion_memory_limit * 1024 ** 2)
+    return create_fusion(args.voxel_size, args.fusion_reduction, args.fusion_statistics, memory_limit, instrumentation)
+
+
+def create_analytics_from_args(args: argparse.Namespace,
+                               instrumentation: Instrumentation = DISABLED) -> Callable[[Measurement], Measurement]:
+    """Returns a function that adds the analytics summary of a measurement as configured by the analytics arguments.
+    The bottom of the crop volume is the reference height of the sections"""
+    bottom = args.box[1] if args.box is not None else args.bottom
+    return create_analytics(args.voxel_size, bottom, args.section_heights, args.reference, instrumentation)
+
+
+def measure_stream(args: argparse.Namespace, cameras: List[camera.Camera], extrinsics: Dict[str, np.ndarray],
+                   crop_volume: CropVolume, instrumentation: Instrumentation = DISABLED, rig: CompiledRig = None):
+    # The point clouds of each frame set are processed in buffers that are reused for later frame sets
+    pool = BufferPool(instrumentation)
+    try:
+        with CameraArray(cameras, queue_size=args.buffer_size, tolerance=args.sync_tolerance,
+                         drop_frames=args.recording_dir is None or args.realtime,
+                         instrumentation=instrumentation) as camera_array, \
+                MeasurementWriter(args.data_dir, args.output_formats, stream=True,
+                                  instrumentation=instrumentation) as writer:
+
+            def write_and_release(measurement: Measurement):
+                writer(measurement)
+                release_points(pool, measurement.points.values())
+
+            pipeline = Pipeline(
+                source=capture_frame_sets(camera_array, args.frame_count),
+                stages=create_measurement_stages(
+                    cameras, extrinsics, crop_volume, args.buffer_size, args.overflow_policy,
+                    create_fusion_from_args(args, instrumentation) if args.fuse else None, instrumentation, rig,
+                    ChangeDetection(args.tile_size) if args.incremental else None,
+                    create_analytics_from_args(args, instrumentation) if args.analytics else None, pool),
+                sink=write_and_release,
+                sink_buffer_size=args.buffer_size,
+                sink_policy=args.overflow_policy
+            )
+            pipeline.run()
+    finally:
+        pool.close()
+    for stage, statistics in pipeline.get_statistics().items():
+        print(f'{stage}: {statistics["processed"]} frames, {statistics["throughput"]:.1f} fps, '
+              f'{statistics["dropped"]} dropped')
+
+
+def measure_once(args: argparse.Namespace, cameras: List[camera.Camera], extrinsics: Dict[str, np.ndarray],
+                 crop_volume: CropVolume, instrumentation: Instrumentation = DISABLED, rig: CompiledRig = None):
+    with CameraArray(cameras, tolerance=args.sync_tolerance, drop_frames=args.recording_dir is None or args.realtime,
+                     instrumentation=instrumentation) as camera_array:
+        frame_set = camera_array.wait_for_frames()
+    object_points = deproject_frame_set({cam.device_id: cam for cam in cameras}, frame_set, instrumentation, rig)
+    measurement = Measurement(
+        frame_number=0,
+        timestamp=min(frames.get_timestamp() for frames in frame_set.values()),
+        points=transform_and_crop_point_clouds(object_points, None if rig is not None else extrinsics, crop_volume,
+                                               instrumentation)
+    )
+    if args.fuse:
+        measurement = create_fusion_from_args(args, instrumentation)(measurement)
+    if args.analytics:
+        measurement = create_analytics_from_args(args, instrumentation)(measurement)
+    with MeasurementWriter(args.data_dir, args.output_formats, instrumentation=instrumentation) as writer:
+        writer(measurement)
+
+
+def measure_tsdf(args: argparse.Namespace, cameras: List[camera.Camera], extrinsics: Dict[str, np.ndarray],
+                 crop_volume: CropVolume, instrumentation: Instrumentation = DISABLED, rig: CompiledRig = None):
+    """Fuses args.frame_count frame sets, or all until interrupted if not set, into a truncated signed distance field
+    within the crop volume and writes its surface"""
+    from depth_camera_array.tsdf import TsdfVolume
+    rig = rig or CompiledRig(os.path.join(args.data_dir, 'rig'), extrinsics)
+    volume = TsdfVolume(args.voxel_size, args.truncation, crop_volume=crop_volume)
+    cameras = {cam.device_id: cam for cam in cameras}
+    timestamp = 0.
+    with CameraArray(list(cameras.values()), tolerance=args.sync_tolerance,
+                     drop_frames=args.recording_dir is None or args.realtime,
+                     instrumentation=instrumentation) as camera_array:
+        try:
+            for frame_set in capture_frame_sets(camera_array, args.frame_count):
+                timestamp = min(frames.get_timestamp() for frames in frame_set.values())
+                for device_id, frames in frame_set.items():
+                    depth_frame = frames.get_depth_frame()
+                    intrinsics = depth_frame.get_profile().as_video_stream_profile().get_intrinsics()
+                    depth_scale = cameras[device_id].depth_scale
+                    depth_image = depth_frame_to_depth_image(depth_frame)
+                    if args.min_depth > 0 or args.max_depth is not None:
+                        depth = depth_image * depth_scale
+                        outside = depth < args.min_depth
+                        if args.max_depth is not None:
+                            outside |= depth > args.max_depth
+                        depth_image = np.where(outside, 0, depth_image).astype(np.uint16)
+                    with instrumentation.measure('integrate', device_id):
+                        volume.integrate(depth_image, rig.get_table(device_id, intrinsics, depth_scale), intrinsics,
+                                         depth_scale, extrinsics[device_id])
+        except KeyboardInterrupt:
+            pass
+    with instrumentation.measure('extract_surface'):
+        points = volume.extract_points()
+        mesh = volume.extract_mesh()
+    with MeasurementWriter(args.data_dir, args.output_formats, instrumentation=instrumentation) as writer:
+        writer(Measurement(frame_number=0, timestamp=timestamp, points={TSDF_POINT_CLOUD_ID: points}))
+    write_mesh_ply(mesh.vertices, mesh.faces, os.path.join(args.data_dir, f'{TSDF_POINT_CLOUD_ID}_mesh.ply'))
+    print(f'{volume.integrated_frames} depth images fused into {volume.block_count} blocks '
+          f'({volume.memory_bytes / 1024 ** 2:.1f} MB), {len(points)} surface points, {len(mesh.faces)} faces')
+
+
+def serve_measurements(args: argparse.Namespace, cameras: List[camera.Camera], extrinsics: Dict[str, np.ndarray],
+                       crop_volume: CropVolume, instrumentation: Instrumentation = DISABLED, rig: CompiledRig = None):
+    """Serves snapshot, burst and subscribe requests on args.socket with warm cameras until interrupted"""
+    import asyncio
+    from depth_camera_array.measurement_daemon import MeasurementService
+    service = MeasurementService(
+        cameras, extrinsics, crop_volume, args.data_dir, args.output_formats, rig,
+        fuse=create_fusion_from_args(args, instrumentation),
+        fuse_by_default=args.fuse,
+        analyze=create_analytics_from_args(args, instrumentation),
+        analyze_by_default=args.analytics, sync_tolerance=args.sync_tolerance, max_queued_jobs=args.max_queued_jobs,
+        instrumentation=instrumentation
+    )
+    try:
+        asyncio.run(service.serve(args.socket, ready=lambda: print(f'Serving measurements on {args.socket}')))
+    except KeyboardInterrupt:
+        pass
+    print(f'{service.measured_frames} frame sets measured, {service.timed_out_jobs} jobs timed out')
+
+
+def measure_multiprocess(args: argparse.Namespace, sources: Dict[str, CaptureSource],
+                         extrinsics: Dict[str, np.ndarray], crop_volume: CropVolume, rig: CompiledRig,
+                         instrumentation: Instrumentation = DISABLED):
+    """Measures the scene continuously with one capture process per camera and args.workers worker processes"""
+    if args.incremental:
+        raise ValueError('Incremental processing compares consecutive frames and cannot be split across workers.')
+    measurement = MultiprocessMeasurement(
+        sources, extrinsics, crop_volume, rig, args.data_dir, args.output_formats, args.workers, args.ring_size,
+        args.overflow_policy, args.sync_tolerance,
+        functools.partial(create_fusion_from_args, args) if args.fuse else None,
+        functools.partial(create_analytics_from_args, args) if args.analytics else None, instrumentation)
+    try:
+        statistics = measurement.run(args.frame_count)
+    finally:
+        for device_id, ring_statistics in measurement.ring_statistics.items():
+            print(f'{device_id}: {", ".join(f"{value} {counter}" for counter, value in ring_statistics.items())} '
+                  f'frames')
+    print(f'{statistics["frame_sets"]} frame sets measured by {args.workers} workers, {statistics["overwritten"]} '
+          f'discarded since their frames were overwritten, {statistics["unmatched"]} unmatched frames')
 
 
 def main():
     args = parse_args()
     dictionary = load_json_to_dict(os.path.join(args.data_dir, 'camera_array.json'))
-    all_connected_cams = camera.initialize_connected_cameras()
-    for cam in all_connected_cams:
-        trans_matrix = np.array(dictionary[cam.device_id])
-        frames = cam.poll_frames()
-        object_points = cam.depth_frame_to_object_points(frames)
-        object_points = apply_transformation(object_points, np.array(trans_matrix))
-        object_points = remove_unnecessary_content(object_points, args.bottom, args.height, args.radius)
-        serial_points = np.array(object_points).transpose()
-        dump_dict_as_json({cam.device_id: serial_points.tolist()},
-                          os.path.join(args.data_dir, cam.device_id + '_object_points.json'))
-        dump_to_ply(object_points, args.data_dir, cam.device_id)
+    crop_volume = create_crop_volume(args)
+    rig_dir = args.rig_dir or os.path.join(args.data_dir, 'rig')
+    instrumentation = create_instrumentation(args.metrics, args.metrics_interval)
+    rig_config = load_rig_config(args.data_dir, args.rig_config)
+    if args.stream and args.workers > 0:
+        # The devices are opened by the capture processes
+        sources = find_capture_sources(args.recording_dir, args.realtime, args.warmup_frames, rig_config)
+        extrinsics = {device_id: np.array(dictionary[device_id]) for device_id in sources}
+        rig = CompiledRig(rig_dir, extrinsics, crop_volume, (args.min_depth, args.max_depth))
+        try:
+            measure_multiprocess(args, sources, extrinsics, crop_volume, rig, instrumentation)
+        finally:
+            finish_instrumentation(instrumentation, args.metrics)
+        return
+
+    all_connected_cams = camera.initialize_connected_cameras(args.recording_dir, args.realtime, args.warmup_frames,
+                                                             rig_config, MEASUREMENT)
+    extrinsics = {cam.device_id: np.array(dictionary[cam.device_id]) for cam in all_connected_cams}
+    rig = CompiledRig(rig_dir, extrinsics, crop_volume, (args.min_depth, args.max_depth))
+    try:
+        if args.socket is not None:
+            serve_measurements(args, all_connected_cams, extrinsics, crop_volume, instrumentation, rig)
+        elif args.tsdf:
+            measure_tsdf(args, all_connected_cams, extrinsics, crop_volume, instrumentation, rig)
+        elif args.stream:
+            measure_stream(args, all_connected_cams, extrinsics, crop_volume, instrumentation, rig)
+        else:
+            measure_once(args, all_connected_cams, extrinsics, crop_volume, instrumentation, rig)
+    finally:
+        finish_instrumentation(instrumentation, args.metrics)
+        camera.close_connected_cameras(all_connected_cams)
+    if rig.compiled:
+        print(f'Compiled the world ray tables of {", ".join(rig.compiled)} to {rig.rig_dir}')
+    if rig.compiled_masks:
+        print(f'Compiled the pixel masks of {", ".join(rig.compiled_masks)} to {rig.rig_dir}')
 
 
 if __name__ == '__main__':
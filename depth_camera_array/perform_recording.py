@@ -0,0 +1,38 @@
+import argparse
+import os
+
+from depth_camera_array.camera import initialize_connected_cameras, close_connected_cameras
+from depth_camera_array.capture_profiles import RECORDING, add_rig_config_argument, load_rig_config
+from depth_camera_array.recording import record_frame_sets
+from depth_camera_array.utilities import create_if_not_exists, DEFAULT_DATA_DIR
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser('Records the raw frames of all connected cameras for later replay')
+    parser.add_argument('--data_dir', type=lambda item: create_if_not_exists(item), default=DEFAULT_DATA_DIR,
+                        help='Data location to load and dump config files')
+    parser.add_argument('--recording_dir', type=str, default=None,
+                        help='Directory the recording is stored to. If not set, <data_dir>/recording is used')
+    parser.add_argument('--frame_count', type=int, default=30, help='Number of frames to record per camera')
+    parser.add_argument('--sync_tolerance', type=float, default=15.,
+                        help='Maximum difference in ms between the timestamps of frames captured by different cameras')
+    parser.add_argument('--warmup_frames', type=int, default=0,
+                        help='Number of frames discarded after starting each device, e.g. to let auto exposure settle')
+    add_rig_config_argument(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    recording_dir = args.recording_dir or os.path.join(args.data_dir, 'recording')
+    cameras = initialize_connected_cameras(warmup_frames=args.warmup_frames,
+                                           rig_config=load_rig_config(args.data_dir, args.rig_config),
+                                           purpose=RECORDING)
+    try:
+        record_frame_sets(cameras, create_if_not_exists(recording_dir), args.frame_count, args.sync_tolerance)
+    finally:
+        close_connected_cameras(cameras)
+
+
+if __name__ == '__main__':
+    main()
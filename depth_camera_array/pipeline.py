@@ -0,0 +1,235 @@
+import collections
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+OVERFLOW_POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+_END_OF_STREAM = object()
+
+
+class BoundedBuffer:
+    """Thread safe FIFO buffer between two pipeline stages.
+
+    If the buffer is full, put either blocks until the consumer caught up, drops the oldest buffered item or drops the
+    new item, depending on the overflow policy. Iterating over the buffer yields items until it is closed and empty.
+    """
+
+    def __init__(self, size: int, policy: str = BLOCK):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {policy}. Use one of {OVERFLOW_POLICIES}.')
+        self.size = size
+        self.policy = policy
+        self.dropped = 0
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, item: Any):
+        with self._condition:
+            if self.policy == BLOCK:
+                while len(self._items) >= self.size and not self._closed:
+                    self._condition.wait()
+            elif len(self._items) >= self.size:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return
+                self._items.popleft()
+            if self._closed:
+                return
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def get(self) -> Any:
+        """Returns the next item or _END_OF_STREAM if the buffer is closed and empty"""
+        with self._condition:
+            while not self._items and not self._closed:
+                self._condition.wait()
+            if not self._items:
+                return _END_OF_STREAM
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def close(self, discard: bool = False):
+        """Marks the end of the stream. Already buffered items are still delivered unless discard is set"""
+        with self._condition:
+            self._closed = True
+            if discard:
+                self._items.clear()
+            self._condition.notify_all()
+
+    def __iter__(self) -> Iterator[Any]:
+        while True:
+            item = self.get()
+            if item is _END_OF_STREAM:
+                return
+            yield item
+
+
+class StageStatistics:
+    def __init__(self):
+        self.processed = 0
+        self._start_time = None
+        self._last_time = None
+
+    def count(self):
+        now = time.monotonic()
+        if self._start_time is None:
+            self._start_time = now
+        self._last_time = now
+        self.processed += 1
+
+    @property
+    def throughput(self) -> float:
+        """Processed items per second"""
+        if self._start_time is None or self._last_time == self._start_time:
+            return 0.
+        return (self.processed - 1) / (self._last_time - self._start_time)
+
+
+class Stage:
+    """Pipeline stage that turns an iterator of input items into an iterator of output items.
+
+    The function is typically a generator function. buffer_size and policy configure the buffer in front of the stage.
+    """
+
+    def __init__(self, name: str, function: Callable[[Iterator[Any]], Iterator[Any]], buffer_size: int = 2,
+                 policy: str = BLOCK):
+        self.name = name
+        self.function = function
+        self.buffer_size = buffer_size
+        self.policy = policy
+
+
+def map_stage(name: str, function: Callable[[Any], Any], buffer_size: int = 2, policy: str = BLOCK) -> Stage:
+    """Creates a stage that applies the function to each item"""
+
+    def generator(items: Iterator[Any]) -> Iterator[Any]:
+        for item in items:
+            yield function(item)
+
+    return Stage(name, generator, buffer_size, policy)
+
+
+class Pipeline:
+    """Runs a source, a sequence of stages and a sink, each in its own thread, connected by bounded buffers"""
+
+    def __init__(self, source: Iterable[Any], stages: List[Stage], sink: Callable[[Any], None],
+                 sink_buffer_size: int = 2, sink_policy: str = BLOCK):
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self._buffers = [BoundedBuffer(stage.buffer_size, stage.policy) for stage in stages]
+        self._buffers.append(BoundedBuffer(sink_buffer_size, sink_policy))
+        self._statistics = collections.OrderedDict(
+            [('source', StageStatistics())] + [(stage.name, StageStatistics()) for stage in stages] +
+            [('sink', StageStatistics())])
+        self._stopped = threading.Event()
+        self._error = None
+
+    def stop(self):
+        """Stops reading from the source. Items that are already in the pipeline are still processed"""
+        self._stopped.set()
+
+    def _abort(self, error: BaseException):
+        if self._error is None:
+            self._error = error
+        self._stopped.set()
+        for buffer in self._buffers:
+            buffer.close(discard=True)
+
+    def _run_source(self):
+        statistics = self._statistics['source']
+        try:
+            for item in self.source:
+                if self._stopped.is_set():
+                    break
+                statistics.count()
+                self._buffers[0].put(item)
+        except Exception as error:
+            self._abort(error)
+        finally:
+            self._buffers[0].close()
+
+    def _run_stage(self, index: int):
+        stage = self.stages[index]
+        statistics = self._statistics[stage.name]
+        try:
+            for item in stage.function(iter(self._buffers[index])):
+                statistics.count()
+                self._buffers[index + 1].put(item)
+        except Exception as error:
+            self._abort(error)
+        finally:
+            self._buffers[index + 1].close()
+
+    def _run_sink(self):
+        statistics = self._statistics['sink']
+        try:
+            for item in self._buffers[-1]:
+                self.sink(item)
+                statistics.count()
+        except Exception as error:
+            self._abort(error)
+
+    def run(self):
+        """Processes items until the source is exhausted or the pipeline is stopped. Reraises the first error of any
+        stage"""
+        threads = [threading.Thread(target=self._run_source, name='source', daemon=True)]
+        threads += [threading.Thread(target=self._run_stage, args=(index,), name=stage.name, daemon=True)
+                    for index, stage in enumerate(self.stages)]
+        threads.append(threading.Thread(target=self._run_sink, name='sink', daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.1)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def get_statistics(self) -> Dict[str, Dict[str, float]]:
+        """Returns the number of processed items, the throughput in items per second and the number of dropped items
+        for each stage"""
+        dropped = [0] + [buffer.dropped for buffer in self._buffers]
+        return {
+            name: {'processed': statistics.processed, 'throughput': statistics.throughput, 'dropped': dropped[index]}
+            for index, (name, statistics) in enumerate(self._statistics.items())
+        }
+
+
+class RingSink:
+    """Keeps the latest items in memory"""
+
+    def __init__(self, size: int):
+        self.items = collections.deque(maxlen=size)
+
+    def __call__(self, item: Any):
+        self.items.append(item)
+
+
+class CallbackSink:
+    def __init__(self, callback: Callable[[Any], None]):
+        self.callback = callback
+
+    def __call__(self, item: Any):
+        self.callback(item)
+
+
+class FileSink:
+    """Writes each item to files by use of a write function that gets the item and the data directory"""
+
+    def __init__(self, data_dir: str, write: Callable[[Any, str], None]):
+        self.data_dir = data_dir
+        self.write = write
+
+    def __call__(self, item: Any):
+        self.write(item, self.data_dir)
@@ -0,0 +1,175 @@
+import json
+import struct
+import zlib
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from depth_camera_array.utilities import dump_dict_as_json
+
+POINT_DTYPE = np.dtype('<f4')
+
+CONTAINER_MAGIC = b'DCAPC\x00\x01\x00'
+CONTAINER_HEADER = struct.Struct('<8sQ')
+
+
+def write_npy(points: np.ndarray, path: str):
+    """Writes (N, 3) points as float32 .npy file that can be memory mapped by load_npy"""
+    np.save(path, np.ascontiguousarray(points, dtype=POINT_DTYPE))
+
+
+def load_npy(path: str, memory_map: bool = True) -> np.ndarray:
+    return np.load(path, mmap_mode='r' if memory_map else None)
+
+
+def _ply_header(point_count: int, face_count: int = None) -> bytes:
+    faces = '' if face_count is None else f'element face {face_count}\nproperty list uchar int vertex_indices\n'
+    return ('ply\n'
+            'format binary_little_endian 1.0\n'
+            f'element vertex {point_count}\n'
+            'property float x\n'
+            'property float y\n'
+            'property float z\n'
+            f'{faces}'
+            'end_header\n').encode('ascii')
+
+
+def write_ply(points: np.ndarray, path: str):
+    """Writes (N, 3) points as binary little endian PLY file without converting them to another type first, if they
+    are float32 already"""
+    points = np.ascontiguousarray(points, dtype=POINT_DTYPE).reshape(-1, 3)
+    with open(path, 'wb') as f:
+        f.write(_ply_header(points.shape[0]))
+        points.tofile(f)
+
+
+def write_mesh_ply(vertices: np.ndarray, faces: np.ndarray, path: str):
+    """Writes a triangle mesh of (N, 3) vertices and (M, 3) vertex indices as binary little endian PLY file"""
+    vertices = np.ascontiguousarray(vertices, dtype=POINT_DTYPE).reshape(-1, 3)
+    records = np.empty(faces.shape[0], dtype=[('count', 'u1'), ('indices', '<i4', (3,))])
+    records['count'] = 3
+    records['indices'] = faces
+    with open(path, 'wb') as f:
+        f.write(_ply_header(vertices.shape[0], records.shape[0]))
+        vertices.tofile(f)
+        records.tofile(f)
+
+
+def load_ply(path: str, memory_map: bool = True) -> np.ndarray:
+    """Loads the points of a binary little endian PLY file that contains float x, y and z vertex properties only"""
+    with open(path, 'rb') as f:
+        if f.readline() != b'ply\n' or f.readline() != b'format binary_little_endian 1.0\n':
+            raise ValueError(f'{path} is no binary little endian PLY file.')
+        point_count = None
+        properties = []
+        for line in iter(f.readline, b''):
+            words = line.decode('ascii').split()
+            if words[0] == 'element' and words[1] == 'vertex':
+                point_count = int(words[2])
+            elif words[0] == 'property':
+                properties.append((words[1], words[2]))
+            elif words[0] == 'end_header':
+                break
+        offset = f.tell()
+    if point_count is None or properties != [('float', 'x'), ('float', 'y'), ('float', 'z')]:
+        raise ValueError(f'{path} does not contain float x, y, z vertices only.')
+    if memory_map:
+        return np.memmap(path, dtype=POINT_DTYPE, mode='r', offset=offset, shape=(point_count, 3))
+    return np.fromfile(path, dtype=POINT_DTYPE, offset=offset).reshape(point_count, 3)
+
+
+class PointCloudContainerWriter:
+    """Writes point clouds of many frames and cameras to one file.
+
+    Each point cloud is split into chunks of at most chunk_size points, which are zlib compressed separately. The
+    file starts with a header that holds the offset of a JSON index at its end. The index lists the chunks of each
+    frame and camera, which allows to read single point clouds without scanning the whole file.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1 << 18, compression_level: int = 1):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self._index = []
+        self._file: BinaryIO = open(path, 'wb')
+        self._file.write(CONTAINER_HEADER.pack(CONTAINER_MAGIC, 0))
+
+    def __enter__(self) -> 'PointCloudContainerWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, frame_number: int, camera_id: str, points: np.ndarray, timestamp: float = 0.) -> int:
+        """Appends the points and returns the number of compressed bytes written"""
+        points = np.ascontiguousarray(points, dtype=POINT_DTYPE).reshape(-1, 3)
+        chunks = []
+        for start in range(0, max(points.shape[0], 1), self.chunk_size):
+            chunk = points[start:start + self.chunk_size]
+            data = zlib.compress(chunk.tobytes(), self.compression_level)
+            chunks.append([self._file.tell(), len(data), chunk.shape[0]])
+            self._file.write(data)
+        self._index.append({
+            'frame': frame_number,
+            'camera': camera_id,
+            'timestamp': timestamp,
+            'points': points.shape[0],
+            'chunks': chunks
+        })
+        return sum(chunk[1] for chunk in chunks)
+
+    def close(self):
+        if self._file.closed:
+            return
+        index_offset = self._file.tell()
+        self._file.write(json.dumps(self._index).encode('utf-8'))
+        self._file.seek(0)
+        self._file.write(CONTAINER_HEADER.pack(CONTAINER_MAGIC, index_offset))
+        self._file.close()
+
+
+class PointCloudContainerReader:
+    def __init__(self, path: str):
+        self.path = path
+        self._file: BinaryIO = open(path, 'rb')
+        magic, index_offset = CONTAINER_HEADER.unpack(self._file.read(CONTAINER_HEADER.size))
+        if magic != CONTAINER_MAGIC:
+            raise ValueError(f'{path} is no point cloud container.')
+        if index_offset == 0:
+            raise ValueError(f'{path} was not closed properly and has no index.')
+        self._file.seek(index_offset)
+        self.index: List[Dict] = json.loads(self._file.read().decode('utf-8'))
+        self._entries = {(entry['frame'], entry['camera']): entry for entry in self.index}
+
+    def __enter__(self) -> 'PointCloudContainerReader':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def keys(self) -> List[Tuple[int, str]]:
+        """Returns frame number and camera id of each point cloud in the order they were written"""
+        return [(entry['frame'], entry['camera']) for entry in self.index]
+
+    def read(self, frame_number: int, camera_id: str) -> np.ndarray:
+        entry = self._entries[(frame_number, camera_id)]
+        points = np.empty((entry['points'], 3), dtype=POINT_DTYPE)
+        position = 0
+        for offset, size, point_count in entry['chunks']:
+            self._file.seek(offset)
+            chunk = np.frombuffer(zlib.decompress(self._file.read(size)), dtype=POINT_DTYPE)
+            points[position:position + point_count] = chunk.reshape(-1, 3)
+            position += point_count
+        return points
+
+    def __iter__(self) -> Iterator[Tuple[int, str, np.ndarray]]:
+        for frame_number, camera_id in self.keys():
+            yield frame_number, camera_id, self.read(frame_number, camera_id)
+
+
+def write_json(points: np.ndarray, path: str, camera_id: str):
+    """Writes points in the legacy JSON layout, which maps the camera id to lists of x, y and z coordinates"""
+    dump_dict_as_json({camera_id: np.asarray(points, dtype=float).reshape(-1, 3).transpose().tolist()}, path)
@@ -0,0 +1,194 @@
+import os
+import time
+from typing import List
+
+import numpy as np
+from pyrealsense2 import pyrealsense2 as rs
+
+from depth_camera_array.camera import Camera
+from depth_camera_array.camera_array import CameraArray
+from depth_camera_array.simulation import SimulatedFrame, SimulatedFrames, SimulatedVideoStreamProfile
+from depth_camera_array.utilities import dump_dict_as_json, load_json_to_dict
+
+METADATA_FILE = 'metadata.json'
+DEPTH_FILE = 'depth.z16'
+COLOR_FILE = 'color.bgr8'
+TIMESTAMPS_FILE = 'timestamps.npy'
+FRAME_NUMBERS_FILE = 'frame_numbers.npy'
+
+
+def intrinsics_to_dict(intrinsics: rs.intrinsics) -> dict:
+    return {
+        'width': intrinsics.width,
+        'height': intrinsics.height,
+        'ppx': intrinsics.ppx,
+        'ppy': intrinsics.ppy,
+        'fx': intrinsics.fx,
+        'fy': intrinsics.fy,
+        'model': intrinsics.model.name,
+        'coeffs': list(intrinsics.coeffs)
+    }
+
+
+def intrinsics_from_dict(data: dict) -> rs.intrinsics:
+    intrinsics = rs.intrinsics()
+    intrinsics.width = data['width']
+    intrinsics.height = data['height']
+    intrinsics.ppx = data['ppx']
+    intrinsics.ppy = data['ppy']
+    intrinsics.fx = data['fx']
+    intrinsics.fy = data['fy']
+    intrinsics.model = getattr(rs.distortion, data['model'])
+    intrinsics.coeffs = data['coeffs']
+    return intrinsics
+
+
+class CameraRecorder:
+    """Records the raw frames of one camera to <recording_dir>/<device_id>/.
+
+    Depth and color frames are appended as raw z16 and bgr8 data to one file per stream, which can be memory mapped as
+    (frame count, height, width) array on replay. Intrinsics, extrinsics, depth scale and frame count are stored in
+    metadata.json, timestamps and frame numbers as .npy files when the recorder is closed.
+    """
+
+    def __init__(self, camera: Camera, recording_dir: str):
+        self.camera = camera
+        self.path = os.path.join(recording_dir, camera.device_id)
+        os.makedirs(self.path, exist_ok=True)
+        self._depth_file = open(os.path.join(self.path, DEPTH_FILE), 'wb')
+        self._color_file = None
+        self._metadata = None
+        self._timestamps = []
+        self._frame_numbers = []
+
+    def record(self, frames: rs.composite_frame):
+        depth_frame = frames.get_depth_frame()
+        color_frame = frames.get_color_frame()
+        if self._metadata is None:
+            self._metadata = self._create_metadata(frames)
+            if color_frame:
+                self._color_file = open(os.path.join(self.path, COLOR_FILE), 'wb')
+        np.asanyarray(depth_frame.get_data()).tofile(self._depth_file)
+        if self._color_file is not None:
+            np.asanyarray(color_frame.get_data()).tofile(self._color_file)
+        self._timestamps.append(frames.get_timestamp())
+        self._frame_numbers.append(depth_frame.get_frame_number())
+
+    def _create_metadata(self, frames: rs.composite_frame) -> dict:
+        depth_frame = frames.get_depth_frame()
+        color_frame = frames.get_color_frame()
+        metadata = {
+            'device_id': self.camera.device_id,
+            'depth_scale': self.camera.depth_scale,
+            'depth_intrinsics': intrinsics_to_dict(
+                depth_frame.get_profile().as_video_stream_profile().get_intrinsics()),
+            'color_intrinsics': None,
+            'depth_to_color': None
+        }
+        if color_frame:
+            calibration = self.camera.get_stream_calibration(frames)
+            metadata['color_intrinsics'] = intrinsics_to_dict(calibration.color_intrinsics)
+            metadata['depth_to_color'] = calibration.depth_to_color.tolist()
+        return metadata
+
+    def close(self):
+        self._depth_file.close()
+        if self._color_file is not None:
+            self._color_file.close()
+        if self._metadata is not None:
+            self._metadata['frame_count'] = len(self._timestamps)
+            dump_dict_as_json(self._metadata, os.path.join(self.path, METADATA_FILE))
+            np.save(os.path.join(self.path, TIMESTAMPS_FILE), np.array(self._timestamps, dtype=np.float64))
+            np.save(os.path.join(self.path, FRAME_NUMBERS_FILE), np.array(self._frame_numbers, dtype=np.int64))
+
+
+class ReplayCamera(Camera):
+    """Camera that replays a recording created by CameraRecorder.
+
+    Frames are memory mapped and wrapped without copying them. If realtime is set, poll_frames blocks until the next
+    frame is due according to the recorded timestamps, otherwise frames are delivered as fast as they are polled. At the
+    end of the recording an EOFError is raised, unless loop is set.
+    """
+
+    def __init__(self, path: str, realtime: bool = False, loop: bool = False):
+        metadata = load_json_to_dict(os.path.join(path, METADATA_FILE))
+        self.device_id = metadata['device_id']
+        self._depth_scale = metadata['depth_scale']
+        self._realtime = realtime
+        self._loop = loop
+
+        frame_count = metadata['frame_count']
+        depth_intrinsics = intrinsics_from_dict(metadata['depth_intrinsics'])
+        self._depth_profile = SimulatedVideoStreamProfile(depth_intrinsics, np.eye(4))
+        self._depth_images = np.memmap(os.path.join(path, DEPTH_FILE), dtype=np.uint16, mode='r',
+                                       shape=(frame_count, depth_intrinsics.height, depth_intrinsics.width))
+        self._color_profile = None
+        self._color_images = None
+        if metadata['color_intrinsics'] is not None:
+            color_intrinsics = intrinsics_from_dict(metadata['color_intrinsics'])
+            self._color_profile = SimulatedVideoStreamProfile(color_intrinsics,
+                                                              np.linalg.inv(metadata['depth_to_color']))
+            self._color_images = np.memmap(os.path.join(path, COLOR_FILE), dtype=np.uint8, mode='r',
+                                           shape=(frame_count, color_intrinsics.height, color_intrinsics.width, 3))
+        self._timestamps = np.load(os.path.join(path, TIMESTAMPS_FILE))
+        self._frame_numbers = np.load(os.path.join(path, FRAME_NUMBERS_FILE))
+        self._index = 0
+        self._start_time = None
+        self._reset_stream_caches()
+
+    @property
+    def frame_count(self) -> int:
+        return self._timestamps.shape[0]
+
+    def poll_frames(self) -> SimulatedFrames:
+        """Returns a frames object with the next recorded depth and color frame"""
+        if self._index >= self.frame_count:
+            if not self._loop or self.frame_count == 0:
+                raise EOFError(f'End of recording of camera {self.device_id}.')
+            self._index = 0
+            self._start_time = None
+        if self._realtime:
+            if self._start_time is None:
+                self._start_time = time.monotonic() - (self._timestamps[self._index] - self._timestamps[0]) / 1000.
+            delay = self._start_time + (self._timestamps[self._index] - self._timestamps[0]) / 1000. - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        index = self._index
+        timestamp = float(self._timestamps[index])
+        frame_number = int(self._frame_numbers[index])
+        color_frame = None
+        if self._color_images is not None:
+            color_frame = SimulatedFrame(self._color_images[index], self._color_profile, frame_number, timestamp)
+        self._index += 1
+        return SimulatedFrames(
+            SimulatedFrame(self._depth_images[index], self._depth_profile, frame_number, timestamp, self._depth_scale),
+            color_frame
+        )
+
+    def close(self):
+        pass
+
+
+def record_frame_sets(cameras: List[Camera], recording_dir: str, frame_count: int, tolerance: float = 15.):
+    """Records frame_count synchronized frame sets of all cameras. The recording of a camera stops early if it is a
+    replayed camera that reached the end of its recording"""
+    recorders = {camera.device_id: CameraRecorder(camera, recording_dir) for camera in cameras}
+    try:
+        with CameraArray(cameras, tolerance=tolerance, drop_frames=False) as camera_array:
+            for _ in range(frame_count):
+                try:
+                    frame_set = camera_array.wait_for_frames()
+                except EOFError:
+                    break
+                for device_id, frames in frame_set.items():
+                    recorders[device_id].record(frames)
+    finally:
+        for recorder in recorders.values():
+            recorder.close()
+
+
+def initialize_replay_cameras(recording_dir: str, realtime: bool = False, loop: bool = False) -> List[ReplayCamera]:
+    return [ReplayCamera(os.path.join(recording_dir, device_id), realtime, loop)
+            for device_id in sorted(os.listdir(recording_dir))
+            if os.path.exists(os.path.join(recording_dir, device_id, METADATA_FILE))]
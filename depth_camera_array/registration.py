@@ -0,0 +1,242 @@
+import itertools
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from depth_camera_array.fusion import voxel_downsample, voxel_indices
+from depth_camera_array.perform_calibration import create_homogenous, rotations_from_vectors
+from depth_camera_array.tsdf import grid_keys
+
+# Offsets of a voxel and its 26 neighbours
+_NEIGHBOURS = np.array(list(itertools.product(range(-1, 2), repeat=3)), dtype=np.int64)
+# Minimum number of neighbours within a voxel neighbourhood to estimate a normal
+MIN_NORMAL_NEIGHBOURS = 5
+
+
+class VoxelHash:
+    """Points sorted by their voxel key, such that the neighbours of any point are found by binary searches for the keys
+    of the 27 surrounding voxels. Only one point per voxel is found, so the points should be voxel downsampled at about
+    the same voxel size, e.g. in another coordinate system"""
+
+    def __init__(self, points: np.ndarray, voxel_size: float):
+        self.voxel_size = voxel_size
+        keys = grid_keys(voxel_indices(points, voxel_size))
+        # Order of the given points, so attributes of the points can be sorted alike
+        self.order = np.argsort(keys)
+        self.points = np.take(points, self.order, axis=0)
+        self.keys = keys[self.order]
+        self.lower = self.points.min(axis=0) if len(points) > 0 else None
+        self.upper = self.points.max(axis=0) if len(points) > 0 else None
+
+    def __len__(self) -> int:
+        return self.points.shape[0]
+
+    def neighbours(self, points: np.ndarray) -> np.ndarray:
+        """Returns the (N, 27) indices of the points in the voxels around each of the (N, 3) points or -1 if a voxel is
+        empty. The nearest point within one voxel size of a query point is found unless it shares its voxel with another
+        point"""
+        if len(self) == 0:
+            return np.full((points.shape[0], _NEIGHBOURS.shape[0]), -1, dtype=np.int64)
+        keys = grid_keys((voxel_indices(points, self.voxel_size)[:, np.newaxis] + _NEIGHBOURS).reshape(-1, 3))
+        indices = np.minimum(np.searchsorted(self.keys, keys), len(self) - 1)
+        return np.where(self.keys[indices] == keys, indices, -1).reshape(-1, _NEIGHBOURS.shape[0])
+
+
+def estimate_normals(cloud: VoxelHash, indices: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Estimates the normals of the points of the cloud at the given indices, by default of all points, as the
+    eigenvector of the smallest eigenvalue of the covariance of their neighbours. The normals point towards the origin,
+    which is the camera for a point cloud in camera coordinates. Returns the (N, 3) normals and the mask of the points
+    with enough neighbours on a plane"""
+    points = cloud.points if indices is None else cloud.points[indices]
+    neighbours = cloud.neighbours(points)
+    valid = neighbours >= 0
+    counts = valid.sum(axis=1)
+    # Empty voxels contribute zeros, which are excluded by the weights
+    positions = np.take(cloud.points, np.maximum(neighbours, 0), axis=0).astype(np.float64)
+    weights = valid[:, :, np.newaxis].astype(np.float64)
+    centers = (positions * weights).sum(axis=1) / np.maximum(counts, 1)[:, np.newaxis]
+    offsets = (positions - centers[:, np.newaxis]) * weights
+    covariances = np.matmul(offsets.transpose(0, 2, 1), offsets)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariances)
+    normals = eigenvectors[:, :, 0]
+    normals *= np.where(np.sum(normals * points, axis=1) > 0, -1., 1.)[:, np.newaxis]
+    # Points on edges or in noise, whose smallest variance is not clearly below the others, have no reliable normal
+    planar = (counts >= MIN_NORMAL_NEIGHBOURS) & (eigenvalues[:, 0] < 0.3 * eigenvalues[:, 1])
+    return normals.astype(np.float32), planar
+
+
+class CameraCloud:
+    """Downsampled points of one camera in camera coordinates, hashed as targets of the other cameras, and an evenly
+    spaced subset of them as sources.
+
+    Only the target points that are paired with a source point need a normal, so the normals are estimated when a
+    point is paired for the first time and cached afterwards.
+    """
+
+    def __init__(self, points: np.ndarray, voxel_size: float, max_samples: int):
+        self.targets = VoxelHash(points, voxel_size)
+        # The hash is sorted by voxel key, so a stride over it samples the surface evenly
+        self.samples = self.targets.points[::max(len(self.targets) // max_samples, 1)][:max_samples]
+        self._normals = np.zeros((len(self.targets), 3), dtype=np.float32)
+        self._planar = np.zeros(len(self.targets), dtype=bool)
+        self._estimated = np.zeros(len(self.targets), dtype=bool)
+
+    def normals(self, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the normals of the target points at the indices and the mask of those that are reliable"""
+        missing = np.unique(indices[~self._estimated[indices]])
+        if missing.shape[0] > 0:
+            self._normals[missing], self._planar[missing] = estimate_normals(self.targets, missing)
+            self._estimated[missing] = True
+        return self._normals[indices], self._planar[indices]
+
+
+class Correspondences(NamedTuple):
+    """Pairs of a source point and its nearest target point with the target normal, all in world coordinates"""
+    source: np.ndarray
+    target: np.ndarray
+    normals: np.ndarray
+
+
+class Registration(NamedTuple):
+    """Refined extrinsics and the residuals of the last correspondences between each overlapping pair of cameras"""
+    extrinsics: Dict[str, np.ndarray]
+    report: dict
+
+
+def transform(points: np.ndarray, extrinsic: np.ndarray) -> np.ndarray:
+    return points @ extrinsic[:3, :3].T.astype(np.float32) + extrinsic[:3, 3].astype(np.float32)
+
+
+def find_correspondences(source: np.ndarray, target: VoxelHash, max_distance: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Pairs each source point with its nearest target point within max_distance, which must not exceed the voxel
+    size of the target. Returns the indices of the paired source and target points. Source points outside the bounding
+    box of the target are skipped without a search"""
+    if len(target) == 0 or source.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    inside = np.flatnonzero(np.all((source >= target.lower - max_distance) & (source <= target.upper + max_distance),
+                                   axis=1))
+    neighbours = target.neighbours(source[inside])
+    distances = np.sum((np.take(target.points, np.maximum(neighbours, 0), axis=0) - source[inside, np.newaxis]) ** 2,
+                       axis=2)
+    distances[neighbours < 0] = np.inf
+    nearest = np.argmin(distances, axis=1)
+    rows = np.arange(inside.shape[0])
+    found = distances[rows, nearest] <= max_distance ** 2
+    return inside[found], neighbours[rows[found], nearest[found]]
+
+
+def prepare_clouds(point_clouds: Dict[str, np.ndarray], voxel_size: float, max_samples: int) -> Dict[str, CameraCloud]:
+    """Downsamples the point clouds in camera coordinates"""
+    return {device_id: CameraCloud(voxel_downsample(points, voxel_size).points, voxel_size, max_samples)
+            for device_id, points in point_clouds.items()}
+
+
+def pair_correspondences(clouds: Dict[str, CameraCloud], extrinsics: Dict[str, np.ndarray], max_distance: float,
+                         min_correspondences: int) -> Dict[Tuple[str, str], Correspondences]:
+    """Finds the correspondences between each pair of cameras and returns them in world coordinates. The source points
+    are transformed into the target camera, so the targets are hashed only once per voxel size. Pairs with fewer than
+    min_correspondences do not overlap and are left out"""
+    pairs = {}
+    for source_id, target_id in itertools.combinations(sorted(clouds), 2):
+        source, target = clouds[source_id], clouds[target_id]
+        relative = np.linalg.solve(extrinsics[target_id], extrinsics[source_id])
+        source_indices, target_indices = find_correspondences(transform(source.samples, relative), target.targets,
+                                                              max_distance)
+        normals, planar = target.normals(target_indices)
+        if np.count_nonzero(planar) >= min_correspondences:
+            pairs[(source_id, target_id)] = Correspondences(
+                transform(source.samples[source_indices[planar]], extrinsics[source_id]),
+                transform(target.targets.points[target_indices[planar]], extrinsics[target_id]),
+                normals[planar] @ extrinsics[target_id][:3, :3].T.astype(np.float32)
+            )
+    return pairs
+
+
+def point_to_plane_step(pairs: Dict[Tuple[str, str], Correspondences], camera_ids: List[str], base_camera: str,
+                        huber_threshold: float, damping: float = 1e-6) -> np.ndarray:
+    """Solves the normal equations of the point to plane residuals of all pairs jointly for a (C, 6) update of
+    rotation vector and translation of each camera in world coordinates. The base camera is not moved"""
+    camera_count = len(camera_ids)
+    positions = {device_id: index for index, device_id in enumerate(camera_ids)}
+    hessian = np.zeros((6 * camera_count, 6 * camera_count))
+    gradient = np.zeros(6 * camera_count)
+    for (source_id, target_id), pair in pairs.items():
+        source, target, normals = (np.asarray(values, dtype=np.float64) for values in pair)
+        residuals = np.sum(normals * (source - target), axis=1)
+        # Huber weights reduce the influence of wrong correspondences
+        weights = np.minimum(1., huber_threshold / np.maximum(np.abs(residuals), 1e-12))
+        jacobians = [np.hstack([np.cross(source, normals), normals]),
+                     -np.hstack([np.cross(target, normals), normals])]
+        blocks = [slice(6 * positions[source_id], 6 * positions[source_id] + 6),
+                  slice(6 * positions[target_id], 6 * positions[target_id] + 6)]
+        for first, first_block in zip(jacobians, blocks):
+            weighted = first * weights[:, np.newaxis]
+            gradient[first_block] += weighted.T @ residuals
+            for second, second_block in zip(jacobians, blocks):
+                hessian[first_block, second_block] += weighted.T @ second
+    free = np.ones(6 * camera_count, dtype=bool)
+    free[6 * positions[base_camera]:6 * positions[base_camera] + 6] = False
+    update = np.zeros(6 * camera_count)
+    reduced = hessian[np.ix_(free, free)]
+    reduced += np.eye(reduced.shape[0]) * damping * max(np.trace(reduced) / max(reduced.shape[0], 1), 1.)
+    update[free] = np.linalg.solve(reduced, -gradient[free])
+    return update.reshape(camera_count, 6)
+
+
+def describe_residuals(pairs: Dict[Tuple[str, str], Correspondences], camera_ids: List[str]) -> dict:
+    """Returns the RMS point to plane distance and the number of correspondences of each pair and camera"""
+    squared_sums = {device_id: 0. for device_id in camera_ids}
+    counts = {device_id: 0 for device_id in camera_ids}
+    report_pairs = []
+    for (source_id, target_id), pair in pairs.items():
+        residuals = np.sum(pair.normals * (pair.source - pair.target), axis=1, dtype=np.float64)
+        squared_sum = float(np.sum(residuals ** 2))
+        report_pairs.append({'cameras': [source_id, target_id], 'correspondences': int(residuals.shape[0]),
+                             'rmsd': float(np.sqrt(squared_sum / residuals.shape[0]))})
+        for device_id in (source_id, target_id):
+            squared_sums[device_id] += squared_sum
+            counts[device_id] += residuals.shape[0]
+    return {
+        'pairs': report_pairs,
+        'cameras': {device_id: {'correspondences': counts[device_id],
+                                'rmsd': float(np.sqrt(squared_sums[device_id] / counts[device_id]))
+                                if counts[device_id] > 0 else None}
+                    for device_id in camera_ids}
+    }
+
+
+def refine_extrinsics(point_clouds: Dict[str, np.ndarray], extrinsics: Dict[str, np.ndarray],
+                      voxel_sizes: Sequence[float] = (0.04, 0.02, 0.01), iterations: int = 10,
+                      base_camera: Optional[str] = None, max_samples: int = 5000, min_correspondences: int = 50,
+                      tolerance: float = 1e-5) -> Registration:
+    """Refines the extrinsics of all cameras jointly by point to plane ICP between each overlapping pair of cameras.
+
+    The point clouds are given in camera coordinates. They are registered coarse to fine: at each voxel size, the
+    clouds are downsampled and at most the given number of Gauss-Newton iterations is performed, each with new
+    correspondences within one voxel size for at most max_samples points of each camera. A level ends early if no
+    camera moves by more than the tolerance in m or rad. The base camera, by default the first one, keeps its
+    extrinsic.
+    """
+    camera_ids = sorted(point_clouds)
+    base_camera = base_camera if base_camera is not None else camera_ids[0]
+    extrinsics = {device_id: np.asarray(extrinsics[device_id], dtype=np.float64) for device_id in camera_ids}
+    report = {'base_camera': base_camera, 'levels': []}
+    pairs = {}
+    for voxel_size in voxel_sizes:
+        clouds = prepare_clouds(point_clouds, voxel_size, max_samples)
+        iteration = 0
+        for iteration in range(1, iterations + 1):
+            pairs = pair_correspondences(clouds, extrinsics, voxel_size, min_correspondences)
+            if not pairs:
+                break
+            update = point_to_plane_step(pairs, camera_ids, base_camera, voxel_size / 2)
+            rotations = rotations_from_vectors(update[:, :3])
+            for index, device_id in enumerate(camera_ids):
+                extrinsics[device_id] = create_homogenous(rotations[index], update[index, 3:]) @ extrinsics[device_id]
+            if np.abs(update).max() < tolerance:
+                break
+        report['levels'].append({'voxel_size': voxel_size, 'iterations': iteration, 'pairs': len(pairs)})
+    if voxel_sizes:
+        pairs = pair_correspondences(clouds, extrinsics, voxel_sizes[-1], min_correspondences)
+    report.update(describe_residuals(pairs, camera_ids))
+    return Registration(extrinsics, report)
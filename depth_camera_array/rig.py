@@ -0,0 +1,277 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+from pyrealsense2 import pyrealsense2 as rs
+
+from depth_camera_array.buffer_pool import BufferPool
+from depth_camera_array.crop_volumes import CropVolume
+from depth_camera_array.deprojection import create_ray_table, depth_frame_to_depth_image
+from depth_camera_array.recording import intrinsics_to_dict
+from depth_camera_array.utilities import dump_dict_as_json, load_json_to_dict
+
+RIG_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+# Largest raw z16 depth value
+MAX_DEPTH_VALUE = np.iinfo(np.uint16).max
+
+
+class WorldRayTable(NamedTuple):
+    """Rays of each pixel in world coordinates scaled such that multiplying them with the raw z16 value of the pixel
+    and adding the camera origin results in its world point"""
+    rays: np.ndarray
+    origin: np.ndarray
+
+
+def compile_world_rays(intrinsics: rs.intrinsics, depth_scale: float, extrinsic: np.ndarray) -> WorldRayTable:
+    """Folds the rotation of the 4x4 extrinsic into the ray table of the depth stream. Returns (height * width, 3)
+    float32 rays in row major order and the float32 origin of the camera in world coordinates"""
+    extrinsic = np.asarray(extrinsic, dtype=np.float64)
+    rays = create_ray_table(intrinsics, depth_scale).astype(np.float64) @ extrinsic[:3, :3].T
+    return WorldRayTable(rays.astype(np.float32), extrinsic[:3, 3].astype(np.float32))
+
+
+def _checkout(pool: Optional[BufferPool], camera_id: str, name: str, shape: Tuple[int, ...], dtype,
+              capacity: int = 0) -> np.ndarray:
+    if pool is None:
+        return np.empty(shape, dtype=dtype)
+    return pool.checkout('deproject', camera_id, name, shape, dtype, capacity)
+
+
+def deproject_to_world(depth_image: np.ndarray, table: WorldRayTable, remove_zero_depth: bool = True,
+                       pool: BufferPool = None, camera_id: str = '') -> np.ndarray:
+    """Calculates the (N, 3) float32 world points of a raw z16 depth image by one multiply-add per coordinate. If a
+    buffer pool is given, the points and all temporaries are checked out from it, and the caller checks in the points"""
+    depth_values = depth_image.reshape(-1)
+    if depth_values.shape[0] != table.rays.shape[0]:
+        raise ValueError(f'Depth image with {depth_values.shape[0]} pixels does not match ray table with '
+                         f'{table.rays.shape[0]} rays.')
+    pixel_count = depth_values.shape[0]
+    temporaries = []
+    if remove_zero_depth:
+        valid = _checkout(pool, camera_id, 'valid', (pixel_count,), bool)
+        np.not_equal(depth_values, 0, out=valid)
+        point_count = int(np.count_nonzero(valid))
+        # np.compress copies the rays of the valid pixels faster than fancy indexing, the copy is then scaled in place
+        points = _checkout(pool, camera_id, 'points', (point_count, 3), np.float32, 3 * pixel_count)
+        np.compress(valid, table.rays, axis=0, out=points)
+        depth_values = np.compress(valid, depth_values, out=_checkout(pool, camera_id, 'depth_values', (point_count,),
+                                                                      np.uint16, pixel_count))
+        temporaries += [valid, depth_values]
+        points *= depth_values[:, np.newaxis]
+    else:
+        points = np.multiply(table.rays, depth_values[:, np.newaxis],
+                             out=_checkout(pool, camera_id, 'points', (pixel_count, 3), np.float32))
+    points += table.origin
+    if pool is not None:
+        pool.checkin_all(temporaries)
+    return points
+
+
+class PixelMask(NamedTuple):
+    """Pixels whose rays can reach the crop volume. For each of them, the world ray and the raw z16 depth bounds within
+    which its point can lie inside the volume are stored. The bounds are rounded outwards, so the points still have to
+    be cropped, but only those of the object remain"""
+    indices: np.ndarray
+    rays: np.ndarray
+    near: np.ndarray
+    far: np.ndarray
+    origin: np.ndarray
+
+
+def compile_pixel_mask(table: WorldRayTable, crop_volume: CropVolume, depth_scale: float,
+                       depth_range: Tuple[float, Optional[float]] = (0., None)) -> PixelMask:
+    """Intersects the world rays with the crop volume and limits the depth bounds to the depth range in m of the
+    camera"""
+    near, far = crop_volume.intersect_rays(table.origin, table.rays)
+    # Zero depth is invalid, so the lower bound is at least 1
+    near = np.maximum(np.floor(near), max(np.ceil(depth_range[0] / depth_scale), 1))
+    far = np.minimum(np.ceil(far), MAX_DEPTH_VALUE if depth_range[1] is None else
+                     np.floor(depth_range[1] / depth_scale))
+    indices = np.flatnonzero(near <= far)
+    return PixelMask(indices.astype(np.int64), np.ascontiguousarray(table.rays[indices]),
+                     near[indices].astype(np.uint16), far[indices].astype(np.uint16), table.origin)
+
+
+def deproject_masked(depth_image: np.ndarray, mask: PixelMask, pool: BufferPool = None,
+                     camera_id: str = '') -> np.ndarray:
+    """Calculates the (N, 3) float32 world points of the masked pixels whose depth lies within their bounds. Only the
+    masked pixels are read. If a buffer pool is given, the points and all temporaries are checked out from it, and the
+    caller checks in the points"""
+    pixel_count = mask.indices.shape[0]
+    depth_values = np.take(depth_image.reshape(-1), mask.indices,
+                           out=_checkout(pool, camera_id, 'masked_depth_values', (pixel_count,), np.uint16))
+    valid = np.greater_equal(depth_values, mask.near, out=_checkout(pool, camera_id, 'valid', (pixel_count,), bool))
+    below_far = np.less_equal(depth_values, mask.far, out=_checkout(pool, camera_id, 'below_far', (pixel_count,), bool))
+    valid &= below_far
+    point_count = int(np.count_nonzero(valid))
+    points = np.compress(valid, mask.rays, axis=0,
+                         out=_checkout(pool, camera_id, 'points', (point_count, 3), np.float32, 3 * pixel_count))
+    valid_depth_values = np.compress(valid, depth_values, out=_checkout(pool, camera_id, 'depth_values',
+                                                                        (point_count,), np.uint16, pixel_count))
+    points *= valid_depth_values[:, np.newaxis]
+    points += mask.origin
+    if pool is not None:
+        pool.checkin_all([depth_values, valid, below_far, valid_depth_values])
+    return points
+
+
+def crop_key(crop_volume: CropVolume, depth_range: Tuple[float, Optional[float]]) -> dict:
+    """Describes the crop volume and depth range a pixel mask depends on"""
+    return {
+        'type': type(crop_volume).__name__,
+        'parameters': {name: np.asarray(value, dtype=np.float64).tolist()
+                       for name, value in sorted(vars(crop_volume).items())},
+        'depth_range': list(depth_range)
+    }
+
+
+def rig_key(device_id: str, intrinsics: rs.intrinsics, depth_scale: float, extrinsic: np.ndarray) -> str:
+    """Returns a hash of everything a world ray table depends on, so a changed calibration, stream mode or device
+    invalidates it"""
+    description = {
+        'version': RIG_VERSION,
+        'device_id': device_id,
+        'intrinsics': intrinsics_to_dict(intrinsics),
+        'depth_scale': float(depth_scale),
+        'extrinsic': np.asarray(extrinsic, dtype=np.float64).tolist()
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def stream_signature(intrinsics: rs.intrinsics, depth_scale: float) -> tuple:
+    """Returns the values of the stream a world ray table depends on, which are much cheaper to compare than to hash"""
+    return (intrinsics.width, intrinsics.height, intrinsics.ppx, intrinsics.ppy, intrinsics.fx, intrinsics.fy,
+            intrinsics.model, tuple(intrinsics.coeffs), depth_scale)
+
+
+class CompiledRig:
+    """World ray tables of all cameras of an array, stored as .npy files in rig_dir.
+
+    A table is compiled from the extrinsic in camera_array.json, the intrinsics of the depth stream and the depth scale
+    when a camera delivers its first frame. The manifest maps each device to the hash of these inputs and to its table
+    file. If the hash matches, the table is memory mapped instead of being compiled again, which only takes some ms.
+    Otherwise, e.g. after a new calibration or with another resolution, the table is compiled and stored again.
+    The hashes are only calculated again if the intrinsics or the depth scale of a camera change, so the extrinsics
+    must not be changed after creating the rig.
+
+    If a crop volume is given, a pixel mask is compiled and stored the same way for each camera, which additionally
+    depends on the crop volume and the depth range in m. Then only the pixels whose rays reach the volume are
+    deprojected, and only if their depth lies within their bounds.
+    """
+
+    def __init__(self, rig_dir: str, extrinsics: Dict[str, np.ndarray], crop_volume: CropVolume = None,
+                 depth_range: Tuple[float, Optional[float]] = (0., None)):
+        self.rig_dir = rig_dir
+        os.makedirs(rig_dir, exist_ok=True)
+        self.extrinsics = extrinsics
+        self.crop_volume = crop_volume
+        self.depth_range = depth_range
+        self._manifest_path = os.path.join(rig_dir, MANIFEST_FILE)
+        self._manifest = load_json_to_dict(self._manifest_path) if os.path.exists(self._manifest_path) else {}
+        self._tables: Dict[str, WorldRayTable] = {}
+        self._keys: Dict[str, str] = {}
+        self._masks: Dict[str, Optional[PixelMask]] = {}
+        self._mask_keys: Dict[str, str] = {}
+        # Maps each device to the stream signature and the table and mask keys calculated for it
+        self._stream_keys: Dict[str, Tuple[tuple, str, Optional[str]]] = {}
+        self._lock = threading.RLock()
+        self.compiled = []
+        self.compiled_masks = []
+
+    def get_table(self, device_id: str, intrinsics: rs.intrinsics, depth_scale: float) -> WorldRayTable:
+        """Returns the world ray table of the camera. It is loaded or compiled only once per device and stream mode"""
+        key, _ = self._get_keys(device_id, intrinsics, depth_scale)
+        if self._keys.get(device_id) == key:
+            return self._tables[device_id]
+        with self._lock:
+            entry = self._manifest.get(device_id)
+            path = os.path.join(self.rig_dir, f'{device_id}_world_rays.npy')
+            if entry is not None and entry['key'] == key and os.path.exists(path):
+                rays = np.load(path, mmap_mode='r')
+                table = WorldRayTable(rays, np.asarray(entry['origin'], dtype=np.float32))
+            else:
+                table = compile_world_rays(intrinsics, depth_scale, self.extrinsics[device_id])
+                temporary_path = f'{path}.{os.getpid()}.tmp.npy'
+                np.save(temporary_path, table.rays)
+                os.replace(temporary_path, path)
+                self._manifest[device_id] = {
+                    'key': key,
+                    'width': intrinsics.width,
+                    'height': intrinsics.height,
+                    'origin': table.origin.tolist()
+                }
+                self._save_manifest()
+                self.compiled.append(device_id)
+            self._tables[device_id] = table
+            self._keys[device_id] = key
+        return table
+
+    def get_mask(self, device_id: str, intrinsics: rs.intrinsics, depth_scale: float) -> Optional[PixelMask]:
+        """Returns the pixel mask of the camera or None if no crop volume is given"""
+        if self.crop_volume is None:
+            return None
+        _, key = self._get_keys(device_id, intrinsics, depth_scale)
+        if self._mask_keys.get(device_id) == key:
+            return self._masks[device_id]
+        with self._lock:
+            table = self.get_table(device_id, intrinsics, depth_scale)
+            entry = self._manifest[device_id]
+            path = os.path.join(self.rig_dir, f'{device_id}_pixel_mask.npz')
+            if entry.get('mask_key') == key and os.path.exists(path):
+                with np.load(path) as arrays:
+                    mask = PixelMask(arrays['indices'], arrays['rays'], arrays['near'], arrays['far'], table.origin)
+            else:
+                mask = compile_pixel_mask(table, self.crop_volume, depth_scale, self.depth_range)
+                temporary_path = f'{path}.{os.getpid()}.tmp.npz'
+                np.savez(temporary_path, indices=mask.indices, rays=mask.rays, near=mask.near, far=mask.far)
+                os.replace(temporary_path, path)
+                entry['mask_key'] = key
+                entry['masked_pixels'] = len(mask.indices)
+                self._save_manifest()
+                self.compiled_masks.append(device_id)
+            self._masks[device_id] = mask
+            self._mask_keys[device_id] = key
+        return mask
+
+    def _get_keys(self, device_id: str, intrinsics: rs.intrinsics, depth_scale: float) -> Tuple[str, Optional[str]]:
+        """Returns the keys of the table and of the pixel mask of the camera. They are hashed only if the stream
+        changed since the last call"""
+        signature = stream_signature(intrinsics, depth_scale)
+        cached = self._stream_keys.get(device_id)
+        if cached is not None and cached[0] == signature:
+            return cached[1], cached[2]
+        table_key = rig_key(device_id, intrinsics, depth_scale, self.extrinsics[device_id])
+        mask_key = None
+        if self.crop_volume is not None:
+            mask_key = hashlib.sha256(json.dumps([table_key, crop_key(self.crop_volume, self.depth_range)],
+                                                 sort_keys=True).encode()).hexdigest()
+        self._stream_keys[device_id] = (signature, table_key, mask_key)
+        return table_key, mask_key
+
+    def _save_manifest(self):
+        # Other processes may load the rig at the same time, so they must never see a partially written file
+        temporary_path = f'{self._manifest_path}.{os.getpid()}.tmp'
+        dump_dict_as_json(self._manifest, temporary_path)
+        os.replace(temporary_path, self._manifest_path)
+
+    def deproject_image(self, device_id: str, depth_image: np.ndarray, intrinsics: rs.intrinsics, depth_scale: float,
+                        remove_zero_depth: bool = True, pool: BufferPool = None) -> np.ndarray:
+        """Calculates the (N, 3) float32 world points of a raw z16 depth image. With a pixel mask, only the points
+        that may lie within the crop volume are returned. If a buffer pool is given, the points are checked out from
+        it"""
+        mask = self.get_mask(device_id, intrinsics, depth_scale)
+        if mask is not None:
+            return deproject_masked(depth_image, mask, pool, device_id)
+        return deproject_to_world(depth_image, self.get_table(device_id, intrinsics, depth_scale), remove_zero_depth,
+                                  pool, device_id)
+
+    def deproject(self, device_id: str, depth_frame: rs.depth_frame, depth_scale: float,
+                  remove_zero_depth: bool = True, pool: BufferPool = None) -> np.ndarray:
+        """Calculates the (N, 3) float32 world points of a depth frame, whose z16 buffer is read without copying it"""
+        return self.deproject_image(device_id, depth_frame_to_depth_image(depth_frame),
+                                    depth_frame.get_profile().as_video_stream_profile().get_intrinsics(), depth_scale,
+                                    remove_zero_depth, pool)
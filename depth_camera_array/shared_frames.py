@@ -0,0 +1,247 @@
+import functools
+import os
+import time
+from multiprocessing import shared_memory
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+from pyrealsense2 import pyrealsense2 as rs
+
+from depth_camera_array.camera import Camera, find_connected_devices
+from depth_camera_array.capture_profiles import CaptureProfile, MEASUREMENT, get_capture_profile
+from depth_camera_array.pipeline import BLOCK, DROP_NEWEST, DROP_OLDEST, OVERFLOW_POLICIES
+from depth_camera_array.recording import METADATA_FILE, ReplayCamera, intrinsics_to_dict
+from depth_camera_array.utilities import load_json_to_dict
+
+# Indices of the counters of a ring
+_WRITTEN, _DROPPED, _OVERWRITTEN = range(3)
+
+
+class RingSpec(NamedTuple):
+    """Everything another process needs to attach to a FrameRing"""
+    name: str
+    device_id: str
+    capacity: int
+    depth_shape: Tuple[int, int]
+    color_shape: Optional[Tuple[int, int, int]]
+    policy: str
+
+
+class FrameDescriptor(NamedTuple):
+    """Identifies a frame in the ring of its camera. Only descriptors are passed between processes, never frames"""
+    device_id: str
+    slot: int
+    sequence: int
+    frame_number: int
+    timestamp: float
+
+
+class StreamInfo(NamedTuple):
+    """Sent once by each capture process before its first frame"""
+    device_id: str
+    depth_intrinsics: dict
+    depth_scale: float
+
+
+class CaptureFinished(NamedTuple):
+    """Sent by a capture process when it stops, with the error message if it failed"""
+    device_id: str
+    error: Optional[str] = None
+
+
+class CaptureSource(NamedTuple):
+    """Opens the camera of a device within a capture process and defines the shapes of its images"""
+    open_camera: Callable[[], Camera]
+    depth_shape: Tuple[int, int]
+    color_shape: Optional[Tuple[int, int, int]]
+
+
+def _ring_layout(capacity: int, depth_shape: Tuple[int, int],
+                 color_shape: Optional[Tuple[int, int, int]]) -> Dict[str, Tuple[int, np.dtype, tuple]]:
+    """Returns the byte offset, dtype and shape of each array within the shared memory of a ring"""
+    arrays = [
+        ('counters', np.int64, (3,)),
+        ('sequences', np.int64, (capacity,)),
+        ('pending', np.int64, (capacity,)),
+        ('frame_numbers', np.int64, (capacity,)),
+        ('timestamps', np.float64, (capacity,)),
+        ('depth', np.uint16, (capacity,) + tuple(depth_shape))
+    ]
+    if color_shape is not None:
+        arrays.append(('color', np.uint8, (capacity,) + tuple(color_shape)))
+    layout = {}
+    offset = 0
+    for name, dtype, shape in arrays:
+        layout[name] = (offset, np.dtype(dtype), shape)
+        # Each array starts at a cache line, so frames can be copied with aligned writes
+        offset += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 64) * 64
+    layout['size'] = (offset, None, None)
+    return layout
+
+
+class FrameRing:
+    """Preallocated ring of depth and color frames of one camera in shared memory.
+
+    The capture process of the camera is the only writer. Frame i is written to slot i % capacity and a descriptor of
+    it is sent to the consumers, which read the frame in place and release the slot when they are done. If the slot of
+    a new frame was not released yet, the policy decides: BLOCK waits for it, DROP_NEWEST skips the new frame and
+    DROP_OLDEST overwrites the old one. Consumers detect an overwritten frame since the sequence number of its slot
+    changed, so they have to check is_current after processing a frame. The process that created the ring unlinks the
+    shared memory when it is closed.
+    """
+
+    def __init__(self, spec: RingSpec, memory: shared_memory.SharedMemory, owner: bool):
+        self.spec = spec
+        self._memory = memory
+        self._owner = owner
+        self._next_sequence = 0
+        layout = _ring_layout(spec.capacity, spec.depth_shape, spec.color_shape)
+        arrays = {name: np.ndarray(shape, dtype, memory.buf, offset)
+                  for name, (offset, dtype, shape) in layout.items() if dtype is not None}
+        self._counters = arrays['counters']
+        self._sequences = arrays['sequences']
+        self._pending = arrays['pending']
+        self._frame_numbers = arrays['frame_numbers']
+        self._timestamps = arrays['timestamps']
+        self._depth = arrays['depth']
+        self._color = arrays.get('color')
+
+    @classmethod
+    def create(cls, device_id: str, capacity: int, depth_shape: Tuple[int, int],
+               color_shape: Optional[Tuple[int, int, int]] = None, policy: str = DROP_OLDEST) -> 'FrameRing':
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {policy}. Use one of {OVERFLOW_POLICIES}.')
+        size = _ring_layout(capacity, depth_shape, color_shape)['size'][0]
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        spec = RingSpec(memory.name, device_id, capacity, tuple(depth_shape),
+                        None if color_shape is None else tuple(color_shape), policy)
+        ring = cls(spec, memory, owner=True)
+        ring._sequences[:] = -1
+        return ring
+
+    @classmethod
+    def attach(cls, spec: RingSpec) -> 'FrameRing':
+        return cls(spec, shared_memory.SharedMemory(name=spec.name), owner=False)
+
+    def write(self, depth_image: np.ndarray, color_image: Optional[np.ndarray], frame_number: int, timestamp: float,
+              should_stop: Callable[[], bool] = lambda: False) -> Optional[FrameDescriptor]:
+        """Copies a frame into the next slot. Returns its descriptor or None if it was dropped"""
+        slot = self._next_sequence % self.spec.capacity
+        if self._pending[slot]:
+            if self.spec.policy == DROP_NEWEST:
+                self._counters[_DROPPED] += 1
+                return None
+            if self.spec.policy == BLOCK:
+                while self._pending[slot]:
+                    if should_stop():
+                        return None
+                    time.sleep(0.0005)
+            else:
+                self._counters[_OVERWRITTEN] += 1
+        # Readers that still hold the old descriptor of the slot notice that it is being overwritten
+        self._sequences[slot] = -1
+        self._depth[slot] = depth_image
+        if self._color is not None and color_image is not None:
+            self._color[slot] = color_image
+        self._frame_numbers[slot] = frame_number
+        self._timestamps[slot] = timestamp
+        self._pending[slot] = 1
+        self._sequences[slot] = self._next_sequence
+        descriptor = FrameDescriptor(self.spec.device_id, slot, self._next_sequence, frame_number, timestamp)
+        self._next_sequence += 1
+        self._counters[_WRITTEN] += 1
+        return descriptor
+
+    def read(self, descriptor: FrameDescriptor) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Returns views of the depth and color image of the frame without copying them, or None if it was
+        overwritten"""
+        if not self.is_current(descriptor):
+            return None, None
+        return self._depth[descriptor.slot], None if self._color is None else self._color[descriptor.slot]
+
+    def is_current(self, descriptor: FrameDescriptor) -> bool:
+        return self._sequences[descriptor.slot] == descriptor.sequence
+
+    def release(self, descriptor: FrameDescriptor):
+        if self.is_current(descriptor):
+            self._pending[descriptor.slot] = 0
+
+    def get_statistics(self) -> Dict[str, int]:
+        return {
+            'written': int(self._counters[_WRITTEN]),
+            'dropped': int(self._counters[_DROPPED]),
+            'overwritten': int(self._counters[_OVERWRITTEN])
+        }
+
+    def close(self):
+        # The arrays have to be released before the memory can be closed
+        self._counters = self._sequences = self._pending = self._frame_numbers = self._timestamps = None
+        self._depth = self._color = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+def capture_to_ring(source: CaptureSource, spec: RingSpec, messages, stop):
+    """Runs in a capture process. Polls the frames of one camera, copies them into its ring and sends their
+    descriptors to the messages queue until stop is set or a replayed recording ended"""
+    ring = FrameRing.attach(spec)
+    error = None
+    try:
+        camera = source.open_camera()
+        try:
+            stream_info_sent = False
+            while not stop.is_set():
+                try:
+                    frames = camera.poll_frames()
+                except EOFError:
+                    break
+                depth_frame = frames.get_depth_frame()
+                color_frame = frames.get_color_frame()
+                if not stream_info_sent:
+                    messages.put(StreamInfo(spec.device_id, intrinsics_to_dict(
+                        depth_frame.get_profile().as_video_stream_profile().get_intrinsics()), camera.depth_scale))
+                    stream_info_sent = True
+                descriptor = ring.write(np.asanyarray(depth_frame.get_data()),
+                                        np.asanyarray(color_frame.get_data()) if color_frame else None,
+                                        depth_frame.get_frame_number(), frames.get_timestamp(), stop.is_set)
+                if descriptor is not None:
+                    messages.put(descriptor)
+        finally:
+            camera.close()
+    except Exception as exception:
+        error = f'{type(exception).__name__}: {exception}'
+    finally:
+        ring.close()
+        messages.put(CaptureFinished(spec.device_id, error))
+
+
+def open_device(device_id: str, warmup_frames: int = 0, profile: CaptureProfile = None) -> Camera:
+    return Camera(device_id, rs.context(), warmup_frames, profile)
+
+
+def find_capture_sources(recording_dir: str = None, realtime: bool = False, warmup_frames: int = 0,
+                         rig_config: dict = None) -> Dict[str, CaptureSource]:
+    """Returns a capture source for each connected device with its measurement profile from the rig config or, if a
+    recording directory is given, for each recorded camera. The cameras are opened by the capture processes, since a
+    device can only be used by one process"""
+    if recording_dir is not None:
+        sources = {}
+        for device_id in sorted(os.listdir(recording_dir)):
+            path = os.path.join(recording_dir, device_id)
+            if not os.path.exists(os.path.join(path, METADATA_FILE)):
+                continue
+            metadata = load_json_to_dict(os.path.join(path, METADATA_FILE))
+            depth_intrinsics = metadata['depth_intrinsics']
+            color_intrinsics = metadata['color_intrinsics']
+            sources[metadata['device_id']] = CaptureSource(
+                functools.partial(ReplayCamera, path, realtime),
+                (depth_intrinsics['height'], depth_intrinsics['width']),
+                None if color_intrinsics is None else (color_intrinsics['height'], color_intrinsics['width'], 3))
+        return sources
+    sources = {}
+    for device_id in find_connected_devices(rs.context()):
+        profile = get_capture_profile(rig_config or {}, MEASUREMENT, device_id)
+        sources[device_id] = CaptureSource(functools.partial(open_device, device_id, warmup_frames, profile),
+                                           profile.depth_shape, profile.color_shape)
+    return sources
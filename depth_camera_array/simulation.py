@@ -0,0 +1,182 @@
+import time
+from typing import List, Optional
+
+import numpy as np
+from pyrealsense2 import pyrealsense2 as rs
+
+from depth_camera_array.aruco_detection import get_dictionary
+from depth_camera_array.camera import Camera
+
+DEFAULT_DEPTH_SCALE = 0.001
+
+
+def create_intrinsics(width: int = 1280, height: int = 720, horizontal_fov: float = 87.) -> rs.intrinsics:
+    """Creates pinhole intrinsics similar to those of a RealSense D4xx depth stream"""
+    intrinsics = rs.intrinsics()
+    intrinsics.width = width
+    intrinsics.height = height
+    intrinsics.fx = width / 2. / np.tan(np.radians(horizontal_fov) / 2.)
+    intrinsics.fy = intrinsics.fx
+    intrinsics.ppx = (width - 1) / 2.
+    intrinsics.ppy = (height - 1) / 2.
+    intrinsics.model = rs.distortion.brown_conrady
+    intrinsics.coeffs = [0., 0., 0., 0., 0.]
+    return intrinsics
+
+
+def create_extrinsics(matrix: np.ndarray = None) -> rs.extrinsics:
+    """Converts a 4x4 matrix to librealsense extrinsics. Creates identity extrinsics if no matrix is given"""
+    matrix = np.eye(4) if matrix is None else np.asarray(matrix)
+    extrinsics = rs.extrinsics()
+    extrinsics.rotation = matrix[:3, :3].T.ravel().tolist()
+    extrinsics.translation = matrix[:3, 3].tolist()
+    return extrinsics
+
+
+def create_depth_image(intrinsics: rs.intrinsics, background: float = 3., foreground: float = 1.5,
+                       depth_scale: float = DEFAULT_DEPTH_SCALE) -> np.ndarray:
+    """Creates a z16 depth image of a wall at background distance with a box at foreground distance in the center
+    of the image"""
+    depth_image = np.full((intrinsics.height, intrinsics.width), round(background / depth_scale), dtype=np.uint16)
+    depth_image[intrinsics.height // 4:3 * intrinsics.height // 4, intrinsics.width // 4:3 * intrinsics.width // 4] = \
+        round(foreground / depth_scale)
+    return depth_image
+
+
+def create_aruco_image(width: int, height: int, marker_count: int = 8) -> np.ndarray:
+    """Creates a bgr8 image of a gray scene with marker_count ArUco markers on a grid"""
+    image = np.full((height, width), 200, dtype=np.uint8)
+    columns = int(np.ceil(np.sqrt(marker_count * width / height)))
+    rows = int(np.ceil(marker_count / columns))
+    cell_size = min(width // columns, height // rows)
+    marker_size = cell_size * 2 // 3
+    from cv2 import aruco
+
+    dictionary = get_dictionary()
+    for index in range(marker_count):
+        row, column = divmod(index, columns)
+        top = row * cell_size + (cell_size - marker_size) // 2
+        left = column * cell_size + (cell_size - marker_size) // 2
+        image[top:top + marker_size, left:left + marker_size] = aruco.drawMarker(dictionary, index + 1, marker_size)
+    return np.repeat(image[:, :, np.newaxis], 3, axis=2)
+
+
+class SimulatedVideoStreamProfile:
+    def __init__(self, intrinsics: rs.intrinsics, to_depth: np.ndarray):
+        self._intrinsics = intrinsics
+        self._to_depth = np.asarray(to_depth, dtype=float)
+
+    def as_video_stream_profile(self) -> 'SimulatedVideoStreamProfile':
+        return self
+
+    def get_intrinsics(self) -> rs.intrinsics:
+        return self._intrinsics
+
+    def get_extrinsics_to(self, profile: 'SimulatedVideoStreamProfile') -> rs.extrinsics:
+        return create_extrinsics(np.linalg.inv(profile._to_depth).dot(self._to_depth))
+
+
+class SimulatedFrame:
+    def __init__(self, data: np.ndarray, profile: SimulatedVideoStreamProfile, frame_number: int, timestamp: float,
+                 depth_scale: float = DEFAULT_DEPTH_SCALE):
+        self._data = data
+        self._profile = profile
+        self._frame_number = frame_number
+        self._timestamp = timestamp
+        self._depth_scale = depth_scale
+
+    def get_data(self) -> np.ndarray:
+        return self._data
+
+    def get_profile(self) -> SimulatedVideoStreamProfile:
+        return self._profile
+
+    def get_frame_number(self) -> int:
+        return self._frame_number
+
+    def get_timestamp(self) -> float:
+        return self._timestamp
+
+    def get_distance(self, x: int, y: int) -> float:
+        return float(self._data[y, x]) * self._depth_scale
+
+    def keep(self):
+        pass
+
+
+class SimulatedFrames:
+    """Composite frame with the interface of rs.composite_frame used by Camera"""
+
+    def __init__(self, depth_frame: SimulatedFrame, color_frame: Optional[SimulatedFrame]):
+        self._depth_frame = depth_frame
+        self._color_frame = color_frame
+
+    def get_depth_frame(self) -> SimulatedFrame:
+        return self._depth_frame
+
+    def get_color_frame(self) -> Optional[SimulatedFrame]:
+        return self._color_frame
+
+    def get_frame_number(self) -> int:
+        return self._depth_frame.get_frame_number()
+
+    def get_timestamp(self) -> float:
+        return self._depth_frame.get_timestamp()
+
+    def keep(self):
+        pass
+
+
+class SimulatedCamera(Camera):
+    """Camera without device that cyclically delivers the given depth and color images.
+
+    Timestamps are given in ms and start at timestamp_offset. If realtime is set, poll_frames blocks until the next
+    frame is due according to the frame rate, otherwise frames are delivered as fast as they are polled.
+    """
+
+    def __init__(self, device_id: str, depth_images: List[np.ndarray] = None, color_images: List[np.ndarray] = None,
+                 depth_intrinsics: rs.intrinsics = None, color_intrinsics: rs.intrinsics = None,
+                 depth_to_color: np.ndarray = None, depth_scale: float = DEFAULT_DEPTH_SCALE, frame_rate: int = 30,
+                 timestamp_offset: float = 0., realtime: bool = False):
+        self.device_id = device_id
+        self._depth_scale = depth_scale
+        self._depth_intrinsics = depth_intrinsics or create_intrinsics()
+        self._color_intrinsics = color_intrinsics or self._depth_intrinsics
+        if depth_images is None:
+            depth_images = [create_depth_image(self._depth_intrinsics, depth_scale=depth_scale)]
+        if color_images is None:
+            color_images = [np.full((self._color_intrinsics.height, self._color_intrinsics.width, 3), 127,
+                                    dtype=np.uint8)]
+        self._depth_images = depth_images
+        self._color_images = color_images
+        self._depth_profile = SimulatedVideoStreamProfile(self._depth_intrinsics, np.eye(4))
+        self._color_profile = SimulatedVideoStreamProfile(
+            self._color_intrinsics, np.eye(4) if depth_to_color is None else np.linalg.inv(depth_to_color))
+        self._frame_rate = frame_rate
+        self._timestamp_offset = timestamp_offset
+        self._realtime = realtime
+        self._frame_number = 0
+        self._start_time = None
+        self._reset_stream_caches()
+
+    def poll_frames(self) -> SimulatedFrames:
+        """Returns a frames object with the next depth and color frame"""
+        period = 1. / self._frame_rate
+        if self._start_time is None:
+            self._start_time = time.monotonic()
+        if self._realtime:
+            delay = self._start_time + self._frame_number * period - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        timestamp = self._timestamp_offset + self._frame_number * period * 1000.
+        frames = SimulatedFrames(
+            SimulatedFrame(self._depth_images[self._frame_number % len(self._depth_images)], self._depth_profile,
+                           self._frame_number, timestamp, self._depth_scale),
+            SimulatedFrame(self._color_images[self._frame_number % len(self._color_images)], self._color_profile,
+                           self._frame_number, timestamp)
+        )
+        self._frame_number += 1
+        return frames
+
+    def close(self):
+        pass
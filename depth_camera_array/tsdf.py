@@ -0,0 +1,260 @@
+from typing import NamedTuple, Tuple
+
+import numpy as np
+from pyrealsense2 import pyrealsense2 as rs
+
+from depth_camera_array.crop_volumes import CropVolume
+from depth_camera_array.deprojection import project_points
+from depth_camera_array.rig import WorldRayTable
+
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+# Corner offsets of a cell and the pairs of corners that form its 12 edges
+_CORNERS = np.array([[x, y, z] for x in range(2) for y in range(2) for z in range(2)])
+_EDGES = [(first, second) for first in range(8) for second in range(first + 1, 8)
+          if np.abs(_CORNERS[first] - _CORNERS[second]).sum() == 1]
+_AXES = np.eye(3, dtype=np.int64)
+
+
+class TsdfMesh(NamedTuple):
+    vertices: np.ndarray
+    faces: np.ndarray
+
+
+def grid_keys(coordinates: np.ndarray) -> np.ndarray:
+    """Packs (N, 3) integer grid coordinates into one int64 key each. Unlike fusion.voxel_keys, the key of a coordinate
+    does not depend on the other coordinates, so keys of different frames can be compared"""
+    shifted = coordinates.astype(np.int64) + _KEY_OFFSET
+    return (shifted[:, 0] << 2 * _KEY_BITS) | (shifted[:, 1] << _KEY_BITS) | shifted[:, 2]
+
+
+class TsdfVolume:
+    """Truncated signed distance field in world coordinates that fuses the depth images of several cameras and frames.
+
+    Voxels are allocated in blocks of block_size^3 voxels. Each frame allocates only the blocks of the truncation band
+    around its measured surface, and only within the crop volume, so the memory is bounded by the crop volume instead of
+    growing with the number of frames. Only the voxels of these blocks are projected into the depth image and updated
+    by a weighted running average, whose weight is limited to max_weight so the volume keeps adapting. The signed
+    distance is positive in front of the surface and truncated to [-1, 1] in units of truncation.
+    """
+
+    def __init__(self, voxel_size: float = 0.005, truncation: float = None, block_size: int = 8,
+                 crop_volume: CropVolume = None, max_weight: float = 64., allocation_stride: int = 4,
+                 chunk_blocks: int = 256):
+        self.voxel_size = voxel_size
+        self.truncation = truncation or 4 * voxel_size
+        self.block_size = block_size
+        self.crop_volume = crop_volume
+        self.max_weight = max_weight
+        self.allocation_stride = allocation_stride
+        self.chunk_blocks = chunk_blocks
+        self.block_count = 0
+        self.integrated_frames = 0
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._key_slots = np.zeros(0, dtype=np.int64)
+        self._coordinates = np.zeros((0, 3), dtype=np.int64)
+        self._tsdf = np.ones((0, block_size ** 3), dtype=np.float32)
+        self._weights = np.zeros((0, block_size ** 3), dtype=np.float32)
+        steps = np.arange(block_size)
+        self._voxel_offsets = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 3)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._tsdf.nbytes + self._weights.nbytes + self._coordinates.nbytes + self._keys.nbytes * 2
+
+    def _find_slots(self, keys: np.ndarray) -> np.ndarray:
+        """Returns the storage slot of the block of each key or -1 if it is not allocated"""
+        if self._keys.shape[0] == 0:
+            return np.full(keys.shape[0], -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._keys, keys), self._keys.shape[0] - 1)
+        return np.where(self._keys[positions] == keys, self._key_slots[positions], -1)
+
+    def _allocate(self, coordinates: np.ndarray) -> np.ndarray:
+        """Allocates the blocks of the unique (N, 3) block coordinates that are new and returns the slots of all"""
+        keys = grid_keys(coordinates)
+        slots = self._find_slots(keys)
+        missing = np.flatnonzero(slots < 0)
+        if missing.shape[0] == 0:
+            return slots
+        count = self.block_count + missing.shape[0]
+        if count > self._tsdf.shape[0]:
+            capacity = max(count, 2 * self._tsdf.shape[0], 64)
+            self._coordinates = np.resize(self._coordinates, (capacity, 3))
+            tsdf = np.ones((capacity, self._tsdf.shape[1]), dtype=np.float32)
+            tsdf[:self.block_count] = self._tsdf[:self.block_count]
+            weights = np.zeros((capacity, self._weights.shape[1]), dtype=np.float32)
+            weights[:self.block_count] = self._weights[:self.block_count]
+            self._tsdf, self._weights = tsdf, weights
+        slots[missing] = np.arange(self.block_count, count)
+        self._coordinates[self.block_count:count] = coordinates[missing]
+        self.block_count = count
+        keys = np.concatenate([self._keys, keys[missing]])
+        key_slots = np.concatenate([self._key_slots, slots[missing]])
+        order = np.argsort(keys, kind='stable')
+        self._keys, self._key_slots = keys[order], key_slots[order]
+        return slots
+
+    def _touched_blocks(self, depth_image: np.ndarray, table: WorldRayTable) -> np.ndarray:
+        """Returns the unique coordinates of the blocks within the truncation band of the measured surface. Only every
+        allocation_stride-th pixel per row and column is used, which is sufficient as long as the pixel footprint times
+        the stride stays below the block size"""
+        height, width = depth_image.shape
+        stride = self.allocation_stride
+        depth_values = depth_image[::stride, ::stride].reshape(-1)
+        rays = table.rays.reshape(height, width, 3)[::stride, ::stride].reshape(-1, 3)
+        valid = np.flatnonzero(depth_values)
+        points = rays[valid] * depth_values[valid, np.newaxis].astype(np.float32) + table.origin
+        directions = points - table.origin
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        # A band of 2 * truncation is sampled at its ends and center, so no block of it is skipped
+        samples = np.concatenate([points + offset * directions
+                                  for offset in (-self.truncation, 0., self.truncation)])
+        if self.crop_volume is not None:
+            samples = samples[self.crop_volume.contains(samples)]
+        coordinates = np.floor(samples / (self.voxel_size * self.block_size)).astype(np.int64)
+        _, first = np.unique(grid_keys(coordinates), return_index=True)
+        return coordinates[first]
+
+    def integrate(self, depth_image: np.ndarray, table: WorldRayTable, intrinsics: rs.intrinsics, depth_scale: float,
+                  extrinsic: np.ndarray) -> int:
+        """Fuses a raw z16 depth image given the world ray table, intrinsics and 4x4 extrinsic of its camera. Returns
+        the number of updated voxels"""
+        slots = self._allocate(self._touched_blocks(depth_image, table))
+        extrinsic = np.asarray(extrinsic, dtype=np.float64)
+        rotation, translation = extrinsic[:3, :3], extrinsic[:3, 3]
+        height, width = depth_image.shape
+        updated = 0
+        for start in range(0, slots.shape[0], self.chunk_blocks):
+            chunk = slots[start:start + self.chunk_blocks]
+            voxels = self._coordinates[chunk][:, np.newaxis, :] * self.block_size + self._voxel_offsets
+            centers = (voxels.reshape(-1, 3) + 0.5) * self.voxel_size
+            camera_points = (centers - translation) @ rotation
+            pixels = np.rint(project_points(intrinsics, camera_points)).astype(np.int64)
+            visible = camera_points[:, 2] > 0
+            visible &= (pixels[:, 0] >= 0) & (pixels[:, 0] < width) & (pixels[:, 1] >= 0) & (pixels[:, 1] < height)
+            visible = np.flatnonzero(visible)
+            depths = depth_image[pixels[visible, 1], pixels[visible, 0]] * depth_scale
+            distances = depths - camera_points[visible, 2]
+            # Voxels far behind the surface are occluded and pixels without depth carry no information
+            observed = (depths > 0) & (distances >= -self.truncation)
+            indices = visible[observed]
+            values = np.minimum(distances[observed] / self.truncation, 1.).astype(np.float32)
+
+            tsdf = self._tsdf[chunk].reshape(-1)
+            weights = self._weights[chunk].reshape(-1)
+            previous = weights[indices]
+            tsdf[indices] = (tsdf[indices] * previous + values) / (previous + 1)
+            weights[indices] = np.minimum(previous + 1, self.max_weight)
+            self._tsdf[chunk] = tsdf.reshape(chunk.shape[0], -1)
+            self._weights[chunk] = weights.reshape(chunk.shape[0], -1)
+            updated += indices.shape[0]
+        self.integrated_frames += 1
+        return updated
+
+    def _padded_blocks(self, min_weight: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the voxel coordinates of the first voxel of each block and its signed distances and validity padded
+        by the first voxels of the neighbouring blocks in positive direction, so each block contains whole cells"""
+        size = self.block_size
+        count = self.block_count
+        coordinates = self._coordinates[:count]
+        tsdf = self._tsdf[:count].reshape(count, size, size, size)
+        valid = self._weights[:count].reshape(count, size, size, size) >= min_weight
+        # Truncated distances do not locate a surface
+        valid &= np.abs(tsdf) < 1
+        padded_tsdf = np.ones((count, size + 1, size + 1, size + 1), dtype=np.float32)
+        padded_valid = np.zeros((count, size + 1, size + 1, size + 1), dtype=bool)
+        padded_tsdf[:, :size, :size, :size] = tsdf
+        padded_valid[:, :size, :size, :size] = valid
+        for offset in _CORNERS[1:]:
+            neighbours = self._find_slots(grid_keys(coordinates + offset))
+            blocks = np.flatnonzero(neighbours >= 0)
+            source = (neighbours[blocks],) + tuple(slice(0, 1) if step else slice(0, size) for step in offset)
+            target = (blocks,) + tuple(slice(size, size + 1) if step else slice(0, size) for step in offset)
+            padded_tsdf[target] = tsdf[source]
+            padded_valid[target] = valid[source]
+        return coordinates * size, padded_tsdf, padded_valid
+
+    def _crossings(self, padded_tsdf: np.ndarray, padded_valid: np.ndarray, first: np.ndarray,
+                   axis: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the mask of the edges from the voxels of the blocks to their neighbour along the axis that cross the
+        surface and the position of the crossing along the edge, the first corners are given by index tuple first"""
+        size = self.block_size
+        second = tuple(slice(start + _AXES[axis][dimension], start + _AXES[axis][dimension] + size)
+                       for dimension, start in enumerate(first))
+        first = tuple(slice(start, start + size) for start in first)
+        values, neighbour_values = padded_tsdf[(slice(None),) + first], padded_tsdf[(slice(None),) + second]
+        crossing = padded_valid[(slice(None),) + first] & padded_valid[(slice(None),) + second]
+        crossing &= (values > 0) != (neighbour_values > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = values / (values - neighbour_values)
+        return crossing, fraction
+
+    def extract_points(self, min_weight: float = 1.) -> np.ndarray:
+        """Returns the (N, 3) float32 points where the zero level set crosses the edges between neighbouring voxels"""
+        origins, padded_tsdf, padded_valid = self._padded_blocks(min_weight)
+        local = self._voxel_offsets.reshape(self.block_size, self.block_size, self.block_size, 3)
+        points = []
+        for axis in range(3):
+            crossing, fraction = self._crossings(padded_tsdf, padded_valid, (0, 0, 0), axis)
+            blocks, x, y, z = np.nonzero(crossing)
+            positions = (origins[blocks] + local[x, y, z]).astype(np.float64) + 0.5
+            positions[:, axis] += fraction[blocks, x, y, z]
+            points.append(positions * self.voxel_size)
+        points = np.concatenate(points).astype(np.float32)
+        if self.crop_volume is not None:
+            points = points[self.crop_volume.contains(points)]
+        return points
+
+    def extract_mesh(self, min_weight: float = 1.) -> TsdfMesh:
+        """Extracts a triangle mesh of the zero level set by surface nets: each cell whose edges cross the surface gets
+        one vertex at the mean of the crossings, and each crossed edge connects the vertices of its four cells. Faces
+        point towards positive distance, i.e. towards the cameras"""
+        size = self.block_size
+        origins, padded_tsdf, padded_valid = self._padded_blocks(min_weight)
+        count = origins.shape[0]
+        sums = np.zeros((count, size, size, size, 3))
+        counts = np.zeros((count, size, size, size), dtype=np.int64)
+        for first, second in _EDGES:
+            axis = int(np.argmax(_CORNERS[second] - _CORNERS[first]))
+            crossing, fraction = self._crossings(padded_tsdf, padded_valid, tuple(_CORNERS[first]), axis)
+            offset = np.where(crossing[..., np.newaxis], _CORNERS[first].astype(np.float64), 0.)
+            offset[..., axis] += np.where(crossing, fraction, 0.)
+            sums += offset
+            counts += crossing
+        blocks, x, y, z = np.nonzero(counts)
+        cells = origins[blocks] + np.stack([x, y, z], axis=1)
+        vertices = ((cells + 0.5 + sums[blocks, x, y, z] / counts[blocks, x, y, z, np.newaxis]) *
+                    self.voxel_size).astype(np.float32)
+        cell_keys = grid_keys(cells)
+        order = np.argsort(cell_keys)
+        sorted_keys = cell_keys[order]
+
+        def find_vertices(coordinates: np.ndarray) -> np.ndarray:
+            keys = grid_keys(coordinates)
+            if sorted_keys.shape[0] == 0:
+                return np.full(keys.shape[0], -1)
+            positions = np.minimum(np.searchsorted(sorted_keys, keys), sorted_keys.shape[0] - 1)
+            return np.where(sorted_keys[positions] == keys, order[positions], -1)
+
+        local = self._voxel_offsets.reshape(size, size, size, 3)
+        faces = []
+        for axis in range(3):
+            crossing, _ = self._crossings(padded_tsdf, padded_valid, (0, 0, 0), axis)
+            blocks, x, y, z = np.nonzero(crossing)
+            voxels = origins[blocks] + local[x, y, z]
+            second, third = _AXES[(axis + 1) % 3], _AXES[(axis + 2) % 3]
+            quads = np.stack([find_vertices(voxels), find_vertices(voxels - second),
+                              find_vertices(voxels - second - third), find_vertices(voxels - third)], axis=1)
+            # The quad order results in normals along the axis, which have to point towards positive distance
+            flip = padded_tsdf[blocks, x, y, z] > 0
+            quads[flip] = quads[flip][:, ::-1]
+            quads = quads[np.all(quads >= 0, axis=1)]
+            faces += [quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]]
+        faces = np.concatenate(faces).astype(np.int32) if faces else np.zeros((0, 3), dtype=np.int32)
+        if self.crop_volume is not None:
+            inside = self.crop_volume.contains(vertices)
+            faces = faces[np.all(inside[faces], axis=1)]
+        used = np.unique(faces)
+        remap = np.full(vertices.shape[0], -1, dtype=np.int32)
+        remap[used] = np.arange(used.shape[0], dtype=np.int32)
+        return TsdfMesh(vertices[used], remap[faces])
@@ -0,0 +1 @@
+python -m depth_camera_array.perform_benchmark $*
\ No newline at end of file
@@ -0,0 +1 @@
+python -m depth_camera_array.perform_icp_refinement $*
\ No newline at end of file
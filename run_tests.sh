@@ -1,2 +1,24 @@
 python -m tests.test_perform_aruco_detection
-python -m tests.test_perform_calibration
\ No newline at end of file
+python -m tests.test_perform_calibration
+python -m tests.test_deprojection
+python -m tests.test_crop_volumes
+python -m tests.test_camera_array
+python -m tests.test_camera
+python -m tests.test_pipeline
+python -m tests.test_point_cloud_io
+python -m tests.test_fusion
+python -m tests.test_recording
+python -m tests.test_perform_benchmark
+python -m tests.test_instrumentation
+python -m tests.test_aruco_detection
+python -m tests.test_marker_accumulator
+python -m tests.test_rig
+python -m tests.test_shared_frames
+python -m tests.test_measurement_workers
+python -m tests.test_measurement_daemon
+python -m tests.test_capture_profiles
+python -m tests.test_tsdf
+python -m tests.test_incremental
+python -m tests.test_analytics
+python -m tests.test_registration
+python -m tests.test_buffer_pool
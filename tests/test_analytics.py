@@ -0,0 +1,72 @@
+import json
+import unittest
+
+import numpy as np
+
+from depth_camera_array.analytics import PointCloudIndex, summarize
+
+ANGLE = np.radians(30.)
+# Rotation around the y axis
+ROTATION = np.array([
+    [np.cos(ANGLE), 0., np.sin(ANGLE)],
+    [0., 1., 0.],
+    [-np.sin(ANGLE), 0., np.cos(ANGLE)]
+])
+
+
+def create_box_surface(lower: np.ndarray, upper: np.ndarray, point_count: int = 200000, seed: int = 0) -> np.ndarray:
+    """Samples points on the faces of a box, without its bottom face"""
+    random = np.random.RandomState(seed)
+    points = random.uniform(lower, upper, (point_count, 3))
+    faces = random.choice([0, 2, 1], point_count)
+    sides = random.randint(0, 2, point_count)
+    sides[faces == 1] = 1
+    points[np.arange(point_count), faces] = np.where(sides, upper[faces], lower[faces])
+    return points.astype(np.float32)
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lower, self.upper = np.array([-0.2, 0.1, -0.1]), np.array([0.2, 1.1, 0.1])
+        self.points = (create_box_surface(self.lower, self.upper) @ ROTATION.T.astype(np.float32))
+        self.index = PointCloudIndex(self.points, voxel_size=0.005)
+
+    def test_queries(self):
+        self.assertEqual(len(self.points), len(self.index))
+        self.assertAlmostEqual(1.1, self.index.height(0.), places=5)
+        lower, upper = self.index.bounding_box()
+        np.testing.assert_array_equal(self.points.min(axis=0), lower)
+        np.testing.assert_array_equal(self.points.max(axis=0), upper)
+
+        box = self.index.oriented_box()
+        np.testing.assert_allclose([0.4, 1., 0.2], box.extents, atol=1e-3)
+        np.testing.assert_allclose([0., 0.6, 0.], box.center, atol=1e-3)
+        self.assertAlmostEqual(1., abs(box.axes[0] @ ROTATION[:, 0]), places=3)
+
+        # The walls of the box at half height enclose 0.4 x 0.2 m, of which only the outline is occupied
+        section = self.index.cross_section(0.6)
+        local = section.points @ ROTATION[np.ix_([0, 2], [0, 2])]
+        self.assertTrue(np.all(np.abs(local) <= [0.2 + 1e-5, 0.1 + 1e-5]))
+        self.assertGreater(section.area, 0.)
+        self.assertLess(section.area, 0.4 * 0.2 / 2)
+
+        self.assertAlmostEqual(0.4 * 0.2 * 1.1, self.index.column_volume(0.), delta=0.1 * 0.4 * 0.2 * 1.1)
+        self.assertGreater(self.index.occupied_volume(), 0.)
+
+        shifted = self.points + np.float32([0.01, 0., 0.])
+        reference = PointCloudIndex(self.points, voxel_size=0.005)
+        distances = reference.nearest_distances(shifted)
+        self.assertLessEqual(distances.max(), 0.01 + 1e-5)
+        np.testing.assert_array_equal(np.zeros(len(self.points)), reference.nearest_distances(self.points))
+
+    def test_summary(self):
+        summary = summarize(self.index, 0.1, [0.5], reference=self.index)
+        self.assertEqual(summary, json.loads(json.dumps(summary)))
+        self.assertAlmostEqual(1., summary['height'], places=5)
+        self.assertEqual(0., summary['reference_distances']['max'])
+        self.assertEqual(1, len(summary['cross_sections']))
+        self.assertDictEqual({'point_count': 0, 'voxel_size': 0.01}, summarize(PointCloudIndex(np.zeros((0, 3))), 0.))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+
+from depth_camera_array.aruco_detection import ArucoDetector, regions_of_interest
+from depth_camera_array.simulation import create_aruco_image
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.image = create_aruco_image(1280, 720, marker_count=4)
+        self.corners, self.ids = ArucoDetector().detect(self.image)
+
+    def assertDetectionEqual(self, expected, actual):
+        self.assertListEqual(sorted(expected[1]), sorted(actual[1]))
+        order = [actual[1].index(aruco_id) for aruco_id in expected[1]]
+        np.testing.assert_allclose(expected[0], actual[0][order], atol=0.01)
+
+    def test_coarse_to_fine(self):
+        self.assertListEqual([1, 2, 3, 4], sorted(self.ids))
+        detection = ArucoDetector(coarse_scale=0.25).detect(self.image)
+        self.assertDetectionEqual((self.corners, self.ids), detection)
+
+    def test_tracking(self):
+        detector = ArucoDetector(coarse_scale=0.5, tracking=True)
+        detector.detect(self.image, 'cam_1')
+        self.assertDetectionEqual((self.corners, self.ids), detector.detect(self.image, 'cam_1'))
+
+        # If a tracked marker disappears, the whole image is searched again
+        image = self.image.copy()
+        left, top, right, bottom = regions_of_interest(self.corners[:1], image.shape, 0.1)[0]
+        image[top:bottom, left:right] = 200
+        corners, ids = detector.detect(image, 'cam_1')
+        self.assertListEqual(sorted(self.ids[1:]), sorted(ids))
+
+    def test_detect_all(self):
+        with ArucoDetector(workers=2) as detector:
+            # The thread pool is kept across frames
+            for _ in range(2):
+                detections = detector.detect_all({'cam_1': self.image, 'cam_2': np.full_like(self.image, 200)})
+                self.assertDetectionEqual((self.corners, self.ids), detections['cam_1'])
+                self.assertEqual((0, 4, 2), detections['cam_2'][0].shape)
+                self.assertListEqual([], detections['cam_2'][1])
+        with self.assertRaises(RuntimeError):
+            detector.detect_all({'cam_1': self.image, 'cam_2': self.image})
+
+    def test_regions_of_interest(self):
+        corners = np.array([[[10., 10.], [30., 10.], [30., 30.], [10., 30.]]], dtype=np.float32)
+        np.testing.assert_array_equal([[0, 0, 41, 40]], regions_of_interest(corners, (40, 60), 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import gc
+import unittest
+
+import numpy as np
+
+from depth_camera_array.buffer_pool import BufferPool
+from depth_camera_array.crop_volumes import MeasurementCylinder
+from depth_camera_array.instrumentation import Instrumentation
+from depth_camera_array.measurement import deproject_frame_set, release_points, transform_and_crop_point_clouds
+from depth_camera_array.rig import compile_pixel_mask, compile_world_rays, deproject_masked, deproject_to_world
+from depth_camera_array.simulation import SimulatedCamera, create_depth_image, create_intrinsics
+
+EXTRINSIC = np.array([
+    [1., 0., 0., 0.],
+    [0., -1., 0., 0.9],
+    [0., 0., -1., 1.5],
+    [0., 0., 0., 1.]
+])
+
+
+class MyTestCase(unittest.TestCase):
+    def test_checkout_and_checkin(self):
+        instrumentation = Instrumentation()
+        pool = BufferPool(instrumentation)
+        first = pool.checkout('deproject', 'cam_1', 'points', (10, 3), capacity=60)
+        self.assertTupleEqual((10, 3), first.shape)
+        self.assertEqual(np.float32, first.dtype)
+        pool.checkin(first)
+        # A smaller array reuses the buffer, a checked in array is ignored the second time
+        second = pool.checkout('deproject', 'cam_1', 'points', (20, 3))
+        pool.checkin(first)
+        self.assertEqual(1, pool.checked_out)
+        self.assertTrue(np.shares_memory(first, second))
+        third = pool.checkout('deproject', 'cam_1', 'points', (5, 3))
+        self.assertFalse(np.shares_memory(second, third))
+        self.assertEqual(2, pool.allocations)
+        self.assertEqual(1, pool.reuses)
+        self.assertDictEqual({('deproject', 'cam_1'): 25 * 3 * 4}, pool.peak_bytes())
+
+        # Arrays that are garbage collected without being checked in are not reused
+        del second, third
+        gc.collect()
+        self.assertEqual(0, pool.checked_out)
+        pool.checkout('deproject', 'cam_1', 'points', (5, 3))
+        self.assertEqual(3, pool.allocations)
+        pool.checkin(np.zeros(3))
+
+        snapshot = instrumentation.snapshot()
+        self.assertListEqual([{'stage': 'deproject', 'camera': 'cam_1', 'peak_bytes': 300}], snapshot['stage_memory'])
+        self.assertIn('depth_camera_array_stage_peak_memory_bytes{stage="deproject",camera="cam_1"} 300',
+                      instrumentation.to_prometheus())
+
+        # A closed pool no longer reports to the instrumentation
+        pool.close()
+        pool.checkout('deproject', 'cam_1', 'points', (100, 3))
+        self.assertEqual(300, instrumentation.snapshot()['stage_memory'][0]['peak_bytes'])
+
+    def test_pooled_deprojection(self):
+        intrinsics = create_intrinsics(64, 48)
+        depth_image = create_depth_image(intrinsics)
+        table = compile_world_rays(intrinsics, 0.001, EXTRINSIC)
+        mask = compile_pixel_mask(table, MeasurementCylinder(0., 1.8, 0.5), 0.001)
+        pool = BufferPool()
+        for _ in range(3):
+            for remove_zero_depth in [True, False]:
+                points = deproject_to_world(depth_image, table, remove_zero_depth, pool, 'cam_1')
+                np.testing.assert_array_equal(deproject_to_world(depth_image, table, remove_zero_depth), points)
+                pool.checkin(points)
+            points = deproject_masked(depth_image, mask, pool, 'cam_1')
+            np.testing.assert_array_equal(deproject_masked(depth_image, mask), points)
+            pool.checkin(points)
+        # Only the first frame allocates
+        allocations = pool.allocations
+        deproject_masked(depth_image, mask, pool, 'cam_1')
+        self.assertEqual(allocations, pool.allocations)
+
+    def test_pooled_measurement_without_rig(self):
+        intrinsics = create_intrinsics(64, 48)
+        depth_images = []
+        # The number of points grows from frame to frame
+        for rows in [40, 20, 0]:
+            depth_image = create_depth_image(intrinsics)
+            depth_image[:rows] = 0
+            depth_images.append(depth_image)
+        camera = SimulatedCamera('cam_1', depth_images, depth_intrinsics=intrinsics)
+        crop_volume = MeasurementCylinder(0., 1.8, 0.5)
+        pool = BufferPool()
+        allocations = []
+        for depth_image in depth_images:
+            frames = camera.poll_frames()
+            object_points = deproject_frame_set({'cam_1': camera}, {'cam_1': frames}, pool=pool)
+            self.assertEqual(np.count_nonzero(depth_image), len(object_points['cam_1']))
+            expected = transform_and_crop_point_clouds({'cam_1': camera.depth_frame_to_object_points(frames, True)},
+                                                       {'cam_1': EXTRINSIC}, crop_volume)
+            points = transform_and_crop_point_clouds(object_points, {'cam_1': EXTRINSIC}, crop_volume, pool=pool)
+            np.testing.assert_allclose(expected['cam_1'], points['cam_1'], atol=1e-6)
+            release_points(pool, points.values())
+            allocations.append(pool.allocations)
+        # Only the first frame allocates
+        self.assertEqual(allocations[0], allocations[-1])
+        self.assertEqual(0, pool.checked_out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+
+from depth_camera_array.simulation import SimulatedCamera, create_intrinsics, create_depth_image
+
+DEPTH_INTRINSICS = create_intrinsics(64, 48)
+COLOR_INTRINSICS = create_intrinsics(80, 60, horizontal_fov=69.)
+DEPTH_TO_COLOR = np.array([
+    [1., 0., 0., 0.015],
+    [0., 1., 0., 0.],
+    [0., 0., 1., 0.],
+    [0., 0., 0., 1.]
+])
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        depth_image = create_depth_image(DEPTH_INTRINSICS, background=3., foreground=1.5)
+        depth_image[:10, :] = 0
+        self.camera = SimulatedCamera('cam_1', depth_images=[depth_image], depth_intrinsics=DEPTH_INTRINSICS,
+                                      color_intrinsics=COLOR_INTRINSICS, depth_to_color=DEPTH_TO_COLOR)
+        self.frames = self.camera.poll_frames()
+
+    def test_depth_frame_to_object_points(self):
+        object_points = self.camera.depth_frame_to_object_points(self.frames)
+        self.assertEqual((64 * 48, 3), object_points.shape)
+        np.testing.assert_allclose(1.5, object_points[24 * 64 + 32, 2], rtol=1e-6)
+
+        object_points = self.camera.depth_frame_to_object_points(self.frames, remove_zero_depth=True)
+        self.assertEqual((64 * 38, 3), object_points.shape)
+
+    def test_image_points_to_object_points(self):
+        # The center of the box, a point on the wall and a pixel without depth at the top border
+        color_pixels = np.array([[39.5, 29.5], [70., 50.], [40., 2.]])
+        for use_aligned_depth in [False, True]:
+            object_points = self.camera.image_points_to_object_points(color_pixels, self.frames, use_aligned_depth)
+            self.assertEqual((3, 3), object_points.shape)
+            np.testing.assert_allclose([-0.015, 0., 1.5], object_points[0], atol=0.02)
+            np.testing.assert_allclose(3., object_points[1, 2], rtol=1e-3)
+            self.assertTrue(np.all(np.isnan(object_points[2])))
+
+    def test_align_depth_to_color_is_cached(self):
+        aligned_depth = self.camera.align_depth_to_color(self.frames)
+        self.assertEqual((60, 80), aligned_depth.shape)
+        self.assertIs(aligned_depth, self.camera.align_depth_to_color(self.frames))
+        self.assertIsNot(aligned_depth, self.camera.align_depth_to_color(self.camera.poll_frames()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+import numpy as np
+
+from depth_camera_array.camera_array import CameraArray
+from depth_camera_array.simulation import SimulatedCamera, create_intrinsics
+
+INTRINSICS = create_intrinsics(64, 48)
+
+
+def create_camera(device_id: str, timestamp_offset: float = 0., frame_rate: int = 200) -> SimulatedCamera:
+    return SimulatedCamera(device_id, depth_intrinsics=INTRINSICS, frame_rate=frame_rate,
+                           timestamp_offset=timestamp_offset, realtime=True)
+
+
+class FailingCamera(SimulatedCamera):
+    def poll_frames(self):
+        raise RuntimeError('Frame didn\'t arrive within 5000')
+
+
+class FiniteCamera(SimulatedCamera):
+    def __init__(self, device_id: str, frame_count: int):
+        super().__init__(device_id, depth_intrinsics=INTRINSICS)
+        self.remaining_frames = frame_count
+
+    def poll_frames(self):
+        if self.remaining_frames == 0:
+            raise EOFError(f'End of recording of camera {self.device_id}.')
+        self.remaining_frames -= 1
+        return super().poll_frames()
+
+
+class MyTestCase(unittest.TestCase):
+    def test_wait_for_frames(self):
+        cameras = [create_camera('cam_1'), create_camera('cam_2', 1.), create_camera('cam_3', -1.)]
+        with CameraArray(cameras, tolerance=2.5) as camera_array:
+            for _ in range(5):
+                frame_set = camera_array.wait_for_frames()
+                self.assertSetEqual({'cam_1', 'cam_2', 'cam_3'}, set(frame_set))
+                timestamps = [frames.get_timestamp() for frames in frame_set.values()]
+                self.assertLessEqual(max(timestamps) - min(timestamps), 2.5)
+
+    def test_unmatched_frames(self):
+        # cam_2 starts 3 frame periods (15 ms) later, so the first frames of the other cameras cannot be matched
+        cameras = [create_camera('cam_1'), create_camera('cam_2', 15.)]
+        with CameraArray(cameras, queue_size=8, tolerance=2.) as camera_array:
+            frame_set = camera_array.wait_for_frames()
+            statistics = camera_array.get_statistics()
+        np.testing.assert_almost_equal(15., frame_set['cam_1'].get_timestamp())
+        self.assertEqual(3, statistics['cam_1']['unmatched_frames'])
+        self.assertEqual(0, statistics['cam_2']['unmatched_frames'])
+
+    def test_failing_camera(self):
+        cameras = [create_camera('cam_1'), FailingCamera('cam_2', depth_intrinsics=INTRINSICS)]
+        with CameraArray(cameras) as camera_array:
+            with self.assertRaises(RuntimeError):
+                camera_array.wait_for_frames()
+
+    def test_end_of_stream(self):
+        # The first camera usually reaches its end before the second one captured anything
+        cameras = [FiniteCamera('cam_1', 3), FiniteCamera('cam_2', 3)]
+        with CameraArray(cameras, drop_frames=False) as camera_array:
+            for _ in range(3):
+                camera_array.wait_for_frames()
+            with self.assertRaises(EOFError):
+                camera_array.wait_for_frames()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from depth_camera_array.capture_profiles import CaptureProfile, HostDecimatedFrames, decimate_depth_image, \
+    get_capture_profile, CALIBRATION, MEASUREMENT
+from depth_camera_array.simulation import SimulatedCamera, create_depth_image, create_intrinsics
+
+RIG_CONFIG = {
+    'measurement': {'filters': ['decimation', 'spatial'], 'decimation': 3},
+    'cameras': {
+        'cam_2': {'measurement': {'depth_resolution': [848, 480], 'host_decimation': 2}}
+    }
+}
+
+
+class MyTestCase(unittest.TestCase):
+    def test_get_capture_profile(self):
+        self.assertEqual(CaptureProfile(), get_capture_profile({}, CALIBRATION, 'cam_1'))
+        self.assertFalse(get_capture_profile({}, MEASUREMENT, 'cam_1').color)
+
+        profile = get_capture_profile(RIG_CONFIG, MEASUREMENT, 'cam_1')
+        self.assertEqual(('decimation', 'spatial'), profile.filters)
+        self.assertEqual((240, 428), profile.depth_shape)
+        self.assertIsNone(profile.color_shape)
+
+        # The entry of a camera overrides the section of the purpose
+        profile = get_capture_profile(RIG_CONFIG, MEASUREMENT, 'cam_2')
+        self.assertEqual((848, 480), profile.depth_resolution)
+        self.assertEqual((80, 142), profile.depth_shape)
+        self.assertEqual(CaptureProfile(), get_capture_profile(RIG_CONFIG, CALIBRATION, 'cam_2'))
+
+        with self.assertRaises(ValueError):
+            get_capture_profile({'measurement': {'resolution': [640, 480]}}, MEASUREMENT)
+        with self.assertRaises(ValueError):
+            get_capture_profile({'measurement': {'filters': ['median']}}, MEASUREMENT)
+
+    def test_decimate_depth_image(self):
+        depth_image = np.array([
+            [1000, 1002, 0, 0, 7],
+            [1004, 0, 0, 0, 7],
+            [2000, 2000, 3000, 3001, 7]
+        ], dtype=np.uint16)
+        np.testing.assert_array_equal([[1002, 0]], decimate_depth_image(depth_image, 2))
+        np.testing.assert_array_equal(depth_image, decimate_depth_image(depth_image, 1))
+
+    def test_host_decimated_frames(self):
+        intrinsics = create_intrinsics(64, 48)
+        camera = SimulatedCamera('cam_1', [create_depth_image(intrinsics, background=2., foreground=2.)],
+                                 depth_intrinsics=intrinsics)
+        frames = HostDecimatedFrames(camera.poll_frames(), 4)
+        depth_frame = frames.get_depth_frame()
+        self.assertEqual((12, 16), depth_frame.get_data().shape)
+        self.assertEqual(16, depth_frame.get_profile().as_video_stream_profile().get_intrinsics().width)
+
+        # The decimated pixels deproject to the same plane, centered like the original image
+        object_points = camera.depth_frame_to_object_points(frames)
+        np.testing.assert_allclose(2., object_points[:, 2], rtol=1e-6)
+        np.testing.assert_allclose([0., 0.], object_points[:, :2].mean(axis=0), atol=1e-6)
+        self.assertIsNotNone(camera.get_stream_calibration(frames))
+
+
+if __name__ == '__main__':
+    unittest.main()
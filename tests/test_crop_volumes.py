@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from depth_camera_array.crop_volumes import AxisAlignedBox, MeasurementCylinder, OrientedBox, transform_and_crop
+
+EXTRINSIC = np.array([
+    [0.36063609, 0.14959066, 0.92063253, 1.4],
+    [-0.20461186, 0.97569952, - 0.07838645, -3.1],
+    [-0.90998659, - 0.16010336, 0.38248048, 2.3],
+    [0., 0., 0., 1.]
+])
+
+
+def transform_homogeneous(points: np.ndarray, extrinsic: np.ndarray) -> np.ndarray:
+    homogeneous = np.ones((4, points.shape[0]))
+    homogeneous[:-1, :] = points.transpose()
+    return extrinsic.dot(homogeneous)[:-1, :].transpose()
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.object_points = np.random.RandomState(0).uniform(-4., 4., (1000, 3)).astype(np.float32)
+
+    def test_transform_and_crop_cylinder(self):
+        transformed = transform_homogeneous(self.object_points, EXTRINSIC)
+        expected = [point for point in transformed
+                    if np.linalg.norm([point[0], point[2]]) <= 2. and -1. <= point[1] <= 1.5]
+
+        result = transform_and_crop(self.object_points, EXTRINSIC, MeasurementCylinder(-1., 2.5, 2.))
+        self.assertEqual(np.float32, result.dtype)
+        self.assertGreater(len(expected), 0)
+        np.testing.assert_allclose(expected, result, rtol=1e-5, atol=1e-5)
+
+    def test_axis_aligned_box(self):
+        box = AxisAlignedBox([-1., 0., -2.], [1., 2., 2.])
+        points = np.array([[0., 1., 0.], [1.5, 1., 0.], [0., -0.1, 0.], [-1., 2., 2.]])
+        np.testing.assert_array_equal([True, False, False, True], box.contains(points))
+
+    def test_oriented_box(self):
+        angle = np.pi / 4
+        rotation = np.array([[np.cos(angle), 0., np.sin(angle)], [0., 1., 0.], [-np.sin(angle), 0., np.cos(angle)]])
+        box = OrientedBox([1., 0., 0.], [1., 1., 0.1], rotation)
+        points = np.array([[1., 0., 0.], [1.5, 0.5, -0.5], [1.5, 0.5, 0.5], [2., 0., 0.]])
+        np.testing.assert_array_equal([True, True, False, False], box.contains(points))
+
+    def test_intersect_rays(self):
+        random_state = np.random.RandomState(1)
+        rotation = np.linalg.qr(random_state.randn(3, 3))[0]
+        origin = np.array([3., 1., -4.])
+        rays = random_state.randn(200, 3)
+        rays[0] = [0., 1., 0.]
+        parameters = np.linspace(0., 10., 500)
+        for volume in [MeasurementCylinder(-1., 2.5, 2.), AxisAlignedBox([-1., 0., -2.], [1., 2., 2.]),
+                       OrientedBox([0.5, 0.2, 0.], [1., 0.5, 2.], rotation)]:
+            near, far = volume.intersect_rays(origin, rays)
+            self.assertTrue(np.any(near <= far))
+            for ray, ray_near, ray_far in zip(rays, near, far):
+                inside = volume.contains(origin + parameters[:, np.newaxis] * ray)
+                np.testing.assert_array_equal(inside, (parameters >= ray_near - 1e-9) & (parameters <= ray_far + 1e-9))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+
+import numpy as np
+from pyrealsense2 import pyrealsense2 as rs
+
+from depth_camera_array.deprojection import create_ray_table, deproject_depth_image, deproject_pixels, project_points, \
+    align_depth_to_color, sample_depth, project_color_pixels_to_depth_pixels
+
+DEPTH_SCALE = 0.001
+
+
+def create_intrinsics(model: rs.distortion, coeffs) -> rs.intrinsics:
+    intrinsics = rs.intrinsics()
+    intrinsics.width = 8
+    intrinsics.height = 6
+    intrinsics.fx = 6.4
+    intrinsics.fy = 6.2
+    intrinsics.ppx = 3.7
+    intrinsics.ppy = 2.6
+    intrinsics.model = model
+    intrinsics.coeffs = coeffs
+    return intrinsics
+
+
+DISTORTIONS = [
+    (rs.distortion.none, [0., 0., 0., 0., 0.]),
+    (rs.distortion.brown_conrady, [0.1, 0.05, 0.01, 0.02, 0.003]),
+    (rs.distortion.inverse_brown_conrady, [0.1, 0.05, 0.01, 0.02, 0.003]),
+    (rs.distortion.modified_brown_conrady, [0.1, 0.05, 0.01, 0.02, 0.003]),
+    (rs.distortion.kannala_brandt4, [0.1, 0.05, 0.01, 0.02, 0.]),
+    (rs.distortion.ftheta, [0.1, 0., 0., 0., 0.]),
+]
+
+
+class MyTestCase(unittest.TestCase):
+    def test_deproject_pixels(self):
+        pixels = np.array([[0., 0.], [7.5, 5.], [3.7, 2.6], [1.25, 4.75]])
+        depths = np.array([0.5, 1.2, 3., 0.])
+        for model, coeffs in DISTORTIONS:
+            intrinsics = create_intrinsics(model, coeffs)
+            expected = [rs.rs2_deproject_pixel_to_point(intrinsics, pixel.tolist(), depth)
+                        for pixel, depth in zip(pixels, depths)]
+            result = deproject_pixels(intrinsics, pixels, depths)
+            self.assertEqual(np.float32, result.dtype)
+            np.testing.assert_allclose(expected, result, rtol=1e-4, atol=1e-6, err_msg=str(model))
+
+    def test_deproject_depth_image(self):
+        intrinsics = create_intrinsics(*DISTORTIONS[2])
+        depth_image = np.arange(48, dtype=np.uint16).reshape(6, 8) * 100
+        ray_table = create_ray_table(intrinsics, DEPTH_SCALE)
+        expected = [rs.rs2_deproject_pixel_to_point(intrinsics, [x, y], depth_image[y, x] * DEPTH_SCALE)
+                    for y in range(intrinsics.height) for x in range(intrinsics.width)]
+
+        result = deproject_depth_image(depth_image, ray_table)
+        self.assertEqual((48, 3), result.shape)
+        self.assertEqual(np.float32, result.dtype)
+        np.testing.assert_allclose(expected, result, rtol=1e-4, atol=1e-6)
+
+        result = deproject_depth_image(depth_image, ray_table, remove_zero_depth=True)
+        np.testing.assert_allclose(expected[1:], result, rtol=1e-4, atol=1e-6)
+
+    def test_deproject_depth_image_with_wrong_shape(self):
+        ray_table = create_ray_table(create_intrinsics(*DISTORTIONS[0]))
+        with self.assertRaises(ValueError):
+            deproject_depth_image(np.zeros((4, 4), dtype=np.uint16), ray_table)
+
+    def test_project_points(self):
+        points = np.array([[0.3, 0.2, 1.], [-0.4, 0.1, 2.5], [0., 0., 0.7]])
+        for model, coeffs in DISTORTIONS:
+            intrinsics = create_intrinsics(model, coeffs)
+            expected = [rs.rs2_project_point_to_pixel(intrinsics, point.tolist()) for point in points]
+            np.testing.assert_allclose(expected, project_points(intrinsics, points), rtol=1e-4, err_msg=str(model))
+
+    def test_align_depth_to_color(self):
+        intrinsics = create_intrinsics(*DISTORTIONS[0])
+        depth_image = np.full((6, 8), 1000, dtype=np.uint16)
+        depth_image[2:4, 3:5] = 500
+        depth_image[0, 0] = 0
+        depth_to_color = np.eye(4, dtype=np.float32)
+        depth_to_color[0, 3] = 0.2
+
+        aligned_depth = align_depth_to_color(depth_image, create_ray_table(intrinsics, DEPTH_SCALE), depth_to_color,
+                                             intrinsics)
+        self.assertEqual((6, 8), aligned_depth.shape)
+        np.testing.assert_allclose(0.5, aligned_depth[2:4, 6:8])
+        np.testing.assert_allclose(1., aligned_depth[5, 3:5])
+        self.assertEqual(0., aligned_depth[0, 0])
+
+    def test_sample_depth(self):
+        depth_image = np.zeros((5, 5), dtype=np.float32)
+        depth_image[2, 2] = 1.
+        depth_image[0, 0] = 2.
+        depth_image[1, 2] = 3.
+        result = sample_depth(depth_image, np.array([[2.2, 1.9], [1., 1.], [4., 4.], [10., 1.]]))
+        np.testing.assert_array_equal([1., 2., np.nan, np.nan], result)
+
+    def test_project_color_pixels_to_depth_pixels(self):
+        intrinsics = create_intrinsics(*DISTORTIONS[0])
+        depth_image = np.full((6, 8), 1000, dtype=np.uint16)
+        depth_image[5] = 0
+        depth_to_color = np.eye(4, dtype=np.float32)
+        depth_to_color[0, 3] = 0.2
+        color_to_depth = np.linalg.inv(depth_to_color)
+
+        color_pixels = np.array([[3., 1.], [6.5, 2.], [7., 4.], [4., 5.]])
+        depth_pixels = project_color_pixels_to_depth_pixels(
+            color_pixels, depth_image, create_ray_table(intrinsics, DEPTH_SCALE), intrinsics, intrinsics,
+            depth_to_color, color_to_depth)
+        # At 1 m, the baseline of 0.2 m shifts each pixel by 0.2 fx to the right in the color image, so the closest
+        # depth pixel lies about that far to the left
+        np.testing.assert_array_equal(np.rint(color_pixels[:3] - [0.2 * intrinsics.fx, 0.]),
+                                      np.floor(depth_pixels[:3]))
+        # The epipolar line of the last pixel only crosses pixels without depth
+        self.assertTrue(np.all(np.isnan(depth_pixels[3])))
+
+
+if __name__ == '__main__':
+    unittest.main()
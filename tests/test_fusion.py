@@ -0,0 +1,47 @@
+import unittest
+
+import numpy as np
+
+from depth_camera_array.fusion import fuse_point_clouds, voxel_downsample, MEDIAN
+
+
+class MyTestCase(unittest.TestCase):
+    def test_voxel_downsample_centroid(self):
+        points = np.array([[0.01, 0.01, 0.01], [0.03, 0.05, 0.07], [0.15, 0.01, 0.01], [-0.05, 0.01, 0.01]])
+        result = voxel_downsample(points, 0.1, with_counts=True)
+        order = np.argsort(result.points[:, 0])
+        np.testing.assert_allclose([[-0.05, 0.01, 0.01], [0.02, 0.03, 0.04], [0.15, 0.01, 0.01]],
+                                   result.points[order], rtol=1e-6)
+        np.testing.assert_array_equal([1, 2, 1], result.counts[order])
+
+    def test_voxel_downsample_median(self):
+        points = np.array([[0.01, 0.01, 0.01], [0.02, 0.02, 0.02], [0.09, 0.09, 0.09]])
+        result = voxel_downsample(points, 0.1, reduction=MEDIAN)
+        np.testing.assert_allclose([[0.02, 0.02, 0.02]], result.points, rtol=1e-6)
+
+    def test_voxel_downsample_with_memory_limit(self):
+        points = np.random.RandomState(0).uniform(-1., 1., (5000, 3)).astype(np.float32)
+        camera_indices = np.arange(5000) % 3
+        expected = voxel_downsample(points, 0.2, camera_indices=camera_indices, with_counts=True)
+        result = voxel_downsample(points, 0.2, camera_indices=camera_indices, with_counts=True, memory_limit=100000)
+        expected_order = np.lexsort(expected.points.T)
+        result_order = np.lexsort(result.points.T)
+        np.testing.assert_allclose(expected.points[expected_order], result.points[result_order], rtol=1e-5)
+        np.testing.assert_array_equal(expected.counts[expected_order], result.counts[result_order])
+        np.testing.assert_array_equal(expected.camera_masks[expected_order], result.camera_masks[result_order])
+
+    def test_fuse_point_clouds(self):
+        point_clouds = {
+            'cam_2': np.array([[0.01, 0.01, 0.01], [0.55, 0.01, 0.01]], dtype=np.float32),
+            'cam_1': np.array([[0.03, 0.03, 0.03], [0.35, 0.01, 0.01]], dtype=np.float32),
+        }
+        result = fuse_point_clouds(point_clouds, 0.1, with_statistics=True)
+        order = np.argsort(result.points[:, 0])
+        self.assertListEqual(['cam_1', 'cam_2'], result.camera_ids)
+        np.testing.assert_allclose([0.02, 0.35, 0.55], result.points[order, 0], rtol=1e-6)
+        np.testing.assert_array_equal([2, 1, 1], result.counts[order])
+        np.testing.assert_array_equal([3, 1, 2], result.camera_masks[order])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from depth_camera_array.crop_volumes import MeasurementCylinder
+from depth_camera_array.incremental import ChangeDetection, IncrementalDeprojector
+from depth_camera_array.measurement import create_measurement_stages
+from depth_camera_array.pipeline import Pipeline
+from depth_camera_array.rig import CompiledRig, compile_world_rays, deproject_to_world
+from depth_camera_array.simulation import SimulatedCamera, create_depth_image, create_intrinsics
+
+DEPTH_SCALE = 0.001
+# Moves the box in front of the camera into the cylinder
+EXTRINSIC = np.array([
+    [1., 0., 0., 0.],
+    [0., -1., 0., 0.9],
+    [0., 0., -1., 1.5],
+    [0., 0., 0., 1.]
+])
+CROP_VOLUME = MeasurementCylinder(0., 1.8, 0.5)
+
+
+def expected_points(depth_image: np.ndarray, table) -> np.ndarray:
+    points = deproject_to_world(depth_image, table, remove_zero_depth=False)
+    return points[(depth_image.reshape(-1) > 0) & CROP_VOLUME.contains(points)]
+
+
+class MyTestCase(unittest.TestCase):
+    def test_update(self):
+        intrinsics = create_intrinsics(64, 48)
+        table = compile_world_rays(intrinsics, DEPTH_SCALE, EXTRINSIC)
+        depth_image = create_depth_image(intrinsics)
+        deprojector = IncrementalDeprojector(table, depth_image.shape, DEPTH_SCALE, CROP_VOLUME, ChangeDetection(16))
+        changes = deprojector.update(depth_image)
+        self.assertTupleEqual((3, 4), changes.tiles.shape)
+        self.assertTrue(np.all(changes.tiles))
+        np.testing.assert_allclose(expected_points(depth_image, table), deprojector.points, atol=1e-5)
+
+        # Noise below the threshold and single flickering pixels do not change any tile
+        noisy = depth_image + np.random.RandomState(0).randint(0, 4, depth_image.shape).astype(np.uint16)
+        noisy[5, 5] = 0
+        self.assertFalse(np.any(deprojector.update(noisy).tiles))
+        self.assertEqual(0, deprojector.changed_points(deprojector.update(noisy)).shape[0])
+
+        # An object enters the upper left corner
+        moved = depth_image.copy()
+        moved[12:20, 20:30] = 1200
+        changes = deprojector.update(moved)
+        expected = np.zeros((3, 4), dtype=bool)
+        expected[0, 1] = expected[1, 1] = True
+        np.testing.assert_array_equal(expected, changes.tiles)
+        self.assertEqual(2 * 16 * 16, changes.pixels.shape[0])
+        np.testing.assert_allclose(expected_points(moved, table), deprojector.points, atol=1e-5)
+        points = deproject_to_world(moved, table, remove_zero_depth=False)[changes.pixels]
+        np.testing.assert_allclose(points[CROP_VOLUME.contains(points)], deprojector.changed_points(changes),
+                                   atol=1e-5)
+
+    def test_incremental_stages(self):
+        intrinsics = create_intrinsics(64, 48)
+        still = create_depth_image(intrinsics)
+        moved = still.copy()
+        moved[:8, :8] = 1000
+        camera = SimulatedCamera('cam_1', [still, still, moved], depth_intrinsics=intrinsics)
+        measurements = []
+        with tempfile.TemporaryDirectory() as rig_dir:
+            rig = CompiledRig(rig_dir, {'cam_1': EXTRINSIC})
+            Pipeline(
+                source=({'cam_1': camera.poll_frames()} for _ in range(3)),
+                stages=create_measurement_stages([camera], {'cam_1': EXTRINSIC}, CROP_VOLUME, rig=rig,
+                                                 change_detection=ChangeDetection()),
+                sink=measurements.append
+            ).run()
+            table = rig.get_table('cam_1', intrinsics, camera.depth_scale)
+        changed_tiles = [measurement.attributes['cam_1_changed_tiles'] for measurement in measurements]
+        self.assertListEqual([12, 0, 1], [int(np.count_nonzero(tiles)) for tiles in changed_tiles])
+        self.assertTrue(changed_tiles[2][0, 0])
+        np.testing.assert_allclose(expected_points(moved, table), measurements[2].points['cam_1'], atol=1e-5)
+
+    def test_depth_range(self):
+        intrinsics = create_intrinsics(64, 48)
+        still = create_depth_image(intrinsics)
+        moved = still.copy()
+        # An object closer than the maximum depth enters the box in the cylinder
+        moved[20:28, 28:36] = 1400
+        camera = SimulatedCamera('cam_1', [still, moved], depth_intrinsics=intrinsics)
+        frame_sets = [{'cam_1': camera.poll_frames()} for _ in range(2)]
+        results = []
+        with tempfile.TemporaryDirectory() as rig_dir:
+            rig = CompiledRig(rig_dir, {'cam_1': EXTRINSIC}, CROP_VOLUME, (0., 1.45))
+            for change_detection in [None, ChangeDetection()]:
+                measurements = []
+                Pipeline(
+                    source=iter(frame_sets),
+                    stages=create_measurement_stages([camera], {'cam_1': EXTRINSIC}, CROP_VOLUME, rig=rig,
+                                                     change_detection=change_detection),
+                    sink=measurements.append
+                ).run()
+                results.append([measurement.points['cam_1'] for measurement in measurements])
+        self.assertListEqual([0, 64], [points.shape[0] for points in results[1]])
+        for points, incremental_points in zip(*results):
+            np.testing.assert_allclose(points, incremental_points, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import unittest
+
+from depth_camera_array.camera_array import CameraArray
+from depth_camera_array.instrumentation import Instrumentation, LatencyHistogram, DISABLED
+from depth_camera_array.simulation import SimulatedCamera, create_intrinsics
+
+
+class MyTestCase(unittest.TestCase):
+    def test_disabled(self):
+        with DISABLED.measure('deproject', 'cam_1'):
+            pass
+        DISABLED.increment('bytes_written', 'cam_1', 100)
+        snapshot = DISABLED.snapshot()
+        self.assertEqual([], snapshot['stages'])
+        self.assertEqual([], snapshot['counters'])
+
+    def test_histogram_quantile(self):
+        histogram = LatencyHistogram([0.001, 0.01, 0.1])
+        for index, seconds in enumerate([0.0005] * 90 + [0.005] * 9 + [0.05]):
+            histogram.observe(seconds, float(index))
+        self.assertEqual([90, 9, 1, 0], histogram.bucket_counts)
+        self.assertEqual(0.001, histogram.quantile(0.5))
+        self.assertEqual(0.01, histogram.quantile(0.99))
+        self.assertEqual(0.05, histogram.quantile(1.))
+        self.assertAlmostEqual(1., histogram.frames_per_second)
+
+    def test_export(self):
+        instrumentation = Instrumentation()
+        instrumentation.observe('deproject', 'cam_1', 0.002)
+        instrumentation.observe('deproject', 'cam_1', 0.004)
+        instrumentation.increment('bytes_written', 'cam_1', 1200)
+        with tempfile.TemporaryDirectory() as directory:
+            instrumentation.export(os.path.join(directory, 'metrics.json'))
+            instrumentation.export(os.path.join(directory, 'metrics.prom'))
+            with open(os.path.join(directory, 'metrics.json')) as f:
+                metrics = json.load(f)
+            with open(os.path.join(directory, 'metrics.prom')) as f:
+                text = f.read()
+        self.assertEqual(2, metrics['stages'][0]['frames'])
+        self.assertAlmostEqual(3., metrics['stages'][0]['mean_ms'])
+        self.assertEqual([{'counter': 'bytes_written', 'camera': 'cam_1', 'value': 1200}], metrics['counters'])
+        self.assertIn('depth_camera_array_stage_latency_seconds_bucket{stage="deproject",camera="cam_1",le="0.0025"} 1',
+                      text)
+        self.assertIn('depth_camera_array_stage_latency_seconds_count{stage="deproject",camera="cam_1"} 2', text)
+        self.assertIn('depth_camera_array_bytes_written_total{camera="cam_1"} 1200', text)
+
+    def test_camera_array(self):
+        instrumentation = Instrumentation()
+        cameras = [SimulatedCamera(device_id, depth_intrinsics=create_intrinsics(64, 48), frame_rate=200,
+                                   realtime=True) for device_id in ['cam_1', 'cam_2']]
+        with CameraArray(cameras, instrumentation=instrumentation) as camera_array:
+            for _ in range(3):
+                camera_array.wait_for_frames()
+        snapshot = instrumentation.snapshot()
+        self.assertSetEqual({('capture', 'cam_1'), ('capture', 'cam_2')},
+                            {(stage['stage'], stage['camera']) for stage in snapshot['stages']})
+        self.assertSetEqual({('dropped_frames', 'cam_1'), ('dropped_frames', 'cam_2'), ('unmatched_frames', 'cam_1'),
+                             ('unmatched_frames', 'cam_2')},
+                            {(counter['counter'], counter['camera']) for counter in snapshot['counters']})
+        # The stopped camera array keeps its final counters but no longer sets them
+        instrumentation.set_counter('dropped_frames', 'cam_1', 99)
+        self.assertIn({'counter': 'dropped_frames', 'camera': 'cam_1', 'value': 99},
+                      instrumentation.snapshot()['counters'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import numpy as np
+
+from depth_camera_array.marker_accumulator import MarkerAccumulator
+
+
+class MyTestCase(unittest.TestCase):
+    def test_mean_and_spread(self):
+        random = np.random.RandomState(0)
+        centers = np.array([[0., 0., 1.], [0.5, 0., 2.]]) + random.normal(0., 0.002, (100, 2, 3))
+        corners = centers[:, :, np.newaxis, :] + np.array([[-0.05, -0.05, 0.], [0.05, -0.05, 0.], [0.05, 0.05, 0.],
+                                                           [-0.05, 0.05, 0.]])
+        accumulator = MarkerAccumulator()
+        for frame_centers, frame_corners in zip(centers, corners):
+            accumulator.add([7, 3], frame_centers, frame_corners)
+        markers = accumulator.result()
+        self.assertListEqual([3, 7], markers.aruco_ids)
+        np.testing.assert_allclose(centers.mean(axis=0)[::-1], markers.centers, atol=1e-3)
+        np.testing.assert_allclose(corners.mean(axis=0)[::-1], markers.corners, atol=1e-3)
+        np.testing.assert_allclose(centers.std(axis=0)[::-1], markers.spread, rtol=1e-6)
+        np.testing.assert_array_equal([100, 100], markers.counts)
+
+    def test_outlier_rejection(self):
+        accumulator = MarkerAccumulator()
+        for index in range(20):
+            center = [0., 0., 1. + 0.001 * (index % 2)]
+            if index == 10:
+                center = [0., 0., 3.]
+            accumulator.add([1, 2], [center, [np.nan] * 3])
+        markers = accumulator.result()
+        self.assertListEqual([1], markers.aruco_ids)
+        np.testing.assert_array_equal([19], markers.counts)
+        np.testing.assert_array_equal([1], markers.rejected)
+        np.testing.assert_allclose([[0., 0., 1.0005]], markers.centers, atol=1e-4)
+        self.assertTrue(np.all(np.isnan(markers.corners)))
+
+    def test_outlier_among_first_samples(self):
+        accumulator = MarkerAccumulator()
+        for index in range(20):
+            center = [0., 0., 1. + 0.001 * (index % 2)]
+            if index in [1, 10]:
+                center = [0., 0., 1.05]
+            accumulator.add([1], [center])
+        markers = accumulator.result()
+        # The first outlier does not inflate the variance, so the second one is rejected as well
+        np.testing.assert_array_equal([2], markers.rejected)
+        np.testing.assert_array_equal([18], markers.counts)
+        np.testing.assert_allclose([[0., 0., 1.0005]], markers.centers, atol=1e-4)
+
+        # Markers with less than min_samples samples are checked against their median as well
+        accumulator = MarkerAccumulator()
+        for center in [[0., 0., 1.], [0., 0., 3.], [0., 0., 1.001]]:
+            accumulator.add([1], [center])
+        np.testing.assert_array_equal([1], accumulator.result().rejected)
+        # Getting the result does not change the samples
+        accumulator.add([1], [[0., 0., 1.]])
+        np.testing.assert_array_equal([3], accumulator.result().counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
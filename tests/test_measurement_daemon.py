@@ -0,0 +1,142 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from depth_camera_array.crop_volumes import MeasurementCylinder
+from depth_camera_array.measurement import create_analytics, create_fusion
+from depth_camera_array.measurement_daemon import MeasurementService, request_measurements, CANCELLED, DONE, ERROR, \
+    MEASUREMENT
+from depth_camera_array.simulation import SimulatedCamera, create_intrinsics
+
+
+def create_service(data_dir: str) -> MeasurementService:
+    intrinsics = create_intrinsics(32, 24)
+    cameras = [SimulatedCamera(device_id, depth_intrinsics=intrinsics, frame_rate=100, realtime=True)
+               for device_id in ['cam_1', 'cam_2']]
+    fuse = create_fusion(0.01)
+    analyze = create_analytics(0.01, -5., [5.])
+    return MeasurementService(cameras, {'cam_1': np.eye(4), 'cam_2': np.eye(4)}, MeasurementCylinder(-5., 10., 5.),
+                              data_dir, ['npy'], fuse=fuse, analyze=analyze, max_active_jobs=2)
+
+
+async def collect(socket_path: str, request: dict) -> list:
+    return [message async for message in request_measurements(socket_path, request)]
+
+
+class MyTestCase(unittest.TestCase):
+    def test_requests(self):
+        async def run(data_dir: str, socket_path: str) -> dict:
+            service = create_service(data_dir)
+            ready = asyncio.Event()
+            server = asyncio.create_task(service.serve(socket_path, ready.set))
+            await ready.wait()
+            try:
+                snapshot, burst, fused = await asyncio.gather(
+                    collect(socket_path, {'id': 'a', 'type': 'snapshot'}),
+                    collect(socket_path, {'id': 'b', 'type': 'burst', 'frame_count': 3}),
+                    collect(socket_path, {'id': 'c', 'type': 'snapshot', 'fuse': True, 'analytics': True,
+                                          'output_formats': []}),
+                )
+                # Requests are rejected if too many jobs are queued
+                service.max_queued_jobs = 0
+                rejected = await collect(socket_path, {'id': 'g', 'type': 'snapshot'})
+                service.max_queued_jobs = 4
+                timeout = await collect(socket_path, {'id': 'd', 'type': 'subscribe', 'timeout': 0.1})
+                invalid = await collect(socket_path, {'id': 'e', 'type': 'burst'})
+
+                # A subscription runs until it is cancelled
+                reader, writer = await asyncio.open_unix_connection(socket_path)
+                writer.write(json.dumps({'id': 'f', 'type': 'subscribe'}).encode() + b'\n')
+                subscription = [json.loads(await reader.readline()) for _ in range(2)]
+                writer.write(json.dumps({'id': 'f', 'type': 'cancel'}).encode() + b'\n')
+                while subscription[-1]['type'] == MEASUREMENT:
+                    subscription.append(json.loads(await reader.readline()))
+                writer.close()
+                status = await collect(socket_path, {'type': 'status'})
+            finally:
+                server.cancel()
+                await asyncio.gather(server, return_exceptions=True)
+            return {'snapshot': snapshot, 'burst': burst, 'fused': fused, 'rejected': rejected, 'timeout': timeout,
+                    'invalid': invalid, 'subscription': subscription, 'status': status}
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = asyncio.run(run(data_dir, os.path.join(data_dir, 'daemon.sock')))
+            self.assertFalse(os.path.exists(os.path.join(data_dir, 'daemon.sock')))
+
+            snapshot = results['snapshot']
+            self.assertListEqual([MEASUREMENT, DONE], [message['type'] for message in snapshot])
+            self.assertDictEqual({'cam_1': 32 * 24, 'cam_2': 32 * 24}, snapshot[0]['point_counts'])
+            self.assertSetEqual({'cam_1.npy', 'cam_2.npy'}, set(os.listdir(snapshot[0]['output_dir'])))
+
+            burst = results['burst']
+            self.assertListEqual([0, 1, 2], [message['frame_number'] for message in burst[:-1]])
+            self.assertEqual(3, burst[-1]['frame_count'])
+            self.assertEqual(6, len(os.listdir(burst[0]['output_dir'])))
+            self.assertListEqual(['fused'], list(results['fused'][0]['point_counts']))
+            self.assertIsNone(results['fused'][0]['output_dir'])
+            self.assertEqual(results['fused'][0]['point_counts']['fused'],
+                             results['fused'][0]['summary']['point_count'])
+            self.assertNotIn('summary', snapshot[0])
+
+            self.assertEqual(ERROR, results['rejected'][0]['type'])
+            self.assertEqual(CANCELLED, results['timeout'][-1]['type'])
+            self.assertEqual('timeout', results['timeout'][-1]['reason'])
+            self.assertEqual(ERROR, results['invalid'][-1]['type'])
+            self.assertEqual(CANCELLED, results['subscription'][-1]['type'])
+            self.assertGreaterEqual(results['subscription'][-1]['frame_count'], 2)
+
+            status = results['status'][0]
+            self.assertListEqual(['cam_1', 'cam_2'], status['cameras'])
+            self.assertEqual(0, status['active_jobs'])
+            self.assertEqual(1, status['timed_out_jobs'])
+
+    def test_invalid_and_disconnected_jobs(self):
+        async def run(data_dir: str, socket_path: str) -> dict:
+            service = create_service(data_dir)
+            ready = asyncio.Event()
+            server = asyncio.create_task(service.serve(socket_path, ready.set))
+            await ready.wait()
+            try:
+                invalid = await collect(socket_path, {'id': 'a', 'type': 'subscribe', 'frame_count': 'abc'})
+                # The service keeps measuring for later requests
+                snapshot = await collect(socket_path, {'id': 'b', 'type': 'snapshot'})
+
+                reader, writer = await asyncio.open_unix_connection(socket_path)
+                for request in [{'type': 'subscribe'}, {'type': 'subscribe'}, {'id': 'c', 'type': 'subscribe'},
+                                {'id': 'c', 'type': 'subscribe'}]:
+                    writer.write(json.dumps(request).encode() + b'\n')
+                duplicate = None
+                while duplicate is None:
+                    message = json.loads(await reader.readline())
+                    if message['type'] == ERROR:
+                        duplicate = message
+                # Two of the jobs are active and one is queued
+                status = service.get_status()
+                jobs = status['active_jobs'] + status['queued_jobs']
+                writer.close()
+                for _ in range(100):
+                    status = service.get_status()
+                    if status['active_jobs'] + status['queued_jobs'] == 0:
+                        break
+                    await asyncio.sleep(0.02)
+            finally:
+                server.cancel()
+                await asyncio.gather(server, return_exceptions=True)
+            return {'invalid': invalid, 'snapshot': snapshot, 'duplicate': duplicate, 'jobs': jobs, 'status': status}
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = asyncio.run(run(data_dir, os.path.join(data_dir, 'daemon.sock')))
+        self.assertListEqual([ERROR], [message['type'] for message in results['invalid']])
+        self.assertListEqual([MEASUREMENT, DONE], [message['type'] for message in results['snapshot']])
+        self.assertEqual('c', results['duplicate']['id'])
+        self.assertEqual(3, results['jobs'])
+        # All jobs of the disconnected client are cancelled, not only the last one
+        self.assertEqual(0, results['status']['active_jobs'] + results['status']['queued_jobs'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import functools
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from depth_camera_array.crop_volumes import MeasurementCylinder
+from depth_camera_array.measurement import create_fusion
+from depth_camera_array.measurement_workers import MultiprocessMeasurement
+from depth_camera_array.rig import CompiledRig
+from depth_camera_array.shared_frames import CaptureSource
+from depth_camera_array.simulation import DEFAULT_DEPTH_SCALE, SimulatedCamera, create_intrinsics
+
+
+class FailingCylinder(MeasurementCylinder):
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        raise ValueError('Cropping failed')
+
+
+class MyTestCase(unittest.TestCase):
+    def test_measure_multiprocess(self):
+        intrinsics = create_intrinsics(32, 24)
+        sources = {
+            device_id: CaptureSource(functools.partial(SimulatedCamera, device_id, depth_intrinsics=intrinsics,
+                                                       frame_rate=100, realtime=True), (24, 32), (24, 32, 3))
+            for device_id in ['cam_1', 'cam_2']
+        }
+        extrinsics = {'cam_1': np.eye(4), 'cam_2': np.eye(4)}
+        with tempfile.TemporaryDirectory() as data_dir:
+            rig = CompiledRig(os.path.join(data_dir, 'rig'), extrinsics)
+            measurement = MultiprocessMeasurement(sources, extrinsics, MeasurementCylinder(-5., 10., 5.), rig,
+                                                  data_dir, ['npy'], workers=2, ring_size=4, sync_tolerance=1.)
+            self.assertEqual(5, measurement.run(5)['frame_sets'])
+            self.assertListEqual(['cam_1', 'cam_2'], sorted(measurement.ring_statistics))
+            self.assertListEqual(['cam_1', 'cam_2'], sorted(rig.compiled))
+            # The workers use the rig of this process, which has no crop volume and therefore no pixel masks
+            self.assertListEqual(['cam_1_world_rays.npy', 'cam_2_world_rays.npy', 'manifest.json'],
+                                 sorted(os.listdir(rig.rig_dir)))
+            files = sorted(name for name in os.listdir(data_dir) if name.endswith('.npy'))
+            self.assertListEqual([f'{device_id}_{index:06d}.npy' for device_id in ['cam_1', 'cam_2']
+                                  for index in range(5)], files)
+            np.testing.assert_allclose(rig.deproject('cam_1', sources['cam_1'].open_camera().poll_frames()
+                                                     .get_depth_frame(), DEFAULT_DEPTH_SCALE),
+                                       np.load(os.path.join(data_dir, files[0])), atol=1e-5)
+
+            # The fusion is created by each worker from its factory
+            with tempfile.TemporaryDirectory() as fused_dir:
+                MultiprocessMeasurement(sources, extrinsics, MeasurementCylinder(-5., 10., 5.), rig, fused_dir, ['npy'],
+                                        workers=1, ring_size=4, sync_tolerance=1.,
+                                        create_fusion=functools.partial(create_fusion, 0.01)).run(2)
+                self.assertListEqual(['fused_000000.npy', 'fused_000001.npy'],
+                                     sorted(name for name in os.listdir(fused_dir) if name.endswith('.npy')))
+
+            # Without the worker, the capture processes would wait for free slots forever
+            measurement = MultiprocessMeasurement(sources, extrinsics, FailingCylinder(-5., 10., 5.), rig, data_dir,
+                                                  ['npy'], workers=1, ring_size=4, sync_tolerance=1.)
+            with self.assertRaisesRegex(RuntimeError, 'worker-0 failed with ValueError: Cropping failed'):
+                measurement.run()
+
+            with self.assertRaises(ValueError):
+                MultiprocessMeasurement(sources, extrinsics, MeasurementCylinder(-5., 10., 5.), rig, data_dir,
+                                        ['container'], workers=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from depth_camera_array.perform_aruco_detection import detect_aruco_targets
+from depth_camera_array.perform_benchmark import compare_with_baseline, measure_import, run_benchmarks
+from depth_camera_array.simulation import create_aruco_image
+
+
+class MyTestCase(unittest.TestCase):
+    def test_create_aruco_image(self):
+        _, aruco_ids = detect_aruco_targets(create_aruco_image(640, 480, marker_count=6))
+        self.assertEqual([1, 2, 3, 4, 5, 6], sorted(aruco_ids))
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(['640x480'], [2], ['transform_and_crop', 'write_ply', 'generate_extrinsics'], 2)
+        self.assertEqual(['transform_and_crop', 'write_ply', 'generate_extrinsics'],
+                         [result['stage'] for result in results])
+        for result in results:
+            self.assertEqual(2, result['cameras'])
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['throughput'], 0)
+
+    def test_compare_with_baseline(self):
+        baseline = [{'stage': 'write_ply', 'resolution': '640x480', 'cameras': 1, 'p50_ms': 10.}]
+        results = [
+            {'stage': 'write_ply', 'resolution': '640x480', 'cameras': 1, 'p50_ms': 11.},
+            {'stage': 'write_ply', 'resolution': '640x480', 'cameras': 4, 'p50_ms': 100.}
+        ]
+        self.assertEqual([], compare_with_baseline(results, baseline, 0.2))
+        results[0]['p50_ms'] = 13.
+        regressions = compare_with_baseline(results, baseline, 0.2)
+        self.assertEqual(1, len(regressions))
+        self.assertEqual(10., regressions[0]['baseline_p50_ms'])
+
+    def test_lazy_imports(self):
+        _, _, calibration_dependencies = measure_import('depth_camera_array.perform_calibration')
+        self.assertFalse({'pyrealsense2', 'cv2', 'open3d', 'matplotlib'} & set(calibration_dependencies))
+        for module in ['depth_camera_array.perform_measurement', 'depth_camera_array.perform_aruco_detection',
+                       'depth_camera_array.create_calibration_targets']:
+            _, _, dependencies = measure_import(module)
+            self.assertFalse({'cv2', 'open3d', 'matplotlib', 'rmsd'} & set(dependencies), module)
+
+
+if __name__ == '__main__':
+    unittest.main()
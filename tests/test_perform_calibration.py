@@ -1,8 +1,10 @@
+import copy
 import unittest
 
 import numpy as np
 
-from depth_camera_array.perform_calibration import define_base_camera, generate_extrinsics
+from depth_camera_array.perform_calibration import analyze_observation_graph, define_base_camera, \
+    generate_extrinsics, generate_extrinsics_with_report, kabsch
 
 WORLD_POINTS = {
     1: [0.3, 0., 0.],
@@ -72,12 +74,74 @@ CAM_TO_REAL = {
 }
 
 
+def create_ring(camera_count: int, seed: int = 0) -> tuple:
+    """Creates reference points of cameras in a ring around the origin. Each camera sees 6 markers, 3 of which are
+    also seen by its successor. The bottom markers are seen by the first camera only"""
+    random = np.random.RandomState(seed)
+    world_points = np.concatenate([[[0.3, 0., 0.], [0., 0., 0.], [0., 0., 0.2]],
+                                   random.uniform(-2., 2., (3 * camera_count - 3, 3))])
+    reference_points, cam_to_real = {}, {}
+    for index in range(camera_count):
+        rotation, _ = np.linalg.qr(random.normal(size=(3, 3)))
+        rotation *= np.linalg.det(rotation)
+        translation = random.uniform(-3., 3., 3)
+        arucos = np.arange(3 * index, 3 * index + 6) % (3 * camera_count)
+        centers = (world_points[arucos] - translation) @ rotation
+        reference_points[f'cam_{index}'] = {'aruco': (arucos + 1).tolist(), 'centers': centers.tolist()}
+        cam_to_real[f'cam_{index}'] = np.block([[rotation, translation[:, np.newaxis]], [np.zeros((1, 3)), 1.]])
+    return reference_points, cam_to_real
+
+
 class MyTestCase(unittest.TestCase):
     def test_generate_extrinsics(self):
         results = generate_extrinsics(REFERENCE_POINTS)
         for cam, expected in CAM_TO_REAL.items():
             np.testing.assert_array_almost_equal(results[cam], expected)
 
+    def test_generate_extrinsics_with_outlier(self):
+        reference_points = copy.deepcopy(REFERENCE_POINTS)
+        reference_points['cam_3']['centers'][4][2] += 0.3
+        results, report = generate_extrinsics_with_report(reference_points)
+        for cam, expected in CAM_TO_REAL.items():
+            np.testing.assert_array_almost_equal(results[cam], expected)
+        self.assertEqual('cam_2', report['base_camera'])
+        self.assertListEqual([10], report['cameras']['cam_3']['outliers'])
+        self.assertListEqual([1, 2, 3, 5, 9], report['cameras']['cam_3']['inliers'])
+        self.assertListEqual([], report['cameras']['cam_2']['outliers'])
+        self.assertAlmostEqual(0.3, report['cameras']['cam_3']['residuals'][5], places=6)
+        self.assertListEqual([], report['cameras']['cam_1']['outliers'])
+
+    def test_generate_extrinsics_ring(self):
+        reference_points, cam_to_real = create_ring(12)
+        results, report = generate_extrinsics_with_report(reference_points)
+        for cam, expected in cam_to_real.items():
+            np.testing.assert_array_almost_equal(results[cam], expected)
+        self.assertEqual('cam_0', report['base_camera'])
+        self.assertEqual(6, max(camera['depth'] for camera in report['cameras'].values()))
+        self.assertEqual(12, len(report['connectivity']['edges']))
+
+    def test_disconnected_graph(self):
+        reference_points, _ = create_ring(6)
+        reference_points['cam_3']['aruco'] = reference_points['cam_3']['aruco'][:2]
+        reference_points['cam_3']['centers'] = reference_points['cam_3']['centers'][:2]
+        reference_points['cam_4']['aruco'] = reference_points['cam_4']['aruco'][4:]
+        reference_points['cam_4']['centers'] = reference_points['cam_4']['centers'][4:]
+        self.assertListEqual([['cam_0', 'cam_1', 'cam_2', 'cam_5'], ['cam_3'], ['cam_4']],
+                             analyze_observation_graph(reference_points)['components'])
+        with self.assertRaises(ValueError):
+            generate_extrinsics(reference_points)
+
+    def test_kabsch(self):
+        random = np.random.RandomState(0)
+        src_points = random.uniform(-1., 1., (5, 10, 3))
+        rotations, _ = np.linalg.qr(random.normal(size=(5, 3, 3)))
+        rotations *= np.linalg.det(rotations)[:, np.newaxis, np.newaxis]
+        translations = random.uniform(-1., 1., (5, 3))
+        dst_points = np.einsum('bij,bnj->bni', rotations, src_points) + translations[:, np.newaxis]
+        transformations = kabsch(src_points, dst_points)
+        np.testing.assert_array_almost_equal(rotations, transformations[:, :3, :3])
+        np.testing.assert_array_almost_equal(translations, transformations[:, :3, 3])
+
     def test_define_base_camera(self):
         expected = 'cam_2'
         result = define_base_camera(REFERENCE_POINTS)
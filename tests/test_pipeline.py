@@ -0,0 +1,127 @@
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from depth_camera_array.buffer_pool import BufferPool
+from depth_camera_array.camera_array import CameraArray, capture_frame_sets
+from depth_camera_array.crop_volumes import MeasurementCylinder
+from depth_camera_array.measurement import create_measurement_stages, release_points
+from depth_camera_array.pipeline import BoundedBuffer, Pipeline, RingSink, map_stage, DROP_OLDEST, DROP_NEWEST
+from depth_camera_array.rig import CompiledRig
+from depth_camera_array.simulation import SimulatedCamera, create_intrinsics
+
+
+class MyTestCase(unittest.TestCase):
+    def test_bounded_buffer_drop_oldest(self):
+        buffer = BoundedBuffer(2, DROP_OLDEST)
+        for item in range(5):
+            buffer.put(item)
+        buffer.close()
+        self.assertListEqual([3, 4], list(buffer))
+        self.assertEqual(3, buffer.dropped)
+
+    def test_bounded_buffer_drop_newest(self):
+        buffer = BoundedBuffer(2, DROP_NEWEST)
+        for item in range(5):
+            buffer.put(item)
+        buffer.close()
+        self.assertListEqual([0, 1], list(buffer))
+        self.assertEqual(3, buffer.dropped)
+
+    def test_pipeline(self):
+        sink = RingSink(3)
+        pipeline = Pipeline(range(10), [map_stage('double', lambda item: 2 * item),
+                                        map_stage('increment', lambda item: item + 1)], sink)
+        pipeline.run()
+        self.assertListEqual([15, 17, 19], list(sink.items))
+        statistics = pipeline.get_statistics()
+        self.assertListEqual(['source', 'double', 'increment', 'sink'], list(statistics))
+        self.assertTrue(all(stage['processed'] == 10 and stage['dropped'] == 0 for stage in statistics.values()))
+
+    def test_pipeline_with_slow_sink_drops_frames(self):
+        release = threading.Event()
+
+        def slow_sink(item):
+            release.wait()
+
+        def source():
+            for item in range(20):
+                yield item
+            release.set()
+
+        pipeline = Pipeline(source(), [map_stage('identity', lambda item: item, policy=DROP_OLDEST)], slow_sink,
+                            sink_buffer_size=1, sink_policy=DROP_OLDEST)
+        pipeline.run()
+        statistics = pipeline.get_statistics()
+        self.assertEqual(20, statistics['source']['processed'])
+        self.assertGreater(statistics['sink']['dropped'] + statistics['identity']['dropped'], 0)
+
+    def test_pipeline_reraises_errors(self):
+        def fail(item):
+            raise ValueError(item)
+
+        pipeline = Pipeline(range(10), [map_stage('fail', fail)], RingSink(1))
+        with self.assertRaises(ValueError):
+            pipeline.run()
+
+    def test_measurement_stages(self):
+        cameras = [SimulatedCamera(f'cam_{index}', depth_intrinsics=create_intrinsics(64, 48), frame_rate=200,
+                                   realtime=True) for index in range(2)]
+        extrinsics = {'cam_0': np.eye(4), 'cam_1': np.diag([-1., 1., -1., 1.])}
+        sink = RingSink(10)
+        with CameraArray(cameras) as camera_array:
+            Pipeline(capture_frame_sets(camera_array, 3),
+                     create_measurement_stages(cameras, extrinsics, MeasurementCylinder(-5., 10., 2.)), sink).run()
+
+        self.assertListEqual([0, 1, 2], [measurement.frame_number for measurement in sink.items])
+        for measurement in sink.items:
+            self.assertSetEqual({'cam_0', 'cam_1'}, set(measurement.points))
+            np.testing.assert_allclose(1.5, measurement.points['cam_0'][:, 2])
+            np.testing.assert_allclose(-1.5, measurement.points['cam_1'][:, 2])
+
+    def test_measurement_stages_with_rig(self):
+        cameras = [SimulatedCamera(f'cam_{index}', depth_intrinsics=create_intrinsics(64, 48), frame_rate=200,
+                                   realtime=True) for index in range(2)]
+        extrinsics = {'cam_0': np.eye(4), 'cam_1': np.diag([-1., 1., -1., 1.])}
+        crop_volume = MeasurementCylinder(-5., 10., 2.)
+        sink, rig_sink = RingSink(2), RingSink(2)
+        with tempfile.TemporaryDirectory() as rig_dir:
+            for stages, measurement_sink in [(create_measurement_stages(cameras, extrinsics, crop_volume), sink),
+                                             (create_measurement_stages(cameras, extrinsics, crop_volume,
+                                                                        rig=CompiledRig(rig_dir, extrinsics)),
+                                              rig_sink)]:
+                with CameraArray(cameras) as camera_array:
+                    Pipeline(capture_frame_sets(camera_array, 2), stages, measurement_sink).run()
+        for measurement, rig_measurement in zip(sink.items, rig_sink.items):
+            for device_id, points in measurement.points.items():
+                np.testing.assert_allclose(points, rig_measurement.points[device_id], atol=1e-5)
+
+    def test_pooled_measurement_stages(self):
+        cameras = [SimulatedCamera(f'cam_{index}', depth_intrinsics=create_intrinsics(64, 48), frame_rate=200,
+                                   realtime=True) for index in range(2)]
+        extrinsics = {'cam_0': np.eye(4), 'cam_1': np.diag([-1., 1., -1., 1.])}
+        crop_volume = MeasurementCylinder(-5., 10., 2.)
+        with tempfile.TemporaryDirectory() as rig_dir:
+            for rig in [None, CompiledRig(rig_dir, extrinsics, crop_volume)]:
+                pool, measurements = BufferPool(), []
+
+                def sink(measurement):
+                    measurements.append({device_id: points.copy() for device_id, points in measurement.points.items()})
+                    release_points(pool, measurement.points.values())
+
+                with CameraArray(cameras) as camera_array:
+                    stages = create_measurement_stages(cameras, extrinsics, crop_volume, rig=rig, pool=pool)
+                    Pipeline(capture_frame_sets(camera_array, 6), stages, sink).run()
+                self.assertEqual(6, len(measurements))
+                for points in measurements:
+                    np.testing.assert_allclose(1.5, points['cam_0'][:, 2], atol=1e-5)
+                    np.testing.assert_allclose(-1.5, points['cam_1'][:, 2], atol=1e-5)
+                self.assertEqual(0, pool.checked_out)
+                # Once the first frames are released, their buffers are reused
+                self.assertGreater(pool.reuses, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
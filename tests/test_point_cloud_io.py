@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from depth_camera_array.point_cloud_io import PointCloudContainerReader, PointCloudContainerWriter, load_npy, \
+    load_ply, write_json, write_npy, write_ply
+from depth_camera_array.utilities import load_json_to_dict
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.points = np.random.RandomState(0).uniform(-2., 2., (1000, 3)).astype(np.float32)
+
+    def tearDown(self):
+        self.data_dir.cleanup()
+
+    def test_npy(self):
+        path = os.path.join(self.data_dir.name, 'cam_1.npy')
+        write_npy(self.points, path)
+        result = load_npy(path)
+        self.assertIsInstance(result, np.memmap)
+        np.testing.assert_array_equal(self.points, result)
+
+    def test_ply(self):
+        path = os.path.join(self.data_dir.name, 'cam_1.ply')
+        write_ply(self.points, path)
+        np.testing.assert_array_equal(self.points, load_ply(path))
+        np.testing.assert_array_equal(self.points, load_ply(path, memory_map=False))
+
+    def test_ply_is_readable_by_open3d(self):
+        import open3d as o3d
+        path = os.path.join(self.data_dir.name, 'cam_1.ply')
+        write_ply(self.points, path)
+        np.testing.assert_allclose(self.points, np.asarray(o3d.io.read_point_cloud(path).points), rtol=1e-6)
+
+    def test_container(self):
+        path = os.path.join(self.data_dir.name, 'measurement.dcapc')
+        with PointCloudContainerWriter(path, chunk_size=300) as writer:
+            for frame_number in range(3):
+                writer.write(frame_number, 'cam_1', self.points + frame_number, timestamp=frame_number * 33.3)
+                writer.write(frame_number, 'cam_2', self.points[:frame_number])
+
+        with PointCloudContainerReader(path) as reader:
+            self.assertEqual(6, len(reader.keys()))
+            self.assertEqual((2, 'cam_1'), reader.keys()[4])
+            np.testing.assert_array_equal(self.points + 1, reader.read(1, 'cam_1'))
+            self.assertEqual((0, 3), reader.read(0, 'cam_2').shape)
+            self.assertEqual(4, len(reader.index[0]['chunks']))
+            self.assertEqual(6, len(list(reader)))
+
+    def test_json(self):
+        path = os.path.join(self.data_dir.name, 'cam_1_object_points.json')
+        write_json(self.points[:5], path, 'cam_1')
+        np.testing.assert_allclose(self.points[:5].transpose(), load_json_to_dict(path)['cam_1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
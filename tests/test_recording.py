@@ -0,0 +1,62 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from depth_camera_array.camera import initialize_connected_cameras
+from depth_camera_array.recording import ReplayCamera, record_frame_sets
+from depth_camera_array.simulation import SimulatedCamera, create_depth_image, create_intrinsics
+
+DEPTH_INTRINSICS = create_intrinsics(64, 48)
+COLOR_INTRINSICS = create_intrinsics(80, 60, horizontal_fov=69.)
+DEPTH_TO_COLOR = np.array([
+    [1., 0., 0., 0.015],
+    [0., 1., 0., 0.],
+    [0., 0., 1., 0.],
+    [0., 0., 0., 1.]
+])
+
+
+def create_camera(device_id: str) -> SimulatedCamera:
+    depth_images = [create_depth_image(DEPTH_INTRINSICS, foreground=1. + index * 0.1) for index in range(5)]
+    color_images = [np.full((60, 80, 3), index, dtype=np.uint8) for index in range(5)]
+    return SimulatedCamera(device_id, depth_images, color_images, DEPTH_INTRINSICS, COLOR_INTRINSICS, DEPTH_TO_COLOR,
+                           frame_rate=100, realtime=True)
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.recording_dir = tempfile.TemporaryDirectory()
+        self.cameras = [create_camera('cam_1'), create_camera('cam_2')]
+        record_frame_sets(self.cameras, self.recording_dir.name, 4)
+
+    def tearDown(self):
+        self.recording_dir.cleanup()
+
+    def test_replay(self):
+        replay_cameras = initialize_connected_cameras(self.recording_dir.name)
+        self.assertListEqual(['cam_1', 'cam_2'], [camera.device_id for camera in replay_cameras])
+        reference = create_camera('cam_1')
+        replay = replay_cameras[0]
+        self.assertEqual(4, replay.frame_count)
+        for index in range(4):
+            expected = reference.poll_frames()
+            frames = replay.poll_frames()
+            self.assertEqual(index, frames.get_frame_number())
+            np.testing.assert_almost_equal(expected.get_timestamp(), frames.get_timestamp())
+            np.testing.assert_array_equal(expected.get_color_frame().get_data(), frames.get_color_frame().get_data())
+            np.testing.assert_array_equal(reference.depth_frame_to_object_points(expected),
+                                          replay.depth_frame_to_object_points(frames))
+            np.testing.assert_allclose(reference.image_points_to_object_points([[40., 30.]], expected),
+                                       replay.image_points_to_object_points([[40., 30.]], frames), rtol=1e-6)
+        with self.assertRaises(EOFError):
+            replay.poll_frames()
+
+    def test_replay_loop(self):
+        replay = ReplayCamera(f'{self.recording_dir.name}/cam_2', loop=True)
+        frame_numbers = [replay.poll_frames().get_frame_number() for _ in range(6)]
+        self.assertListEqual([0, 1, 2, 3, 0, 1], frame_numbers)
+
+
+if __name__ == '__main__':
+    unittest.main()
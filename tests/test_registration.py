@@ -0,0 +1,90 @@
+import unittest
+
+import numpy as np
+
+from depth_camera_array.deprojection import create_ray_table
+from depth_camera_array.perform_calibration import create_homogenous, rotations_from_vectors
+from depth_camera_array.perform_icp_refinement import capture_point_clouds
+from depth_camera_array.registration import VoxelHash, estimate_normals, refine_extrinsics
+from depth_camera_array.simulation import SimulatedCamera, create_intrinsics
+
+DEPTH_SCALE = 0.001
+# Spheres of different sizes on the floor, so the scene constrains all six degrees of freedom of each camera
+SPHERES = [(np.array([0., 0.3, 0.]), 0.3), (np.array([0.5, 0.15, 0.3]), 0.15), (np.array([-0.4, 0.2, -0.5]), 0.2)]
+
+
+def look_at(position: np.ndarray, target: np.ndarray = np.array([0., 0.3, 0.])) -> np.ndarray:
+    forward = (target - position) / np.linalg.norm(target - position)
+    right = np.cross(forward, [0., 1., 0.])
+    right /= np.linalg.norm(right)
+    return create_homogenous(np.stack([right, np.cross(forward, right), forward], axis=1), position)
+
+
+def render_scene(intrinsics, extrinsic: np.ndarray, max_depth: float = 4.) -> np.ndarray:
+    """Renders the z16 depth image of the floor at y = 0 and the spheres seen by a camera"""
+    rays = create_ray_table(intrinsics).astype(np.float64)
+    world_rays = rays @ extrinsic[:3, :3].T
+    origin = extrinsic[:3, 3]
+    with np.errstate(divide='ignore'):
+        depth = -origin[1] / world_rays[:, 1]
+    depth[depth <= 0] = np.inf
+    for center, radius in SPHERES:
+        offset = center - origin
+        a = np.sum(world_rays ** 2, axis=1)
+        b = world_rays @ offset
+        discriminant = b ** 2 - a * (offset @ offset - radius ** 2)
+        hit = (b - np.sqrt(np.maximum(discriminant, 0.))) / a
+        depth = np.where((discriminant > 0) & (hit > 0) & (hit < depth), hit, depth)
+    depth[depth > max_depth] = 0.
+    return np.rint(depth / DEPTH_SCALE).astype(np.uint16).reshape(intrinsics.height, intrinsics.width)
+
+
+def rotation_angle(rotation: np.ndarray) -> float:
+    return float(np.degrees(np.arccos(np.clip((np.trace(rotation) - 1.) / 2., -1., 1.))))
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.intrinsics = create_intrinsics(320, 240)
+        angles = np.radians([0., 90., 180., 270.])
+        self.extrinsics = {f'cam_{index}': look_at(np.array([2. * np.cos(angle), 1.2, 2. * np.sin(angle)]))
+                           for index, angle in enumerate(angles)}
+
+    def test_normals(self):
+        x, z = np.meshgrid(np.arange(-1., 1., 0.05) + 0.025, np.arange(1., 2., 0.05) + 0.025)
+        points = np.column_stack([x.ravel(), np.zeros(x.size), z.ravel()])
+        cloud = VoxelHash(points.astype(np.float32), 0.05)
+        normals, planar = estimate_normals(cloud)
+        # Only the corners have too few neighbours
+        self.assertEqual(4, np.count_nonzero(~planar))
+        # The normals of the plane y = 0 point towards the origin, which lies on the plane, so only their axis is fixed
+        np.testing.assert_allclose(1., np.abs(normals[:, 1]), atol=1e-5)
+
+    def test_refine_extrinsics(self):
+        cameras = [SimulatedCamera(device_id, [render_scene(self.intrinsics, extrinsic)],
+                                   depth_intrinsics=self.intrinsics, depth_scale=DEPTH_SCALE, realtime=True,
+                                   frame_rate=100)
+                   for device_id, extrinsic in self.extrinsics.items()]
+        point_clouds = capture_point_clouds(cameras, max_depth=3.5)
+        self.assertListEqual(sorted(self.extrinsics), sorted(point_clouds))
+        self.assertTrue(all(np.all(points[:, 2] <= 3.5) for points in point_clouds.values()))
+
+        # Errors of a few cm and degree, as they remain after a marker calibration
+        random = np.random.RandomState(1)
+        perturbed = {device_id: create_homogenous(rotations_from_vectors(random.normal(0., 0.01, (1, 3)))[0],
+                                                  random.normal(0., 0.015, 3)) @ extrinsic
+                     for device_id, extrinsic in self.extrinsics.items()}
+        perturbed['cam_0'] = self.extrinsics['cam_0']
+        registration = refine_extrinsics(point_clouds, perturbed, base_camera='cam_0')
+        np.testing.assert_array_equal(self.extrinsics['cam_0'], registration.extrinsics['cam_0'])
+        for device_id, extrinsic in self.extrinsics.items():
+            error = np.linalg.solve(extrinsic, registration.extrinsics[device_id])
+            self.assertLess(np.linalg.norm(error[:3, 3]), 0.002)
+            self.assertLess(rotation_angle(error[:3, :3]), 0.1)
+        self.assertEqual('cam_0', registration.report['base_camera'])
+        self.assertEqual(6, len(registration.report['pairs']))
+        self.assertTrue(all(camera['rmsd'] < 0.002 for camera in registration.report['cameras'].values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from depth_camera_array.crop_volumes import MeasurementCylinder, transform_points
+from depth_camera_array.rig import CompiledRig
+from depth_camera_array.simulation import SimulatedCamera, create_intrinsics, create_depth_image
+
+EXTRINSIC = np.array([
+    [0., 0., 1., 0.5],
+    [0., 1., 0., 1.2],
+    [-1., 0., 0., -0.3],
+    [0., 0., 0., 1.]
+])
+
+
+class MyTestCase(unittest.TestCase):
+    def test_deproject(self):
+        intrinsics = create_intrinsics(64, 48)
+        depth_image = create_depth_image(intrinsics)
+        depth_image[:5] = 0
+        camera = SimulatedCamera('cam_1', [depth_image], depth_intrinsics=intrinsics)
+        frames = camera.poll_frames()
+        expected = transform_points(camera.depth_frame_to_object_points(frames, remove_zero_depth=True), EXTRINSIC)
+        with tempfile.TemporaryDirectory() as rig_dir:
+            rig = CompiledRig(rig_dir, {'cam_1': EXTRINSIC})
+            points = rig.deproject('cam_1', frames.get_depth_frame(), camera.depth_scale)
+            self.assertEqual(np.float32, points.dtype)
+            np.testing.assert_allclose(expected, points, atol=1e-5)
+            self.assertListEqual(['cam_1'], rig.compiled)
+
+            # A second rig with the same calibration maps the stored table instead of compiling it again
+            rig = CompiledRig(rig_dir, {'cam_1': EXTRINSIC})
+            np.testing.assert_array_equal(points, rig.deproject('cam_1', frames.get_depth_frame(), camera.depth_scale))
+            self.assertListEqual([], rig.compiled)
+            self.assertIsInstance(rig.get_table('cam_1', intrinsics, camera.depth_scale).rays, np.memmap)
+
+            # A new calibration or stream mode invalidates the stored table
+            rig = CompiledRig(rig_dir, {'cam_1': np.eye(4)})
+            np.testing.assert_allclose(camera.depth_frame_to_object_points(frames, remove_zero_depth=True),
+                                       rig.deproject('cam_1', frames.get_depth_frame(), camera.depth_scale),
+                                       atol=1e-5)
+            self.assertListEqual(['cam_1'], rig.compiled)
+            rig.get_table('cam_1', create_intrinsics(32, 24), camera.depth_scale)
+            self.assertListEqual(['cam_1', 'cam_1'], rig.compiled)
+            table = rig.get_table('cam_1', create_intrinsics(32, 24), 2 * camera.depth_scale)
+            self.assertListEqual(['cam_1', 'cam_1', 'cam_1'], rig.compiled)
+            self.assertIs(table, rig.get_table('cam_1', create_intrinsics(32, 24), 2 * camera.depth_scale))
+            self.assertSetEqual({'manifest.json', 'cam_1_world_rays.npy'}, set(os.listdir(rig_dir)))
+
+    def test_pixel_mask(self):
+        intrinsics = create_intrinsics(64, 48)
+        depth_image = create_depth_image(intrinsics)
+        camera = SimulatedCamera('cam_1', [depth_image], depth_intrinsics=intrinsics)
+        frames = camera.poll_frames()
+        crop_volume = MeasurementCylinder(-0.3, 0.6, 0.2)
+        # Moves the box in front of the camera into the cylinder
+        extrinsics = {'cam_1': np.eye(4)}
+        extrinsics['cam_1'][2, 3] = -1.5
+        with tempfile.TemporaryDirectory() as rig_dir:
+            points = CompiledRig(rig_dir, extrinsics).deproject('cam_1', frames.get_depth_frame(), camera.depth_scale)
+            expected = points[crop_volume.contains(points)]
+            self.assertGreater(len(expected), 0)
+
+            rig = CompiledRig(rig_dir, extrinsics, crop_volume)
+            culled_points = rig.deproject('cam_1', frames.get_depth_frame(), camera.depth_scale)
+            mask = rig.get_mask('cam_1', intrinsics, camera.depth_scale)
+            self.assertLess(len(mask.indices), depth_image.size)
+            self.assertLess(len(culled_points), len(points))
+            np.testing.assert_allclose(expected, culled_points[crop_volume.contains(culled_points)], atol=1e-6)
+            self.assertListEqual(['cam_1'], rig.compiled_masks)
+
+            # The stored mask is reused until the crop volume or the depth range changes
+            rig = CompiledRig(rig_dir, extrinsics, crop_volume)
+            np.testing.assert_array_equal(mask.indices, rig.get_mask('cam_1', intrinsics, camera.depth_scale).indices)
+            self.assertListEqual([], rig.compiled_masks)
+            rig = CompiledRig(rig_dir, extrinsics, crop_volume, (0., 1.))
+            self.assertEqual(0, len(rig.deproject('cam_1', frames.get_depth_frame(), camera.depth_scale)))
+            self.assertListEqual(['cam_1'], rig.compiled_masks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+
+from depth_camera_array.pipeline import BLOCK, DROP_NEWEST, DROP_OLDEST
+from depth_camera_array.shared_frames import FrameRing
+
+DEPTH_SHAPE = (4, 6)
+
+
+def create_depth(value: int) -> np.ndarray:
+    return np.full(DEPTH_SHAPE, value, dtype=np.uint16)
+
+
+class MyTestCase(unittest.TestCase):
+    def test_write_and_read(self):
+        ring = FrameRing.create('cam_1', 2, DEPTH_SHAPE, DEPTH_SHAPE + (3,), DROP_OLDEST)
+        reader = FrameRing.attach(ring.spec)
+        try:
+            first = ring.write(create_depth(1), np.zeros(DEPTH_SHAPE + (3,), dtype=np.uint8), 10, 1.)
+            depth_image, color_image = reader.read(first)
+            self.assertEqual((0, 0, 10, 1.), (first.slot, first.sequence, first.frame_number, first.timestamp))
+            np.testing.assert_array_equal(create_depth(1), depth_image)
+            self.assertEqual(DEPTH_SHAPE + (3,), color_image.shape)
+
+            # The slot of the first frame is reused by the third one, which overwrites the unreleased first frame
+            ring.write(create_depth(2), None, 11, 2.)
+            third = ring.write(create_depth(3), None, 12, 3.)
+            self.assertEqual(0, third.slot)
+            self.assertFalse(reader.is_current(first))
+            self.assertEqual((None, None), reader.read(first))
+            # The view of the first frame now shows the third one, which is why is_current has to be checked
+            np.testing.assert_array_equal(create_depth(3), depth_image)
+            reader.release(first)
+            self.assertDictEqual({'written': 3, 'dropped': 0, 'overwritten': 1}, ring.get_statistics())
+        finally:
+            reader.close()
+            ring.close()
+
+    def test_drop_newest_and_block(self):
+        ring = FrameRing.create('cam_1', 1, DEPTH_SHAPE, policy=DROP_NEWEST)
+        first = ring.write(create_depth(1), None, 0, 0.)
+        self.assertIsNone(ring.write(create_depth(2), None, 1, 1.))
+        np.testing.assert_array_equal(create_depth(1), ring.read(first)[0])
+        ring.release(first)
+        self.assertIsNotNone(ring.write(create_depth(3), None, 2, 2.))
+        self.assertDictEqual({'written': 2, 'dropped': 1, 'overwritten': 0}, ring.get_statistics())
+        ring.close()
+
+        ring = FrameRing.create('cam_1', 1, DEPTH_SHAPE, policy=BLOCK)
+        ring.write(create_depth(1), None, 0, 0.)
+        self.assertIsNone(ring.write(create_depth(2), None, 1, 1., should_stop=lambda: True))
+        ring.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import argparse
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from depth_camera_array.crop_volumes import MeasurementCylinder
+from depth_camera_array.deprojection import create_ray_table
+from depth_camera_array.perform_measurement import measure_tsdf
+from depth_camera_array.point_cloud_io import load_npy
+from depth_camera_array.rig import compile_world_rays
+from depth_camera_array.simulation import SimulatedCamera, create_intrinsics
+from depth_camera_array.tsdf import TsdfVolume
+
+DEPTH_SCALE = 0.001
+RADIUS = 0.1
+CENTER = np.array([0., 0.2, 0.])
+
+
+def create_extrinsic(rotation: np.ndarray, position: np.ndarray) -> np.ndarray:
+    extrinsic = np.eye(4)
+    extrinsic[:3, :3] = rotation
+    extrinsic[:3, 3] = position
+    return extrinsic
+
+
+# Four cameras on a circle around the sphere looking at its center
+EXTRINSICS = [
+    create_extrinsic(np.diag([1., 1., 1.]), [0., 0.2, -0.6]),
+    create_extrinsic(np.diag([-1., 1., -1.]), [0., 0.2, 0.6]),
+    create_extrinsic(np.array([[0., 0., 1.], [0., 1., 0.], [-1., 0., 0.]]), [-0.6, 0.2, 0.]),
+    create_extrinsic(np.array([[0., 0., -1.], [0., 1., 0.], [1., 0., 0.]]), [0.6, 0.2, 0.]),
+]
+
+
+def render_sphere(intrinsics, extrinsic: np.ndarray) -> np.ndarray:
+    """Renders the z16 depth image of the sphere seen by a camera"""
+    rays = create_ray_table(intrinsics).astype(np.float64)
+    center = (CENTER - extrinsic[:3, 3]) @ extrinsic[:3, :3]
+    a = np.sum(rays ** 2, axis=1)
+    b = rays @ center
+    discriminant = b ** 2 - a * (center @ center - RADIUS ** 2)
+    depth = np.where(discriminant > 0, (b - np.sqrt(np.maximum(discriminant, 0.))) / a, 0.)
+    return np.rint(depth / DEPTH_SCALE).astype(np.uint16).reshape(intrinsics.height, intrinsics.width)
+
+
+class MyTestCase(unittest.TestCase):
+    def test_integrate_sphere(self):
+        intrinsics = create_intrinsics(160, 120)
+        volume = TsdfVolume(voxel_size=0.005, crop_volume=MeasurementCylinder(0., 0.5, 0.3))
+        frames = [(render_sphere(intrinsics, extrinsic), compile_world_rays(intrinsics, DEPTH_SCALE, extrinsic),
+                   extrinsic) for extrinsic in EXTRINSICS]
+        for depth_image, table, extrinsic in frames:
+            self.assertGreater(volume.integrate(depth_image, table, intrinsics, DEPTH_SCALE, extrinsic), 0)
+        block_count, memory = volume.block_count, volume.memory_bytes
+
+        # Fusing the same views again neither allocates blocks nor memory
+        for _ in range(3):
+            for depth_image, table, extrinsic in frames:
+                volume.integrate(depth_image, table, intrinsics, DEPTH_SCALE, extrinsic)
+        self.assertEqual(block_count, volume.block_count)
+        self.assertEqual(memory, volume.memory_bytes)
+
+        points = volume.extract_points()
+        self.assertEqual(np.float32, points.dtype)
+        self.assertGreater(points.shape[0], 1000)
+        # Only at the poles, which all cameras see at grazing angles, the error reaches about one voxel
+        distances = np.abs(np.linalg.norm(points - CENTER, axis=1) - RADIUS)
+        self.assertLess(np.percentile(distances, 99), 0.004)
+        self.assertLess(distances.max(), 2 * volume.voxel_size)
+
+        mesh = volume.extract_mesh()
+        self.assertGreater(mesh.faces.shape[0], 1000)
+        self.assertLess(np.abs(np.linalg.norm(mesh.vertices - CENTER, axis=1) - RADIUS).max(), 2 * volume.voxel_size)
+        # Faces point outwards, towards the cameras
+        triangles = mesh.vertices[mesh.faces]
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        outward = np.sum(normals * (triangles.mean(axis=1) - CENTER), axis=1) > 0
+        self.assertGreater(outward.mean(), 0.99)
+
+    def test_crop_volume(self):
+        intrinsics = create_intrinsics(160, 120)
+        # The cylinder contains only the upper half of the sphere
+        volume = TsdfVolume(voxel_size=0.005, crop_volume=MeasurementCylinder(0.2, 0.5, 0.3))
+        table = compile_world_rays(intrinsics, DEPTH_SCALE, EXTRINSICS[0])
+        volume.integrate(render_sphere(intrinsics, EXTRINSICS[0]), table, intrinsics, DEPTH_SCALE, EXTRINSICS[0])
+        block_height = volume.voxel_size * volume.block_size
+        self.assertTrue(np.all(volume._coordinates[:volume.block_count, 1] >= np.floor(0.2 / block_height)))
+        self.assertTrue(np.all(volume.extract_points()[:, 1] >= 0.2))
+
+    def test_measure_tsdf(self):
+        intrinsics = create_intrinsics(160, 120)
+        cameras = [SimulatedCamera(f'cam_{index}', [render_sphere(intrinsics, extrinsic)], depth_intrinsics=intrinsics,
+                                   frame_rate=100, realtime=True)
+                   for index, extrinsic in enumerate(EXTRINSICS)]
+        extrinsics = {camera.device_id: extrinsic for camera, extrinsic in zip(cameras, EXTRINSICS)}
+        with tempfile.TemporaryDirectory() as data_dir:
+            args = argparse.Namespace(data_dir=data_dir, output_formats=['npy'], voxel_size=0.005, truncation=None,
+                                      frame_count=3, sync_tolerance=15., recording_dir=None, realtime=False,
+                                      min_depth=0., max_depth=None)
+            measure_tsdf(args, cameras, extrinsics, MeasurementCylinder(0., 0.5, 0.3))
+            points = load_npy(os.path.join(data_dir, 'tsdf.npy'))
+            self.assertGreater(points.shape[0], 1000)
+            with open(os.path.join(data_dir, 'tsdf_mesh.ply'), 'rb') as f:
+                header = f.read(256)
+            self.assertIn(b'element face', header)
+
+
+if __name__ == '__main__':
+    unittest.main()